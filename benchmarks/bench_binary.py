@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк двоичных файлов: накладные расходы по объему и скорость записи и
+восстановления в сравнении с текстовыми файлами того же объема
+"""
+
+import argparse
+import itertools
+import os
+import random
+import tempfile
+from pathlib import Path
+
+import yaml
+
+from common import make_text, measure, print_table
+
+from main import (YAML_DUMPER, NullProgress, ScanRules, backup_reader, open_backup, restore_backup_stream,
+                  scan_directory, write_backup)
+
+
+def make_tree(root: Path, files: int, size: int, binary: bool) -> int:
+    """Создает files файлов примерно по size байт: случайные байты или текст; возвращает объем."""
+    rng = random.Random(0)
+    total = 0
+    for i in range(files):
+        directory = root / f'dir{i // 50}'
+        directory.mkdir(parents=True, exist_ok=True)
+        if binary:
+            data = b'\0' + rng.randbytes(size - 1) if hasattr(rng, 'randbytes') else b'\0' + os.urandom(size - 1)
+            (directory / f'blob{i}.bin').write_bytes(data)
+        else:
+            data = make_text(size, seed=i).encode('utf-8')
+            (directory / f'module{i}.py').write_bytes(data)
+        total += len(data)
+    return total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=500, help='Файлов каждого вида')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='Размер файла в байтах')
+    parser.add_argument('--repeat', type=int, default=3, help='Запусков на этап (берется лучший)')
+    args = parser.parse_args()
+
+    rules = ScanRules(all_files=True)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        runs = itertools.count()
+        rows = {}
+        for kind in ('text', 'binary'):
+            source_path = temp_path / kind
+            source_bytes = make_tree(source_path, args.files, args.size, kind == 'binary')
+            skeleton = scan_directory(source_path, read_content=False, rules=rules)
+            megabytes = source_bytes / 1024 / 1024
+
+            for backup_format in ('yaml', 'records'):
+                backup_path = temp_path / f'{kind}.{backup_format}'
+
+                def create() -> None:
+                    with open(backup_path, 'wb') as f:
+                        write_backup(f, source_path, skeleton, backup_format=backup_format)
+
+                def restore() -> None:
+                    with open_backup(backup_path) as f:
+                        reader = backup_reader(f)
+                        reader.read_header()
+                        restore_backup_stream(reader, temp_path / f'restore{next(runs)}', NullProgress())
+
+                create_seconds = measure(create, args.repeat)
+                restore_seconds = measure(restore, args.repeat)
+                rows[f'{kind} {backup_format}'] = {
+                    'overhead': backup_path.stat().st_size / source_bytes,
+                    'create MB/s': megabytes / create_seconds,
+                    'restore MB/s': megabytes / restore_seconds,
+                }
+
+            if kind == 'binary':
+                # Прежний путь: байты как строка latin-1 с экранированием в YAML
+                files = [path.read_bytes() for path in sorted(source_path.rglob('*.bin'))]
+                dumped = {}
+
+                def dump_latin1() -> None:
+                    dumped['bytes'] = sum(
+                        len(yaml.dump({'content': str(data, 'latin-1')}, Dumper=YAML_DUMPER,
+                                      allow_unicode=True).encode('utf-8'))
+                        for data in files)
+
+                seconds = measure(dump_latin1, 1)
+                rows['binary yaml latin-1 (до)'] = {
+                    'overhead': dumped['bytes'] / source_bytes,
+                    'create MB/s': megabytes / seconds,
+                    'restore MB/s': '-',
+                }
+
+        print_table(f"Двоичные и текстовые файлы ({args.files} × {args.size // 1024} KB каждого вида)", rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сжатия бэкапа: скорость записи, чтения и размер для разных кодеков и уровней
+"""
+
+import argparse
+import tempfile
+from pathlib import Path
+
+from common import make_text_tree, measure, print_table
+
+from main import BackupYamlReader, open_backup, open_backup_output, scan_directory, write_backup
+
+CODECS = [
+    ('.yml', None),
+    ('.yml.gz', 1),
+    ('.yml.gz', 6),
+    ('.yml.gz', 9),
+    ('.yml.bz2', 1),
+    ('.yml.bz2', 9),
+    ('.yml.xz', 0),
+    ('.yml.xz', 6),
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=500, help='Число файлов в дереве')
+    parser.add_argument('--size', type=int, default=20_000, help='Размер файла в символах')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        source_path = temp_path / 'source'
+        total_bytes = make_text_tree(source_path, args.files, args.size)
+        skeleton = scan_directory(source_path, read_content=False)
+        megabytes = total_bytes / 1024 / 1024
+
+        rows = {}
+        for suffix, level in CODECS:
+            backup_path = temp_path / f'backup{suffix}'
+
+            def create() -> None:
+                with open_backup_output(backup_path, level) as f:
+                    write_backup(f, source_path, skeleton)
+
+            def read() -> None:
+                with open_backup(backup_path) as f:
+                    reader = BackupYamlReader(f)
+                    reader.read_header()
+                    for _ in reader.iter_entries():
+                        pass
+
+            write_time = measure(create)
+            read_time = measure(read)
+            name = suffix if level is None else f'{suffix} (уровень {level})'
+            rows[name] = {
+                'write, MB/s': megabytes / write_time,
+                'read, MB/s': megabytes / read_time,
+                'size, KB': backup_path.stat().st_size // 1024,
+                'ratio': total_bytes / backup_path.stat().st_size,
+            }
+        print_table(f"Сжатие бэкапа ({args.files} файлов, {megabytes:.1f} MB исходных данных)", rows)
+
+
+if __name__ == '__main__':
+    main()
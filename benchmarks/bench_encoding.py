@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк определения кодировки: прежнее многократное чтение против однократного
+"""
+
+import tempfile
+from pathlib import Path
+
+from common import make_text, measure, print_table
+
+from main import read_file_text
+
+FILES_PER_ENCODING = 200
+# Небольшие конфиги и крупные файлы (последние читаются через mmap)
+SIZES = [2_000, 20_000, 2_000_000]
+
+
+def legacy_read_file_content(file_path: Path) -> str:
+    """Прежняя реализация: файл заново открывается и читается для каждой кодировки."""
+    for encoding in ['utf-8', 'cp1251', 'latin-1']:
+        try:
+            with open(file_path, 'r', encoding=encoding) as f:
+                return f.read()
+        except UnicodeDecodeError:
+            continue
+    return ''
+
+
+def build_corpus(root: Path, encoding: str, size: int) -> list:
+    count = FILES_PER_ENCODING if size < 1_000_000 else 4
+    paths = []
+    for i in range(count):
+        text = make_text(size, seed=i)
+        data = text.encode(encoding, errors='replace')
+        if encoding == 'latin-1':
+            # Байт 0x98 не декодируется в cp1251 — файл дойдет до третьей попытки
+            data = data.replace(b'?', b'\x98')
+        path = root / f'{encoding}_{size}_{i}.txt'
+        path.write_bytes(data)
+        paths.append(path)
+    return paths
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir)
+        for size in SIZES:
+            rows = {}
+            for encoding in ['utf-8', 'cp1251', 'latin-1']:
+                paths = build_corpus(root, encoding, size)
+                legacy = measure(lambda: [legacy_read_file_content(p) for p in paths])
+                single = measure(lambda: [read_file_text(p) for p in paths])
+                rows[encoding] = {
+                    'files': len(paths),
+                    'legacy, s': legacy,
+                    'single read, s': single,
+                    'speedup': legacy / single,
+                }
+            print_table(f"Чтение файлов размером {size} байт", rows)
+
+
+if __name__ == '__main__':
+    main()
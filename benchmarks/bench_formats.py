@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк форматов бэкапа: скорость записи, разбора и восстановления для YAML и records
+"""
+
+import argparse
+import shutil
+import tempfile
+from pathlib import Path
+
+from common import make_text_tree, measure, print_table
+
+from main import (BACKUP_FORMATS, backup_reader, open_backup, open_backup_output,
+                  restore_backup_stream, scan_directory, write_backup)
+
+
+class SilentBar:
+    """Прогресс-бар без вывода: без него восстановление печатает каждый файл."""
+
+    def update(self, n: int) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000, help='Число файлов в дереве')
+    parser.add_argument('--size', type=int, default=5_000, help='Размер файла в символах')
+    parser.add_argument('--jobs', type=int, default=1, help='Число потоков для записи и восстановления')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        source_path = temp_path / 'source'
+        restore_path = temp_path / 'restore'
+        total_bytes = make_text_tree(source_path, args.files, args.size)
+        skeleton = scan_directory(source_path, read_content=False)
+        megabytes = total_bytes / 1024 / 1024
+
+        rows = {}
+        for backup_format in BACKUP_FORMATS:
+            backup_path = temp_path / f'backup.{backup_format}'
+
+            def create() -> None:
+                with open_backup_output(backup_path) as f:
+                    write_backup(f, source_path, skeleton, jobs=args.jobs, backup_format=backup_format)
+
+            def read() -> None:
+                with open_backup(backup_path) as f:
+                    reader = backup_reader(f)
+                    reader.read_header()
+                    for _ in reader.iter_entries():
+                        pass
+
+            def restore() -> None:
+                shutil.rmtree(restore_path, ignore_errors=True)
+                restore_path.mkdir()
+                with open_backup(backup_path) as f:
+                    reader = backup_reader(f)
+                    reader.read_header()
+                    restore_backup_stream(reader, restore_path, progress_bar=SilentBar(), jobs=args.jobs)
+
+            rows[backup_format] = {
+                'write, MB/s': megabytes / measure(create),
+                'read, MB/s': megabytes / measure(read),
+                'restore, MB/s': megabytes / measure(restore),
+                'size, KB': backup_path.stat().st_size // 1024,
+            }
+        print_table(f"Форматы бэкапа ({args.files} файлов, {megabytes:.1f} MB исходных данных)", rows)
+
+
+if __name__ == '__main__':
+    main()
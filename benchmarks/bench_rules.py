@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк правил отбора: скорость сопоставления путей с шаблонами .gitignore
+и выигрыш от отсечения исключенных поддеревьев при обходе
+"""
+
+import argparse
+import fnmatch
+import random
+import tempfile
+from pathlib import Path
+
+from common import make_flat_tree, measure, print_table
+
+from main import IgnoreRules, ScanRules, scan_directory
+
+# Типичный .gitignore Python/JS проекта с якорями, отрицаниями и '**'
+GITIGNORE = """
+# Byte-compiled
+*.py[cod]
+*$py.class
+*.so
+.Python
+build/
+develop-eggs/
+dist/
+downloads/
+eggs/
+.eggs/
+lib64/
+parts/
+sdist/
+var/
+wheels/
+*.egg-info/
+.installed.cfg
+*.egg
+MANIFEST
+*.manifest
+*.spec
+pip-log.txt
+htmlcov/
+.tox/
+.coverage
+.coverage.*
+.cache
+nosetests.xml
+coverage.xml
+*.cover
+.hypothesis/
+*.mo
+*.pot
+*.log
+!important.log
+local_settings.py
+db.sqlite3
+instance/
+.webassets-cache
+.scrapy
+docs/_build/
+target/
+.ipynb_checkpoints
+.python-version
+celerybeat-schedule
+*.sage.py
+.env
+.venv
+env/
+venv/
+ENV/
+/site
+.mypy_cache/
+node_modules/
+npm-debug.log*
+/coverage
+**/generated/*.json
+fixtures/**/snapshot-*.json
+"""
+
+NAMES = ['main.py', 'utils.py', 'config.json', 'README.md', 'data.log', 'important.log',
+         'module.pyc', 'settings.yml', 'snapshot-1.json', 'schema.json', 'notes.txt', 'setup.cfg']
+DIRS = ['src', 'pkg', 'tests', 'generated', 'fixtures', 'docs', 'api', 'core', 'v1', 'models']
+
+
+def make_paths(count: int, seed: int = 0):
+    """Генерирует относительные пути файлов глубиной 1–6."""
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(count):
+        parts = [rng.choice(DIRS) for _ in range(rng.randint(0, 5))]
+        name = rng.choice(NAMES)
+        paths.append(('/'.join(parts + [name]), name))
+    return paths
+
+
+def naive_match(patterns, rel_path: str, name: str) -> bool:
+    """Построчная проверка через fnmatch, как без предварительной компиляции в блоки."""
+    excluded = False
+    for pattern in patterns:
+        negated = pattern.startswith('!')
+        glob = pattern[1:] if negated else pattern
+        if glob.endswith('/'):
+            continue
+        target = rel_path if '/' in glob else name
+        if fnmatch.fnmatchcase(target, glob.lstrip('/')):
+            excluded = not negated
+    return excluded
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--paths', type=int, default=300_000, help='Число путей для сопоставления')
+    parser.add_argument('--generated', type=int, default=20_000, help='Файлов в исключаемом поддереве')
+    args = parser.parse_args()
+
+    patterns = [line.strip() for line in GITIGNORE.splitlines()
+                if line.strip() and not line.startswith('#')]
+    paths = make_paths(args.paths)
+    rules = ScanRules(excludes=patterns)
+    chain = rules.root_chain + (IgnoreRules(patterns),)
+
+    def compiled() -> None:
+        for rel_path, name in paths:
+            rules.include_file(chain, rel_path, name)
+
+    def naive() -> None:
+        for rel_path, name in paths:
+            name.endswith(('.py', '.md', '.json')) and not naive_match(patterns, rel_path, name)
+
+    rows = {}
+    for label, func in (('скомпилированные правила', compiled), ('fnmatch по шаблонам', naive)):
+        seconds = measure(func, repeat=1)
+        rows[label] = {
+            'seconds': seconds,
+            'ns/path': seconds / len(paths) * 1e9,
+            'paths/s': len(paths) / seconds,
+        }
+    print_table(f"Сопоставление {len(paths)} путей с {len(patterns)} шаблонами", rows)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir)
+        make_flat_tree(root / 'src', 2_000)
+        make_flat_tree(root / 'generated', args.generated)
+        (root / '.backupignore').write_text('generated/\n', encoding='utf-8')
+        # Для сравнения: поддерево обходится целиком, а .json отбрасываются пофайлово
+        file_rules = ScanRules(excludes=['!generated/', 'generated/**/*.json'])
+
+        rows = {}
+        for label, scan_rules in (('без правил', ScanRules(ignore_files=())),
+                                  ('отсечение generated/', ScanRules()),
+                                  ('фильтр файлов generated/**', file_rules)):
+            seconds = measure(lambda: scan_directory(root, read_content=False, rules=scan_rules))
+            files = scan_directory(root, read_content=False, rules=scan_rules)['metadata']['total_files']
+            rows[label] = {'seconds': seconds, 'files': files}
+        print_table(f"Обход дерева ({args.generated} файлов в generated/)", rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк этапов бэкапа на синтетическом дереве: сканирование, сериализация,
+разбор (yaml.safe_load и потоковый) и восстановление
+"""
+
+import argparse
+import itertools
+import json
+import tempfile
+from pathlib import Path
+
+import yaml
+
+from common import SIZE_DISTRIBUTIONS, make_synthetic_tree, measure, print_table
+
+from main import (YAML_LOADER, backup_reader, create_directory_structure, open_backup,
+                  restore_backup_stream, scan_directory, write_backup)
+
+
+class SilentBar:
+    """Прогресс-бар без вывода: без него восстановление печатает каждый файл."""
+
+    def update(self, n: int) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000, help='Число файлов')
+    parser.add_argument('--depth', type=int, default=3, help='Глубина дерева директорий')
+    parser.add_argument('--fanout', type=int, default=4, help='Поддиректорий на директорию')
+    parser.add_argument('--size', type=int, default=4000, help='Средний размер файла в символах')
+    parser.add_argument('--distribution', choices=SIZE_DISTRIBUTIONS, default='lognormal',
+                        help='Распределение размеров файлов')
+    parser.add_argument('--encodings', default='utf-8:0.8,cp1251:0.15,latin-1:0.05',
+                        help='Смесь кодировок с весами')
+    parser.add_argument('--jobs', type=int, default=1, help='Число потоков для чтения и записи')
+    parser.add_argument('--repeat', type=int, default=3, help='Запусков на этап (берется лучший)')
+    parser.add_argument('--json', action='store_true', help='Вывести результаты в JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        source_path = temp_path / 'source'
+        shape = make_synthetic_tree(source_path, args.files, args.depth, args.fanout, args.size,
+                                    args.distribution, args.encodings)
+        skeleton = scan_directory(source_path, read_content=False)
+        runs = itertools.count()
+        loaded = {}
+
+        def serialize(backup_format: str):
+            def run() -> None:
+                with open(temp_path / f'backup.{backup_format}', 'wb') as f:
+                    write_backup(f, source_path, skeleton, jobs=args.jobs, backup_format=backup_format)
+            return run
+
+        def safe_load() -> None:
+            with open(temp_path / 'backup.yaml', 'rb') as f:
+                loaded['backup'] = yaml.load(f, Loader=YAML_LOADER)
+
+        def stream_parse(backup_format: str):
+            def run() -> None:
+                with open_backup(temp_path / f'backup.{backup_format}') as f:
+                    reader = backup_reader(f)
+                    reader.read_header()
+                    for _ in reader.iter_entries():
+                        pass
+            return run
+
+        def create_structure() -> None:
+            create_directory_structure(temp_path / f'restore{next(runs)}', loaded['backup']['structure'],
+                                       SilentBar(), jobs=args.jobs)
+
+        def stream_restore(backup_format: str):
+            def run() -> None:
+                with open_backup(temp_path / f'backup.{backup_format}') as f:
+                    reader = backup_reader(f)
+                    reader.read_header()
+                    restore_backup_stream(reader, temp_path / f'restore{next(runs)}', SilentBar(),
+                                          jobs=args.jobs)
+            return run
+
+        # Этапы идут по порядку: каждый следующий использует результат предыдущих
+        stages = [
+            ('scan_directory (скелет)', lambda: scan_directory(source_path, read_content=False)),
+            ('scan_directory (содержимое)', lambda: scan_directory(source_path, jobs=args.jobs)),
+            ('serialize yaml', serialize('yaml')),
+            ('serialize records', serialize('records')),
+            ('yaml.safe_load', safe_load),
+            ('stream parse yaml', stream_parse('yaml')),
+            ('stream parse records', stream_parse('records')),
+            ('create_directory_structure', create_structure),
+            ('restore stream yaml', stream_restore('yaml')),
+            ('restore stream records', stream_restore('records')),
+        ]
+        megabytes = shape['bytes'] / 1024 / 1024
+        rows = {}
+        for name, func in stages:
+            seconds = measure(func, args.repeat)
+            rows[name] = {
+                'seconds': seconds,
+                'MB/s': megabytes / seconds,
+                'files/s': shape['files'] / seconds,
+            }
+
+    if args.json:
+        print(json.dumps({'tree': shape, 'jobs': args.jobs, 'stages': rows}, ensure_ascii=False, indent=2))
+    else:
+        print_table(f"Этапы бэкапа ({shape['files']} файлов, {shape['directories']} директорий, "
+                    f"{megabytes:.1f} MB)", rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк verify/diff: сравнение дерева с манифестом бэкапа по stat-данным
+и с хешированием файлов, у которых изменился только mtime
+"""
+
+import argparse
+import os
+import tempfile
+from pathlib import Path
+
+from common import make_flat_tree, make_text_tree, measure, print_table
+
+from main import ScanRules, StageStats, compare_tree, save_backup, scan_project
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100_000, help='Файлов в дереве (пустых)')
+    parser.add_argument('--text-files', type=int, default=2_000, help='Текстовых файлов с содержимым')
+    parser.add_argument('--jobs', type=int, default=4, help='Потоков для хеширования')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        root = temp_path / 'source'
+        make_flat_tree(root / 'flat', args.files)
+        make_text_tree(root / 'text', args.text_files, 4000)
+        backup_path = temp_path / 'backup.rec'
+        structure = scan_project(root, backup_path, ScanRules(), StageStats())
+        save_backup(backup_path, root, structure, backup_format='records')
+        files = structure['metadata']['total_files']
+        roots = [(root, '')]
+
+        def run(checksum: bool, jobs: int = 1):
+            return lambda: compare_tree(backup_path, roots, checksum=checksum, jobs=jobs)
+
+        rows = {}
+        rows['без изменений'] = {'seconds': measure(run(False))}
+        # mtime меняется у всех текстовых файлов, как после restore без --preserve-mtime
+        for file_path in (root / 'text').rglob('*.py'):
+            os.utime(file_path, (1, 1))
+        rows['mtime, без хеша'] = {'seconds': measure(run(False))}
+        rows['mtime, хеш'] = {'seconds': measure(run(True))}
+        rows[f'mtime, хеш ({args.jobs} потока)'] = {'seconds': measure(run(True, args.jobs))}
+        for row in rows.values():
+            row['files/s'] = files / row['seconds']
+        print_table(f"Сравнение дерева с манифестом ({files} файлов)", rows)
+
+
+if __name__ == '__main__':
+    main()
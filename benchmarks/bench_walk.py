@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк обхода дерева: Path.iterdir + повторные stat() против os.scandir
+"""
+
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Any, Dict
+
+from common import make_flat_tree, measure, print_table
+
+from main import should_include_file, should_skip_directory, scan_directory
+
+
+def legacy_walk(root_path: Path) -> Dict[str, Any]:
+    """Прежний рекурсивный обход: is_file/is_dir и два stat() на каждый файл."""
+    structure: Dict[str, Any] = {}
+
+    def scan_recursive(current_path: Path, current_structure: Dict[str, Any]) -> None:
+        for item in current_path.iterdir():
+            if item.is_file() and should_include_file(item):
+                current_structure[item.name] = {
+                    'type': 'file',
+                    'size': item.stat().st_size,
+                    'modified': item.stat().st_mtime
+                }
+            elif item.is_dir():
+                if should_skip_directory(item.name):
+                    continue
+                current_structure[item.name] = {}
+                scan_recursive(item, current_structure[item.name])
+
+    scan_recursive(root_path, structure)
+    return structure
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=100_000, help='Число файлов в дереве')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir)
+        make_flat_tree(root, args.entries)
+        per_100k = 100_000 / args.entries
+
+        legacy = measure(lambda: legacy_walk(root))
+        scandir = measure(lambda: scan_directory(root, read_content=False))
+        print_table(f"Обход дерева из {args.entries} файлов (время на 100k записей)", {
+            'Path.iterdir + stat()': {'s / 100k': legacy * per_100k},
+            'os.scandir, итеративно': {'s / 100k': scandir * per_100k},
+        })
+        print(f"Ускорение: {legacy / scandir:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк watch: запись снимка по индексу в памяти в сравнении с
+create --incremental, который каждый раз пересканирует дерево
+"""
+
+import argparse
+import tempfile
+from pathlib import Path
+
+from common import make_flat_tree, make_text_tree, measure, print_table
+
+from main import (PollingWatcher, ScanRules, StageStats, TreeIndex, WatchSession, make_incremental, save_backup,
+                  scan_project)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100_000, help='Файлов в дереве (пустых)')
+    parser.add_argument('--text-files', type=int, default=2_000, help='Текстовых файлов с содержимым')
+    parser.add_argument('--changes', type=int, default=10, help='Измененных файлов между снимками')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        root = temp_path / 'source'
+        make_flat_tree(root / 'flat', args.files)
+        make_text_tree(root / 'text', args.text_files, 4000)
+        rules = ScanRules()
+        full_path = temp_path / 'full.rec'
+        structure = scan_project(root, full_path, rules, StageStats())
+        result = save_backup(full_path, root, structure, backup_format='records')
+        files = structure['metadata']['total_files']
+        changed = sorted((root / 'text').rglob('*.py'))[:args.changes]
+        counter = [0]
+
+        def touch() -> None:
+            counter[0] += 1
+            for path in changed:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(f'# {counter[0]}\n')
+
+        def incremental() -> None:
+            touch()
+            output_path = temp_path / 'inc.rec'
+            project = scan_project(root, output_path, rules, StageStats())
+            project, sections, unchanged = make_incremental(project, root, full_path, output_path)
+            save_backup(output_path, root, project, sections=sections, backup_format='records',
+                        unchanged=unchanged)
+
+        index = TreeIndex(root, rules, structure['structure'], result['manifest'])
+        session = WatchSession(index, PollingWatcher(3600), full_path, dict(structure['metadata']), 0, 3600,
+                               {'backup_format': 'records'}, StageStats())
+
+        def flush() -> None:
+            touch()
+            # Как от inotify: по событию на каждый измененный файл
+            index.mark((path.parent.relative_to(root).as_posix(), path.name) for path in changed)
+            session.flush()
+
+        rows = {
+            'create --incremental': {'seconds': measure(incremental)},
+            'watch: снимок': {'seconds': measure(flush)},
+        }
+        for row in rows.values():
+            row['changes/s'] = args.changes / row['seconds']
+        print_table(f"Инкремент из {args.changes} изменений в дереве из {files} файлов", rows)
+        print(f"Индекс в памяти: {index.memory() / 1024 / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
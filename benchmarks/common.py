@@ -0,0 +1,133 @@
+"""
+Общие помощники для бенчмарков simple-backup
+"""
+
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+# Импортируем main.py из корня репозитория
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# Текст, который представим во всех кодировках корпуса
+SAMPLE_WORDS = ['backup', 'restore', 'файл', 'директория', 'проект', 'настройка', 'value', 'config']
+
+
+def make_text(size: int, seed: int = 0) -> str:
+    """Генерирует текст примерно из size символов с кириллицей и латиницей."""
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(SAMPLE_WORDS)
+        words.append(word)
+        length += len(word) + 1
+        if rng.random() < 0.1:
+            words.append('\n')
+    return ' '.join(words)[:size]
+
+
+def measure(func: Callable[[], Any], repeat: int = 3) -> float:
+    """Возвращает лучшее время выполнения func за repeat запусков, в секундах."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def print_table(title: str, rows: Dict[str, Dict[str, Any]]) -> None:
+    """Печатает результаты бенчмарка простой таблицей."""
+    print(f"\n{title}")
+    print("=" * len(title))
+    columns = list(next(iter(rows.values())).keys())
+    print(f"{'':<28}" + ''.join(f"{column:>16}" for column in columns))
+    for name, values in rows.items():
+        cells = ''.join(f"{value:>16.4f}" if isinstance(value, float) else f"{value:>16}"
+                        for value in values.values())
+        print(f"{name:<28}{cells}")
+
+
+def make_flat_tree(root: Path, entries: int, files_per_dir: int = 50) -> None:
+    """Создает дерево из entries пустых файлов по files_per_dir в директории.
+
+    Часть файлов получает расширения, не попадающие в бэкап, чтобы обходчик
+    тратил время и на отбрасываемые записи.
+    """
+    extensions = ['.py', '.md', '.json', '.bin', '.png']
+    directory = root
+    for i in range(entries):
+        if i % files_per_dir == 0:
+            directory = root / f'dir{i // files_per_dir // 100}' / f'sub{i // files_per_dir}'
+            directory.mkdir(parents=True, exist_ok=True)
+        (directory / f'file{i}{extensions[i % len(extensions)]}').touch()
+
+
+def make_text_tree(root: Path, files: int, size: int, files_per_dir: int = 20) -> int:
+    """Создает дерево текстовых .py файлов примерно по size символов; возвращает объем в байтах."""
+    total = 0
+    for i in range(files):
+        directory = root / f'pkg{i // files_per_dir}'
+        directory.mkdir(parents=True, exist_ok=True)
+        data = make_text(size, seed=i).encode('utf-8')
+        (directory / f'module{i}.py').write_bytes(data)
+        total += len(data)
+    return total
+
+
+# Распределения размеров файлов для make_synthetic_tree
+SIZE_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+
+def parse_mix(spec: str) -> List[Tuple[str, float]]:
+    """Разбирает смесь вида 'utf-8:0.8,cp1251:0.2' в список (значение, вес)."""
+    mix = []
+    for part in spec.split(','):
+        name, _, weight = part.partition(':')
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def make_synthetic_tree(root: Path, files: int, depth: int = 3, fanout: int = 4,
+                        mean_size: int = 4000, distribution: str = 'lognormal',
+                        encodings: str = 'utf-8', seed: int = 0) -> Dict[str, int]:
+    """Создает синтетическое дерево заданной формы.
+
+    Файлы раскладываются по директориям глубиной до depth и ветвлением fanout;
+    размер выбирается по distribution со средним mean_size символов, а
+    кодировка — по весам из encodings ('utf-8:0.8,cp1251:0.15,latin-1:0.05').
+    Возвращает число файлов, директорий и объем в байтах.
+    """
+    rng = random.Random(seed)
+    mix = parse_mix(encodings)
+    names, weights = [name for name, _ in mix], [weight for _, weight in mix]
+
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [parent / f'd{i}' for parent in level for i in range(fanout)]
+        directories.extend(level)
+    for directory in directories:
+        directory.mkdir(parents=True, exist_ok=True)
+
+    total = 0
+    for i in range(files):
+        if distribution == 'fixed':
+            size = mean_size
+        elif distribution == 'uniform':
+            size = rng.randint(0, 2 * mean_size)
+        else:
+            # Медиана ниже среднего: много мелких файлов и редкие крупные
+            size = int(rng.lognormvariate(0, 1) * mean_size / 1.6487)
+        encoding = rng.choices(names, weights)[0]
+        text = make_text(size, seed=i)
+        if encoding == 'latin-1':
+            # В latin-1 нет кириллицы — оставляем западноевропейский текст
+            text = text.encode('ascii', 'ignore').decode('ascii').replace('e', 'é')
+        data = text.encode(encoding)
+        (rng.choice(directories) / f'file{i}.py').write_bytes(data)
+        total += len(data)
+    return {'files': files, 'directories': len(directories) - 1, 'bytes': total}
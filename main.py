@@ -5,272 +5,4248 @@ Simple Backup - Простой инструмент для создания и 
 
 import click
 import yaml
-from pathlib import Path
-from typing import Dict, Any
+from pathlib import Path, PurePosixPath
+from typing import TYPE_CHECKING, Dict, Any, BinaryIO, Callable, Collection, Deque, Iterable, Iterator, List, Optional, Protocol, Set, Tuple, Union
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, redirect_stdout
+import base64
+import bz2
+import codecs
+import ctypes
+import ctypes.util
+import errno
+import functools
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
+import os
+import re
+import select
 import shutil
+import stat
+import struct
+import sys
+import threading
+import time
+
+
+# Кодировки перебираются по порядку; latin-1 декодирует любые байты
+ENCODINGS = ('utf-8', 'cp1251', 'latin-1')
+# «Кодировка» двоичных файлов: содержимое хранится байтами (в YAML — !!binary)
+BINARY_ENCODING = 'binary'
+# Файл двоичный, если в его начале есть нулевой байт (как в git)
+BINARY_SNIFF_SIZE = 8192
+# Файлы от этого размера читаются через mmap
+MMAP_THRESHOLD = 1024 * 1024
+# Файлы больше этого размера читаются, пишутся в бэкап и восстанавливаются фрагментами
+CHUNK_SIZE = 8 * 1024 * 1024
+# Шард с файлами из корня проекта; директории верхнего уровня образуют свои шарды
+ROOT_SHARD = '.'
+# Что делать с файлами больше --max-file-size
+OVERSIZE_POLICIES = ('skip', 'warn', 'truncate')
+
+MANIFEST_FORMAT = 'simple-backup-manifest'
+INDEX_FORMAT = 'simple-backup-index'
+
+# Форматы бэкапа: YAML (по умолчанию) и плоские записи с сырыми байтами файлов
+BACKUP_FORMATS = ('yaml', 'records')
+RECORDS_MAGIC = b'SIMPLE-BACKUP-RECORDS 1\n'
+
+# Сжатие выбирается по суффиксу файла бэкапа, а при чтении — по магическим байтам
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.lzma': 'xz'}
+COMPRESSION_MAGIC = {'gzip': b'\x1f\x8b', 'bz2': b'BZh', 'xz': b'\xfd7zXZ\x00'}
+COMPRESSION_DEFAULT_LEVELS = {'gzip': 6, 'bz2': 9, 'xz': 6}
+# Поток бэкапа, открытый на чтение: обычный файл или распаковывающая обертка
+BackupStream = Union[io.BufferedReader, gzip.GzipFile, bz2.BZ2File, lzma.LZMAFile]
+# Сжимающие потоки медленны на мелких записях, поэтому вывод буферизуется
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Ошибки чтения, при которых файл, удаленный или закрытый после сканирования, пропускается
+READ_ERRORS = (PermissionError, FileNotFoundError, IsADirectoryError)
+
+# Каждый сотый снимок watch пишет полный манифест, чтобы цепочка разностных оставалась короткой
+WATCH_MANIFEST_INTERVAL = 100
+
+# События inotify, на которые подписывается watch (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                | IN_ONLYDIR)
+# struct inotify_event без имени: wd, mask, cookie, len
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# libyaml заметно быстрее чистого Python, но доступен не во всех сборках PyYAML.
+# Для проверки типов берутся классы на Python с тем же интерфейсом
+if TYPE_CHECKING:
+    YAML_DUMPER = yaml.SafeDumper
+    YAML_LOADER = yaml.SafeLoader
+else:
+    YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class BackupDumper(YAML_DUMPER):
+    """Dumper бэкапа: байты пишутся как !!binary одной строкой base64.
+
+    Стандартный представитель переносит base64 каждые 76 символов, и в
+    глубоко вложенной записи отступы строк добавляют к объему еще ~10%.
+    """
+
+
+BackupDumper.add_representer(bytes, lambda dumper, data: dumper.represent_scalar(
+    'tag:yaml.org,2002:binary', base64.b64encode(data).decode('ascii')))
+
+# Ширина строки, при которой строковый скаляр не переносится (предел int для libyaml)
+UNWRAPPED_WIDTH = 2 ** 31 - 1
+
+
+SKIP_DIRECTORIES = frozenset({
+    '.venv', '__pycache__', '.git', 'node_modules',
+    '.pytest_cache', '.mypy_cache', 'build', 'dist'
+})
+INCLUDE_EXTENSIONS = frozenset({'.py', '.md', '.yml', '.yaml', '.txt', '.json', '.toml', '.cfg', '.ini'})
+
+# Файлы с шаблонами исключений; читаются в каждой директории при обходе
+IGNORE_FILES = ('.gitignore', '.backupignore')
+# Встроенные правила в синтаксисе .gitignore: скрытые и служебные директории
+DEFAULT_IGNORE_PATTERNS = ('.*/',) + tuple(f'{name}/' for name in sorted(SKIP_DIRECTORIES))
 
 
 def should_skip_directory(dir_name: str) -> bool:
     """Проверяет, нужно ли пропустить директорию."""
-    skip_dirs = {
-        '.venv', '__pycache__', '.git', 'node_modules', 
-        '.pytest_cache', '.mypy_cache', 'build', 'dist'
+    return dir_name in SKIP_DIRECTORIES or dir_name.startswith('.')
+
+
+def should_include_name(file_name: str) -> bool:
+    """Проверяет по имени файла, нужно ли включить его в бэкап (без создания Path)."""
+    return os.path.splitext(file_name)[1].lower() in INCLUDE_EXTENSIONS
+
+
+def should_include_file(file_path: Path) -> bool:
+    """Проверяет, нужно ли включить файл в бэкап."""
+    return should_include_name(file_path.name)
+
+
+def glob_to_regex(pattern: str) -> str:
+    """Переводит glob из .gitignore в регулярное выражение.
+
+    '*' и '?' не пересекают '/', '**/' соответствует любому числу директорий,
+    а '**' в конце — всему содержимому.
+    """
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            body = pattern[i + 1:end].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            parts.append(f'[{body}]')
+            i = end + 1
+            continue
+        elif char == '\\' and i + 1 < n:
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return ''.join(parts)
+
+
+class GlobSet:
+    """Набор glob-шаблонов, скомпилированный для быстрой проверки.
+
+    Шаблоны без '/' сверяются с именем: литералы — поиском в множестве, '*.ext' —
+    через str.endswith, остальные — одним общим регулярным выражением. Шаблоны
+    с '/' сверяются с путем относительно базовой директории.
+    """
+
+    __slots__ = ('names', 'suffixes', 'name_regex', 'path_regex')
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        names = set()
+        suffixes = []
+        name_parts = []
+        path_parts = []
+        for pattern in patterns:
+            if '/' in pattern:
+                path_parts.append(glob_to_regex(pattern.lstrip('/')))
+            elif not any(char in pattern for char in '*?[\\'):
+                names.add(pattern)
+            elif pattern.startswith('*') and not any(char in pattern[1:] for char in '*?[\\'):
+                suffixes.append(pattern[1:])
+            else:
+                name_parts.append(glob_to_regex(pattern))
+        self.names = frozenset(names)
+        self.suffixes = tuple(suffixes)
+        self.name_regex = re.compile('(?:%s)\\Z' % '|'.join(name_parts)) if name_parts else None
+        self.path_regex = re.compile('(?:%s)\\Z' % '|'.join(path_parts)) if path_parts else None
+
+    def __bool__(self) -> bool:
+        return bool(self.names or self.suffixes or self.name_regex or self.path_regex)
+
+    def match(self, rel_path: str, name: str) -> bool:
+        """Проверяет путь (относительно базы) и его последний компонент name."""
+        return (name in self.names
+                or (bool(self.suffixes) and name.endswith(self.suffixes))
+                or (self.name_regex is not None and self.name_regex.match(name) is not None)
+                or (self.path_regex is not None and self.path_regex.match(rel_path) is not None))
+
+
+class IgnoreRules:
+    """Шаблоны в синтаксисе .gitignore для одной базовой директории.
+
+    Поддерживаются комментарии, отрицание '!', привязка к базе через '/',
+    шаблоны только для директорий ('dir/') и '**'. Подряд идущие шаблоны одного
+    знака компилируются в общий блок; блоки проверяются с конца, так что, как и
+    в git, побеждает последнее совпавшее правило.
+    """
+
+    def __init__(self, lines: Iterable[str], base: str = ''):
+        self.base = base
+        # [отрицание, шаблоны для всех путей, шаблоны только для директорий]
+        groups: List[Tuple[bool, List[str], List[str]]] = []
+        for line in lines:
+            line = line.rstrip('\r\n').rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            elif line.startswith(('\\!', '\\#')):
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            if not groups or groups[-1][0] != negated:
+                groups.append((negated, [], []))
+            _, any_kind, dirs_only = groups[-1]
+            (dirs_only if dir_only else any_kind).append(line)
+        # (отрицание, набор для файлов, набор для директорий), от последнего блока к первому
+        self.blocks = [(negated, GlobSet(any_kind), GlobSet(any_kind + dirs_only))
+                       for negated, any_kind, dirs_only in reversed(groups)]
+        self.has_file_rules = any(files for _, files, _ in self.blocks)
+
+    @classmethod
+    def from_file(cls, path: Path, base: str = '') -> 'IgnoreRules':
+        """Читает правила из файла .gitignore или .backupignore."""
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return cls(f, base)
+
+    def match(self, rel_path: str, name: str, is_dir: bool) -> Optional[bool]:
+        """True — путь исключен, False — возвращен отрицанием, None — правила о нем молчат."""
+        if not is_dir and not self.has_file_rules:
+            return None
+        rel_path = rel_path[len(self.base):]
+        for negated, files, dirs in self.blocks:
+            if (dirs if is_dir else files).match(rel_path, name):
+                return not negated
+        return None
+
+
+class ScanRules:
+    """Правила отбора файлов при сканировании.
+
+    Файл попадает в бэкап, если его расширение есть в INCLUDE_EXTENSIONS или он
+    подходит под шаблон из includes, и при этом не исключен. Исключения
+    применяются по старшинству: встроенные DEFAULT_IGNORE_PATTERNS, файлы
+    ignore_files от корня вглубь (.backupignore сильнее .gitignore той же
+    директории), затем excludes из командной строки. Исключенная директория не
+    читается вовсе, поэтому правила вида 'generated/' отсекают целые поддеревья.
+
+    С all_files расширение не проверяется: в бэкап попадает любой не
+    исключенный файл, а двоичные сохраняются байтами.
+
+    Файлы больше max_file_size байт по политике oversize пропускаются ('skip',
+    'warn') или обрезаются до max_file_size байт ('truncate'); сканирование
+    складывает их (путь, размер) в oversized.
+
+    as_dict возвращает аргументы конструктора простыми значениями: они пишутся
+    в metadata.rules бэкапа, чтобы diff и verify отбирали файлы так же, как create.
+    """
+
+    def __init__(self, includes: Iterable[str] = (), excludes: Iterable[str] = (),
+                 ignore_files: Iterable[str] = IGNORE_FILES,
+                 max_file_size: Optional[int] = None, oversize: str = 'warn', all_files: bool = False):
+        if oversize not in OVERSIZE_POLICIES:
+            raise ValueError(f"Неизвестная политика для больших файлов: {oversize}")
+        self.all_files = all_files
+        self.max_file_size = max_file_size
+        self.oversize = oversize
+        self.oversized: List[Tuple[str, int]] = []
+        self.include_patterns = list(includes)
+        self.includes = GlobSet(self.include_patterns)
+        enabled = set(ignore_files)
+        self.ignore_files = tuple(name for name in IGNORE_FILES if name in enabled)
+        self.exclude_patterns = list(excludes)
+        self.cli_rules = IgnoreRules(self.exclude_patterns) if self.exclude_patterns else None
+        self.root_chain: Tuple[IgnoreRules, ...] = (IgnoreRules(DEFAULT_IGNORE_PATTERNS),)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Аргументы конструктора, из которых правила можно воссоздать: ScanRules(**rules.as_dict())."""
+        return {'includes': self.include_patterns, 'excludes': self.exclude_patterns,
+                'ignore_files': list(self.ignore_files), 'max_file_size': self.max_file_size,
+                'oversize': self.oversize, 'all_files': self.all_files}
+
+    def extend_chain(self, chain: Tuple[IgnoreRules, ...], dir_path: str, rel_prefix: str,
+                     names: Iterable[str]) -> Tuple[IgnoreRules, ...]:
+        """Добавляет к цепочке правила из файлов игнорирования, найденных в директории."""
+        present = set(names)
+        for file_name in self.ignore_files:
+            if file_name in present:
+                try:
+                    chain += (IgnoreRules.from_file(Path(dir_path) / file_name, rel_prefix),)
+                except OSError:
+                    continue
+        return chain
+
+    def is_excluded(self, chain: Tuple[IgnoreRules, ...], rel_path: str, name: str, is_dir: bool) -> bool:
+        """Проверяет путь по всем правилам, от самых сильных к встроенным."""
+        if self.cli_rules is not None:
+            result = self.cli_rules.match(rel_path, name, is_dir)
+            if result is not None:
+                return result
+        for rules in reversed(chain):
+            result = rules.match(rel_path, name, is_dir)
+            if result is not None:
+                return result
+        return False
+
+    def include_file(self, chain: Tuple[IgnoreRules, ...], rel_path: str, name: str) -> bool:
+        """Нужно ли включить файл в бэкап."""
+        if not (self.all_files or should_include_name(name) or self.includes.match(rel_path, name)):
+            return False
+        return not self.is_excluded(chain, rel_path, name, False)
+
+
+def is_binary(data: Any) -> bool:
+    """Проверяет по первым BINARY_SNIFF_SIZE байтам, что содержимое двоичное."""
+    return b'\0' in data[:BINARY_SNIFF_SIZE]
+
+
+def decode_content(data: Any, file_path: Path) -> Tuple[Any, Optional[str]]:
+    """Декодирует байты первой подходящей кодировкой из ENCODINGS.
+
+    Двоичное содержимое не декодируется и возвращается байтами с BINARY_ENCODING.
+    """
+    if is_binary(data):
+        return bytes(data), BINARY_ENCODING
+    for encoding in ENCODINGS:
+        try:
+            return str(data, encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    
+    return f"<ОШИБКА: Не удалось прочитать файл {file_path}>", None
+
+
+def detect_encoding(data: bytes) -> Optional[str]:
+    """Подбирает кодировку из ENCODINGS, не сохраняя декодированный текст."""
+    if is_binary(data):
+        return BINARY_ENCODING
+    if data.isascii():
+        return ENCODINGS[0]
+    for encoding in ENCODINGS:
+        try:
+            str(data, encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def content_hash(data: Any) -> str:
+    """Быстрый хеш содержимого файла (BLAKE2b, 128 бит)."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class EncodingDetector:
+    """Подбирает кодировку по фрагментам содержимого так же, как detect_encoding по всему.
+
+    Кандидаты из ENCODINGS декодируют фрагменты инкрементальными декодерами, а
+    не справившиеся отбрасываются, поэтому файл читается один раз. Текст не
+    сохраняется.
+    """
+
+    def __init__(self) -> None:
+        self._decoders = [(encoding, codecs.getincrementaldecoder(encoding)()) for encoding in ENCODINGS]
+        self._sniffed = 0
+        self._binary = False
+
+    def update(self, chunk: bytes) -> None:
+        """Учитывает очередной фрагмент."""
+        if self._sniffed < BINARY_SNIFF_SIZE:
+            self._binary = self._binary or is_binary(chunk[:BINARY_SNIFF_SIZE - self._sniffed])
+            self._sniffed += len(chunk)
+        if self._binary:
+            return
+        ascii_only = chunk.isascii()
+        alive = []
+        for encoding, decoder in self._decoders:
+            try:
+                # ASCII декодируется любым кандидатом, если у него нет незавершенного символа
+                if not ascii_only or decoder.getstate()[0]:
+                    decoder.decode(chunk)
+            except UnicodeDecodeError:
+                continue
+            alive.append((encoding, decoder))
+        self._decoders = alive
+
+    def result(self) -> Optional[str]:
+        """Кодировка всех учтенных фрагментов; None, если не подошла ни одна."""
+        if self._binary:
+            return BINARY_ENCODING
+        for encoding, decoder in self._decoders:
+            try:
+                decoder.decode(b'', final=True)
+                return encoding
+            except UnicodeDecodeError:
+                continue
+        return None
+
+
+class FileChunks:
+    """Содержимое большого файла, которое читается фрагментами по CHUNK_SIZE байт.
+
+    Файл открывается сразу (ошибки доступа видны тому, кто создает объект, — до
+    записи первого фрагмента), а читается при единственном переборе, поэтому в
+    памяти находится один фрагмент. По мере чтения считается content_hash
+    прочитанных байтов (hexdigest после перебора), а с detect — и кодировка
+    (encoding после перебора). limit ограничивает чтение первыми limit байтами.
+    """
+
+    def __init__(self, file_path: Path, limit: Optional[int] = None, detect: bool = False):
+        self.file_path = file_path
+        self.limit = limit
+        self.encoding: Optional[str] = None
+        self._file = open(file_path, 'rb')
+        self._digest = hashlib.blake2b(digest_size=16)
+        self._detector = EncodingDetector() if detect else None
+
+    def __iter__(self) -> Iterator[bytes]:
+        remaining = self.limit
+        with self._file as f:
+            while remaining is None or remaining > 0:
+                chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                self._digest.update(chunk)
+                if self._detector is not None:
+                    self._detector.update(chunk)
+                yield chunk
+        if self._detector is not None:
+            self.encoding = self._detector.result()
+
+    def hexdigest(self) -> str:
+        """Хеш байтов, прочитанных при переборе."""
+        return self._digest.hexdigest()
+
+
+def hash_file(file_path: Path, limit: Optional[int] = None) -> str:
+    """Считает content_hash файла (или первых limit байт), читая его блоками, без декодирования."""
+    chunks = FileChunks(file_path, limit)
+    for _ in chunks:
+        pass
+    return chunks.hexdigest()
+
+
+def detect_file_encoding(file_path: Path, limit: Optional[int] = None) -> Optional[str]:
+    """Подбирает кодировку большого файла за один проход по фрагментам без сохранения текста."""
+    with open(file_path, 'rb') as f:
+        if is_binary(f.read(BINARY_SNIFF_SIZE)):
+            return BINARY_ENCODING
+    chunks = FileChunks(file_path, limit, detect=True)
+    for _ in chunks:
+        pass
+    return chunks.encoding
+
+
+def read_file_data(file_path: Path, with_hash: bool = False, raw: bool = False,
+                   limit: Optional[int] = None, chunked: bool = False) -> Dict[str, Any]:
+    """Читает файл один раз и подбирает кодировку по уже прочитанным байтам.
+
+    Возвращает словарь с ключами content и encoding, а при with_hash — еще и hash
+    тех же байтов. Большие файлы отображаются в память через mmap, чтобы не
+    держать лишнюю копию байтов рядом со строкой. При raw вместо content
+    возвращаются сами байты (ключ data) — для формата records. limit — сколько
+    первых байт читать (для обрезанных файлов). Двоичный файл (см. is_binary)
+    получает BINARY_ENCODING, а его content — байты вместо строки.
+
+    С chunked файл больше CHUNK_SIZE целиком не читается: вместо content
+    возвращается FileChunks (ключ chunks), а хеш берется у него после перебора.
+    YAML пишет фрагменты текстом, поэтому кодировка подбирается заранее
+    отдельным проходом; при raw файл не декодируется, и кодировка подбирается
+    по ходу записи (ключа encoding нет, см. chunks_encoding).
+    """
+    if chunked:
+        size = os.stat(file_path).st_size
+        if size > CHUNK_SIZE and (limit is None or limit > CHUNK_SIZE):
+            if raw:
+                return {'chunks': FileChunks(file_path, limit, detect=True)}
+            return {'chunks': FileChunks(file_path, limit), 'encoding': detect_file_encoding(file_path, limit)}
+    
+    if raw:
+        with open(file_path, 'rb') as f:
+            data = f.read() if limit is None else f.read(limit)
+        result = {'data': data, 'encoding': detect_encoding(data)}
+        if with_hash:
+            result['hash'] = content_hash(data)
+        return result
+    
+    def from_bytes(data: Any) -> Dict[str, Any]:
+        content, encoding = decode_content(data, file_path)
+        result = {'content': content, 'encoding': encoding}
+        if with_hash:
+            result['hash'] = content_hash(data)
+        return result
+    
+    with open(file_path, 'rb') as f:
+        if limit is not None:
+            return from_bytes(f.read(limit))
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return from_bytes(mapped)
+        return from_bytes(f.read())
+
+
+def read_file_text(file_path: Path, limit: Optional[int] = None) -> Tuple[Any, Optional[str]]:
+    """Читает файл (или первые limit байт) и возвращает (содержимое, кодировка).
+
+    Содержимое двоичного файла — байты.
+    """
+    data = read_file_data(file_path, limit=limit)
+    return data['content'], data['encoding']
+
+
+def read_file_content(file_path: Path) -> str:
+    """Читает содержимое файла с обработкой ошибок кодировки."""
+    content: str = read_file_text(file_path)[0]
+    return content
+
+
+def scan_directory_optimized(root_path: Path, read_content: bool = True, jobs: int = 1,
+                             rules: Optional[ScanRules] = None,
+                             top_level: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """Оптимизированное сканирование директории с пропуском исключаемых папок.
+
+    При read_content=False содержимое файлов не читается: получается «скелет»
+    структуры, который потоковая запись дополняет содержимым по одному файлу.
+    При jobs > 1 обход директорий идет в текущем потоке, а чтение и декодирование
+    файлов — в пуле потоков; порядок ключей в structure при этом не меняется.
+    rules — правила отбора (по умолчанию встроенные и .gitignore/.backupignore);
+    файлы больше rules.max_file_size пропускаются или помечаются truncated.
+    top_level — имена в корне, которыми ограничен обход (шард одного корня).
+    """
+    project_structure = {
+        'metadata': {
+            'root_path': str(root_path.absolute()),
+            'backup_date': str(Path().cwd()),
+            'total_files': 0,
+            'total_directories': 0
+        },
+        'structure': {}
     }
-    return dir_name in skip_dirs or dir_name.startswith('.')
+    
+    files_count = 0
+    dirs_count = 0
+    executor = ThreadPoolExecutor(max_workers=jobs) if read_content and jobs > 1 else None
+    # (структура, имя, будущее содержимое) — заполняются после обхода
+    pending: List[Tuple[Dict[str, Any], str, 'Future[Tuple[str, Optional[str]]]']] = []
+    
+    if rules is None:
+        rules = ScanRules()
+    rules.oversized.clear()
+    only = None if top_level is None else frozenset(top_level)
+    
+    # Обход итеративный, поэтому глубина дерева не ограничена лимитом рекурсии.
+    # DirEntry кэширует тип и stat, так что на включаемый файл приходится один stat.
+    # Каждая директория несет (путь, структура, относительный префикс, цепочка правил).
+    stack: List[Tuple[str, Dict[str, Any], str, Tuple[IgnoreRules, ...]]] = [
+        (str(root_path), project_structure['structure'], '', rules.root_chain)
+    ]
+    
+    try:
+        while stack:
+            current_dir, current_structure, prefix, chain = stack.pop()
+            try:
+                with os.scandir(current_dir) as it:
+                    items = list(it)
+            except READ_ERRORS + (NotADirectoryError,):
+                # Пропускаем директории без доступа и исчезнувшие во время обхода
+                continue
+            if rules.ignore_files:
+                chain = rules.extend_chain(chain, current_dir, prefix,
+                                           (item.name for item in items if item.name in rules.ignore_files))
+            if only is not None and not prefix:
+                items = [item for item in items if item.name in only]
+            
+            subdirs = []
+            for item in items:
+                if item.is_file():
+                    if not rules.include_file(chain, prefix + item.name, item.name):
+                        continue
+                    try:
+                        st = item.stat()
+                    except FileNotFoundError:
+                        # Файл удален во время обхода
+                        continue
+                    
+                    # Обрабатываем файл
+                    entry: Dict[str, Any] = {'type': 'file'}
+                    encoding = None
+                    limit = None
+                    if rules.max_file_size is not None and st.st_size > rules.max_file_size:
+                        rules.oversized.append((prefix + item.name, st.st_size))
+                        if rules.oversize != 'truncate':
+                            continue
+                        limit = rules.max_file_size
+                    if executor:
+                        entry['content'] = None
+                        pending.append((current_structure, item.name,
+                                        executor.submit(read_file_text, Path(item.path), limit)))
+                    elif read_content:
+                        try:
+                            entry['content'], encoding = read_file_text(Path(item.path), limit)
+                        except READ_ERRORS:
+                            continue
+                    entry['size'] = st.st_size
+                    entry['modified'] = st.st_mtime
+                    entry['mode'] = st.st_mode & 0o7777
+                    if limit is not None:
+                        # Сохранены только первые limit байт файла
+                        entry['truncated'] = limit
+                    if read_content:
+                        entry['encoding'] = encoding
+                    current_structure[item.name] = entry
+                    files_count += 1
+                    
+                elif item.is_dir():
+                    # Исключенная директория отсекается целиком и не читается
+                    rel_path = prefix + item.name
+                    if rules.is_excluded(chain, rel_path, item.name, True):
+                        continue
+                    
+                    # Создаем директорию в структуре
+                    if item.name not in current_structure:
+                        current_structure[item.name] = {}
+                        dirs_count += 1
+                    subdirs.append((item.path, current_structure[item.name], rel_path + '/', chain))
+            
+            # В обратном порядке, чтобы обход шел в глубину в порядке листинга
+            stack.extend(reversed(subdirs))
+        
+        for structure, name, future in pending:
+            try:
+                structure[name]['content'], structure[name]['encoding'] = future.result()
+            except READ_ERRORS:
+                # Недоступный или исчезнувший файл пропускается, как и при последовательном чтении
+                del structure[name]
+                files_count -= 1
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    
+    project_structure['metadata']['total_files'] = files_count
+    project_structure['metadata']['total_directories'] = dirs_count
+    
+    return project_structure
+
+
+def scan_directory(root_path: Path, read_content: bool = True, jobs: int = 1,
+                   rules: Optional[ScanRules] = None,
+                   top_level: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """Сканирует директорию и возвращает структуру проекта."""
+    return scan_directory_optimized(root_path, read_content, jobs, rules, top_level)
+
+
+def parallel_map(func: Callable[..., Any], items: Iterable[Any], jobs: int = 1) -> Iterator[Any]:
+    """Применяет func к элементам в пуле потоков, отдавая результаты в исходном порядке.
+
+    Вперед обрабатывается не больше 2 * jobs элементов, так что память остается ограниченной.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        window: Deque['Future[Any]'] = deque()
+        for item in items:
+            window.append(executor.submit(func, item))
+            if len(window) >= jobs * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def iter_file_data(files: Iterable[Tuple[Path, Optional[int]]], jobs: int = 1, with_hash: bool = False,
+                   raw: bool = False) -> Iterator[Dict[str, Any]]:
+    """Читает файлы (путь, limit) в пуле потоков и отдает результаты read_file_data в исходном порядке.
+
+    Файлы больше CHUNK_SIZE отдаются лениво (ключ chunks) и читаются уже при записи.
+    Файл, который не удалось прочитать (READ_ERRORS), дает {'error': исключение}.
+    """
+    def read(item: Tuple[Path, Optional[int]]) -> Dict[str, Any]:
+        try:
+            return read_file_data(item[0], with_hash, raw, item[1], chunked=True)
+        except READ_ERRORS as e:
+            return {'error': e}
+    
+    return parallel_map(read, files, jobs)
+
+
+def remove_structure_file(structure: Dict[str, Any], rel_path: str) -> bool:
+    """Удаляет файл из структуры по относительному пути; возвращает True, если он был."""
+    *dirs, name = rel_path.split('/')
+    for part in dirs:
+        child = structure.get(part)
+        if not isinstance(child, dict):
+            return False
+        structure = child
+    entry = structure.get(name)
+    if isinstance(entry, dict) and entry.get('type') == 'file':
+        del structure[name]
+        return True
+    return False
+
+
+def walk_structure(structure: Dict[str, Any]) -> Iterator[Tuple[str, str, str, Dict[str, Any]]]:
+    """Обходит структуру в глубину без рекурсии.
+
+    Отдает кортежи (вид, относительный путь, имя, запись), где вид — 'file',
+    'begin' (вход в директорию) или 'end' (выход из нее).
+    """
+    stack: List[Tuple[str, Iterator[Tuple[str, Any]], str, str, Dict[str, Any]]] = [
+        ('', iter(structure.items()), '', '', structure)
+    ]
+    while stack:
+        prefix, items = stack[-1][:2]
+        for name, entry in items:
+            if not isinstance(entry, dict):
+                continue
+            rel_path = prefix + name
+            if entry.get('type') == 'file':
+                yield ('file', rel_path, name, entry)
+            else:
+                yield ('begin', rel_path, name, entry)
+                stack.append((rel_path + '/', iter(entry.items()), rel_path, name, entry))
+                break
+        else:
+            _, _, rel_path, name, entry = stack.pop()
+            if stack:
+                yield ('end', rel_path, name, entry)
+
+
+def iter_structure_files(structure: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Перебирает файлы структуры, возвращая пары (относительный путь, запись)."""
+    for kind, rel_path, _, entry in walk_structure(structure):
+        if kind == 'file':
+            yield rel_path, entry
+
+
+class Progress(Protocol):
+    """Прогресс-бар: click.progressbar или NullProgress."""
+
+    def update(self, n_steps: int) -> None: ...
+
+
+class StageStats:
+    """Время, объем и число файлов по этапам команды — для --profile и --stats-json.
+
+    Время этапа — это время, проведенное в нем вызывающим потоком. При jobs > 1
+    чтение и запись файлов идут в пуле потоков, поэтому этапы перекрываются, а
+    время чтения показывает, сколько запись ждала данные.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.info: Dict[str, Any] = {}
+
+    def add(self, name: str, seconds: float = 0.0, files: int = 0, nbytes: int = 0) -> None:
+        """Добавляет к этапу время, файлы и байты."""
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'files': 0, 'bytes': 0})
+        stage['seconds'] += seconds
+        stage['files'] += files
+        stage['bytes'] += nbytes
+
+    @contextmanager
+    def stage(self, name: str, files: int = 0, nbytes: int = 0) -> Iterator[None]:
+        """Относит время блока with к этапу name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, files, nbytes)
+
+    def timed(self, name: str, items: Iterable[Any]) -> Iterator[Any]:
+        """Отдает элементы items, относя время получения каждого к этапу name."""
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def merge(self, other: 'StageStats') -> None:
+        """Добавляет этапы другой статистики; время шардов из разных процессов суммируется.
+
+        Числовые значения info (счетчики) тоже суммируются.
+        """
+        for name, stage in other.stages.items():
+            self.add(name, stage['seconds'], stage['files'], stage['bytes'])
+        for key, value in other.info.items():
+            if isinstance(value, int):
+                self.info[key] = self.info.get(key, 0) + value
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Статистика в виде словаря для JSON, со скоростями по каждому этапу."""
+        stages = {}
+        for name, stage in self.stages.items():
+            seconds = stage['seconds']
+            stages[name] = dict(stage,
+                                files_per_second=stage['files'] / seconds if seconds else None,
+                                bytes_per_second=stage['bytes'] / seconds if seconds else None)
+        return {'total_seconds': time.perf_counter() - self.started, **self.info, 'stages': stages}
+
+    def report(self) -> None:
+        """Печатает статистику по этапам."""
+        data = self.as_dict()
+        click.echo(f"⏱  Этапы (всего {data['total_seconds']:.3f} с):")
+        for name, stage in data['stages'].items():
+            line = f"   - {name:<10} {stage['seconds']:9.3f} с"
+            if stage['files']:
+                line += f"  {stage['files']:>8} файлов ({stage['files_per_second'] or 0:,.0f}/с)"
+            if stage['bytes']:
+                line += f"  {stage['bytes'] / 1024 / 1024:9.1f} MB ({(stage['bytes_per_second'] or 0) / 1024 / 1024:,.1f} MB/с)"
+            click.echo(line)
+
+
+def emit_stats(stats: StageStats, command: str, profile: bool, stats_json: Optional[str]) -> None:
+    """Выводит статистику этапов по флагам --profile и --stats-json ('-' — в stdout).
+
+    В команде с декоратором stats_json_output JSON для '-' пишется в настоящий
+    stdout, куда больше ничего не выводится.
+    """
+    if profile:
+        stats.report()
+    if stats_json:
+        text = json.dumps({'command': command, **stats.as_dict()}, ensure_ascii=False, indent=2)
+        if stats_json == '-':
+            context = click.get_current_context(silent=True)
+            click.echo(text, file=context.meta.get('stats_stdout') if context else None)
+        else:
+            Path(stats_json).write_text(text + '\n', encoding='utf-8')
+
+
+def stats_json_output(command: Callable[..., Any]) -> Callable[..., Any]:
+    """Декоратор команды с --stats-json: при '-' stdout отдается под JSON, а остальной вывод идет в stderr.
+
+    Так отчет можно читать программой: create ... --stats-json - | jq .
+    """
+    @functools.wraps(command)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if kwargs.get('stats_json') != '-':
+            return command(*args, **kwargs)
+        click.get_current_context().meta['stats_stdout'] = sys.stdout
+        with redirect_stdout(sys.stderr):
+            return command(*args, **kwargs)
+    
+    return wrapper
+
+
+def backup_trailer(backup_format: str, digest: str) -> bytes:
+    """Завершающая строка бэкапа с контрольной суммой (content_hash) всех байтов перед ней.
+
+    Длина строки не зависит от суммы, поэтому check отделяет ее от конца
+    потока, не разбирая формат.
+    """
+    if backup_format == 'records':
+        return json.dumps({'type': 'end', 'digest': digest}).encode('utf-8') + b'\n'
+    return f"digest: '{digest}'\n".encode('utf-8')
+
+
+def chunks_hash(entry: Dict[str, Any]) -> Optional[str]:
+    """Хеш большого файла, известный после перебора chunks.
+
+    FileChunks считает его при чтении с диска, а запись из бэкапа получает
+    поле hash вслед за фрагментами.
+    """
+    chunks = entry['chunks']
+    return chunks.hexdigest() if isinstance(chunks, FileChunks) else entry.get('hash')
+
+
+def chunks_encoding(entry: Dict[str, Any]) -> Optional[str]:
+    """Кодировка большого файла, подобранная при переборе chunks (как chunks_hash)."""
+    chunks = entry['chunks']
+    return chunks.encoding if isinstance(chunks, FileChunks) else entry.get('encoding')
+
+
+class BackupYamlWriter:
+    """Потоковая запись бэкапа в YAML.
+
+    Каждая запись сериализуется отдельно и сразу уходит в поток, поэтому в памяти
+    одновременно находится не больше одного файла. Результат — обычный YAML-документ,
+    который читается через yaml.safe_load так же, как бэкап, записанный yaml.dump.
+    Последний ключ документа — digest, контрольная сумма всех байтов перед ним
+    (см. backup_trailer).
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.offset = 0
+        self.digest: Optional[str] = None
+        self._digest = hashlib.blake2b(digest_size=16)
+        # Открытые отображения: [имя, заголовок уже записан]
+        self._stack: List[List[Any]] = []
+
+    def _write(self, text: str) -> None:
+        data = text.encode('utf-8')
+        self.stream.write(data)
+        self._digest.update(data)
+        self.offset += len(data)
+
+    def _dump(self, data: Any, depth: int, width: Optional[int] = None) -> str:
+        text = yaml.dump(data, Dumper=BackupDumper, default_flow_style=False,
+                         allow_unicode=True, sort_keys=False, indent=2, width=width)
+        if depth:
+            prefix = '  ' * depth
+            text = ''.join(prefix + line for line in text.splitlines(True))
+        return text
+
+    def _flush_headers(self) -> None:
+        # Заголовок отображения пишется только при появлении первого потомка,
+        # иначе пустая директория должна быть записана как "{}"
+        for depth, item in enumerate(self._stack):
+            if not item[1]:
+                text = self._dump({item[0]: {}}, depth)
+                self._write(text[:-len('{}\n')].rstrip(' ') + '\n')
+                item[1] = True
+
+    def begin_mapping(self, name: str) -> None:
+        """Открывает вложенное отображение (директорию или раздел верхнего уровня)."""
+        self._stack.append([name, False])
+
+    def end_mapping(self) -> None:
+        """Закрывает последнее открытое отображение."""
+        name, written = self._stack.pop()
+        if not written:
+            self._flush_headers()
+            self._write(self._dump({name: {}}, len(self._stack)))
+
+    def write_entry(self, name: str, value: Any) -> int:
+        """Записывает пару ключ-значение на текущем уровне вложенности.
+
+        Возвращает смещение начала записи в байтах: вместе с self.offset после
+        вызова оно задает фрагмент, который читается отдельно от документа.
+        Запись с полем chunks (большой файл) пишется по фрагменту за раз, а ее
+        hash, известный только после чтения фрагментов, — полем после chunks.
+        """
+        self._flush_headers()
+        start = self.offset
+        depth = len(self._stack)
+        if not isinstance(value, dict) or value.get('chunks') is None:
+            self._write(self._dump({name: value}, depth))
+            return start
+        
+        # Большой файл: поля записи, затем последним полем — последовательность
+        # фрагментов, каждый из которых сериализуется отдельно. Фрагмент пишется
+        # одной строкой: при переносе каждая строка получала бы отступ записи
+        fields = {key: item for key, item in value.items() if key not in ('content', 'data', 'chunks', 'hash')}
+        # Кодировка фрагментов из records известна только после них: тогда они пишутся байтами
+        raw = 'encoding' not in fields
+        if raw:
+            fields['encoding'] = BINARY_ENCODING
+        fields['chunks'] = []
+        text = self._dump({name: fields}, depth)
+        self._write(text[:-len('[]\n')].rstrip(' ') + '\n')
+        written = False
+        for chunk in iter_chunks(value, raw=raw):
+            self._write(self._dump([chunk], depth + 1, UNWRAPPED_WIDTH))
+            written = True
+        if not written:
+            self._write(self._dump([''], depth + 1))
+        digest = chunks_hash(value)
+        if digest is not None:
+            self._write(self._dump({'hash': digest}, depth + 1))
+        return start
+
+    def finish(self) -> None:
+        """Закрывает отображения и дописывает контрольную сумму документа."""
+        while self._stack:
+            self.end_mapping()
+        self.digest = self._digest.hexdigest()
+        trailer = backup_trailer('yaml', self.digest)
+        self.stream.write(trailer)
+        self.offset += len(trailer)
+
+
+class BackupRecordsWriter:
+    """Потоковая запись бэкапа в формате records.
+
+    Формат плоский: сигнатура RECORDS_MAGIC, строка JSON с разделами заголовка
+    (metadata, deleted), затем по записи на директорию, файл и блоб. Запись — строка
+    JSON с путем и метаданными, а у файла и блоба за ней следуют length сырых байтов
+    содержимого и перевод строки. Файл больше CHUNK_SIZE записывается с флагом
+    chunked и без length: его байты идут следом записями {"type": "chunk"} того же
+    вида, а пустой фрагмент с хешем файла (и кодировкой, если она подбиралась по
+    ходу чтения) завершает его. Последняя запись — {"type": "end"} с контрольной
+    суммой всех байтов перед ней, по ней обнаруживается обрезанный бэкап.
+
+    Интерфейс совпадает с BackupYamlWriter, поэтому write_backup пишет оба формата.
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.offset = 0
+        self.digest: Optional[str] = None
+        self._digest = hashlib.blake2b(digest_size=16)
+        self._header: Optional[Dict[str, Any]] = {}
+        self._stack: List[str] = []
+
+    def _write(self, data: bytes) -> None:
+        self.stream.write(data)
+        self._digest.update(data)
+        self.offset += len(data)
+
+    def _write_record(self, record: Dict[str, Any], data: Optional[bytes] = None) -> None:
+        if data is not None:
+            record['length'] = len(data)
+        self._write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        if data is not None:
+            self._write(data)
+            self._write(b'\n')
+
+    def _flush_header(self) -> None:
+        if self._header is not None:
+            self._write(RECORDS_MAGIC)
+            self._write(json.dumps(self._header, ensure_ascii=False).encode('utf-8') + b'\n')
+            self._header = None
+
+    def begin_mapping(self, name: str) -> None:
+        """Открывает раздел верхнего уровня или директорию внутри structure."""
+        self._flush_header()
+        if self._stack:
+            self._write_record({'type': 'dir', 'path': '/'.join(self._stack[1:] + [name])})
+        self._stack.append(name)
+
+    def end_mapping(self) -> None:
+        """Закрывает последний открытый раздел или директорию."""
+        self._stack.pop()
+
+    def write_entry(self, name: str, value: Any) -> int:
+        """Пишет раздел заголовка, файл (в structure) или блоб (в blobs).
+
+        Возвращает смещение начала записи в байтах, как BackupYamlWriter.
+        """
+        if not self._stack:
+            if self._header is None:
+                raise ValueError("Разделы заголовка должны идти до structure")
+            self._header[name] = value
+            return self.offset
+        
+        start = self.offset
+        if self._stack[0] == 'blobs':
+            record = {'type': 'blob', 'digest': name, 'encoding': value.get('encoding')}
+        else:
+            record = {'type': 'file', 'path': '/'.join(self._stack[1:] + [name])}
+            record.update((key, item) for key, item in value.items()
+                          if key not in ('type', 'content', 'data', 'chunks'))
+        if 'blob' in value:
+            self._write_record(record)
+        elif value.get('chunks') is not None:
+            # Большой файл: запись без length, за ней фрагменты до пустого, несущего хеш
+            record.pop('hash', None)
+            record['chunked'] = True
+            self._write_record(record)
+            for chunk in iter_chunks(value, raw=True):
+                self._write_record({'type': 'chunk'}, chunk)
+            closing: Dict[str, Any] = {'type': 'chunk'}
+            digest = chunks_hash(value)
+            if digest:
+                closing['hash'] = digest
+            encoding = None if record.get('encoding') else chunks_encoding(value)
+            if encoding:
+                closing['encoding'] = encoding
+            self._write_record(closing, b'')
+        else:
+            self._write_record(record, entry_bytes(value))
+        return start
+
+    def finish(self) -> None:
+        """Записывает завершающую запись с контрольной суммой."""
+        self._flush_header()
+        self._stack.clear()
+        self.digest = self._digest.hexdigest()
+        trailer = backup_trailer('records', self.digest)
+        self.stream.write(trailer)
+        self.offset += len(trailer)
+
+
+class UnreadableBlob(Exception):
+    """Ни один файл с содержимым блоба не удалось прочитать, а ссылки на блоб уже записаны.
+
+    skipped — пути, которые нужно пропустить при повторной записи бэкапа: файлы
+    этого блоба и файлы, пропущенные до него.
+    """
+
+    def __init__(self, skipped: List[str]):
+        super().__init__(f"не удалось прочитать {len(skipped)} файлов")
+        self.skipped = skipped
+
+
+def write_backup(stream: BinaryIO, root_path: Path, project_structure: Dict[str, Any],
+                 progress_bar: Optional[Progress] = None, jobs: int = 1,
+                 sections: Optional[Dict[str, Any]] = None, dedup: bool = False,
+                 backup_format: str = 'yaml', stats: Optional[StageStats] = None,
+                 exclude: Iterable[str] = ()) -> Dict[str, Any]:
+    """Записывает бэкап в поток, читая содержимое файлов по мере записи.
+
+    project_structure может быть получена с read_content=False: недостающее
+    содержимое читается с диска непосредственно перед записью каждого файла
+    (при jobs > 1 — с небольшим упреждением в пуле потоков). sections — разделы
+    верхнего уровня, которые пишутся между metadata и structure.
+
+    С dedup записи structure ссылаются на ключи таблицы blobs (хеш содержимого),
+    а каждое уникальное содержимое записывается в blobs один раз после structure.
+    backup_format — 'yaml' или 'records'; для records файлы не декодируются в
+    текст, а пишутся исходными байтами. В stats попадают этапы read (hash для
+    dedup) и serialize. Запись файла с содержимым несет hash — content_hash его
+    байтов, посчитанный в том же проходе, что и чтение; у блоба хешем служит ключ.
+
+    Файлы больше CHUNK_SIZE читаются и пишутся фрагментами (поле chunks), так что
+    память не зависит от размера файла. У записей с truncated читаются только
+    первые truncated байт.
+
+    Файл, который после сканирования удален или стал недоступен, пропускается с
+    предупреждением: его нет в structure, manifest и index, а total_files в
+    project_structure уменьшается (metadata в самом бэкапе уже записана).
+    Пути из exclude пропускаются так же, но без чтения и предупреждения.
+
+    С dedup блоб, первый файл которого не читается, берется из другого файла с
+    тем же хешем. Если не читается ни один, ссылки на блоб в structure уже
+    записаны, поэтому поднимается UnreadableBlob: бэкап пишется заново с
+    exclude (см. save_backup).
+
+    Возвращает статистику: manifest (путь -> [размер, mtime, хеш]), index
+    (путь -> [смещение, длина] записи, для dedup также смещение и длина блоба),
+    blobs (число уникальных блобов), saved_bytes (байт сэкономлено дедупликацией)
+    и skipped (пути пропущенных файлов).
+    """
+    structure = project_structure['structure']
+    raw = backup_format == 'records'
+    stats = stats or StageStats()
+    exclude = set(exclude)
+    missing = ((root_path / rel_path, entry.get('truncated'))
+               for kind, rel_path, _, entry in walk_structure(structure)
+               if kind == 'file' and entry.get('content') is None and rel_path not in exclude)
+    if dedup:
+        def try_hash(item: Tuple[Path, Optional[int]]) -> Any:
+            try:
+                return hash_file(*item)
+            except READ_ERRORS as e:
+                return e
+        
+        # Первый проход только хеширует байты; содержимое читается позже и лишь для уникальных файлов
+        file_hashes = stats.timed('hash', parallel_map(try_hash, missing, jobs))
+    else:
+        file_data = stats.timed('read', iter_file_data(missing, jobs, with_hash=True, raw=raw))
+    manifest: Dict[str, List[Any]] = {}
+    index: Dict[str, List[Any]] = {}
+    # Хеш -> (путь к первому файлу, размер, уже прочитанная запись или None, limit)
+    unique: Dict[str, Tuple[Path, int, Optional[Dict[str, Any]], Optional[int]]] = {}
+    # Хеш -> все файлы с этим содержимым (путь, limit), на случай если первый не прочитается
+    copies: Dict[str, List[Tuple[str, Optional[int]]]] = {}
+    saved_bytes = 0
+    skipped: List[str] = []
+    
+    def skip(rel_path: str, error: Optional[OSError]) -> None:
+        if error is not None:
+            click.echo(f"⚠ Файл {rel_path} пропущен: {error.strerror or error}")
+        skipped.append(rel_path)
+        project_structure['metadata']['total_files'] -= 1
+    
+    writer = BackupRecordsWriter(stream) if raw else BackupYamlWriter(stream)
+    writer.write_entry('metadata', project_structure['metadata'])
+    for key, value in (sections or {}).items():
+        writer.write_entry(key, value)
+    writer.begin_mapping('structure')
+    
+    for kind, rel_path, name, entry in walk_structure(structure):
+        if kind == 'file' and rel_path in exclude:
+            skip(rel_path, None)
+        elif kind == 'file' and dedup:
+            if entry.get('content') is None:
+                digest = next(file_hashes)
+                if isinstance(digest, OSError):
+                    skip(rel_path, digest)
+                    continue
+                stats.add('hash', files=1, nbytes=entry.get('size', 0))
+                known = None
+            else:
+                known = {'content': entry['content'], 'encoding': entry.get('encoding')}
+                digest = content_hash(entry_bytes(known))
+            if digest in unique:
+                saved_bytes += entry.get('size', 0)
+            else:
+                unique[digest] = (root_path / rel_path, entry.get('size', 0), known, entry.get('truncated'))
+            copies.setdefault(digest, []).append((rel_path, entry.get('truncated')))
+            record = {'type': 'file', 'blob': digest}
+            record.update((key, value) for key, value in entry.items()
+                          if key not in ('content', 'encoding'))
+            # Байты содержимого учитываются при записи блоба
+            with stats.stage('serialize', 1):
+                start = writer.write_entry(name, record)
+            index[rel_path] = [start, writer.offset - start]
+            manifest[rel_path] = [entry.get('size'), entry.get('modified'), digest]
+            if progress_bar:
+                progress_bar.update(entry.get('size', 0))
+        elif kind == 'file':
+            record = {'type': 'file', 'content': entry.get('content')}
+            record.update(entry)
+            if record['content'] is None:
+                data = next(file_data)
+                if 'error' in data:
+                    skip(rel_path, data['error'])
+                    continue
+                digest = data.pop('hash', None)
+                if 'chunks' in data:
+                    # Большой файл читается фрагментами во время записи
+                    del record['content']
+                record.update(data)
+                stats.add('read', files=1, nbytes=entry.get('size', 0))
+            else:
+                digest = content_hash(entry_bytes(record))
+            if digest is not None:
+                # Хеш, посчитанный при чтении, проверяется check и restore --verify
+                record['hash'] = digest
+            with stats.stage('serialize', 1, entry.get('size', 0)):
+                start = writer.write_entry(name, record)
+            if digest is None:
+                digest = record['chunks'].hexdigest()
+            index[rel_path] = [start, writer.offset - start]
+            manifest[rel_path] = [entry.get('size'), entry.get('modified'), digest]
+            if progress_bar:
+                progress_bar.update(entry.get('size', 0))
+        elif kind == 'begin':
+            writer.begin_mapping(name)
+        else:
+            writer.end_mapping()
+    
+    writer.end_mapping()
+    
+    if dedup:
+        writer.begin_mapping('blobs')
+        unread = ((path, limit) for path, _, known, limit in unique.values() if known is None)
+        blob_data = stats.timed('read', iter_file_data(unread, jobs, with_hash=True, raw=raw))
+        blob_index: Dict[str, List[int]] = {}
+        for digest, (path, size, known, _) in unique.items():
+            actual = digest
+            if known is None:
+                known = next(blob_data)
+                # Первый файл исчез или стал недоступен: читается другой с тем же содержимым
+                for rel_path, limit in copies[digest][1:]:
+                    if 'error' not in known:
+                        break
+                    known = next(iter_file_data([(root_path / rel_path, limit)], with_hash=True, raw=raw))
+                if 'error' in known:
+                    for rel_path, _ in copies[digest]:
+                        skip(rel_path, known['error'])
+                    raise UnreadableBlob(skipped)
+                actual = known.pop('hash', None)
+                stats.add('read', files=1, nbytes=size)
+            with stats.stage('serialize', nbytes=size):
+                start = writer.write_entry(digest, known)
+            if actual is None:
+                actual = known['chunks'].hexdigest()
+            if actual != digest:
+                click.echo(f"⚠ Файл {path} изменился во время создания бэкапа")
+            blob_index[digest] = [start, writer.offset - start]
+        writer.end_mapping()
+        for rel_path, offsets in index.items():
+            offsets.extend(blob_index[manifest[rel_path][2]])
+    with stats.stage('serialize'):
+        writer.finish()
+    
+    return {'manifest': manifest, 'index': index, 'blobs': len(unique), 'saved_bytes': saved_bytes,
+            'skipped': skipped}
+
+
+class ReadStream(Protocol):
+    """Поток, из которого читают парсеры бэкапа: файл бэкапа или DigestReader."""
+
+    def read(self, size: int = -1) -> bytes: ...
+
+    def readline(self) -> bytes: ...
+
+
+class BackupYamlReader:
+    """Потоковое чтение бэкапа из YAML по событиям парсера.
+
+    Документ не строится целиком: записи файлов собираются из событий по одной
+    и отдаются сразу, поэтому расход памяти не зависит от размера бэкапа.
+    """
+
+    def __init__(self, stream: ReadStream) -> None:
+        self.loader = YAML_LOADER(stream)
+        self.header: Dict[str, Any] = {}
+        self.has_structure = False
+        self._anchors: Dict[str, Any] = {}
+
+    def _scalar(self, event: yaml.ScalarEvent) -> Any:
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = self.loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        constructor = self.loader.yaml_constructors.get(tag)
+        if constructor is None:
+            raise yaml.constructor.ConstructorError(
+                None, None, f"неизвестный тег {tag!r}", event.start_mark)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, event.style)
+        return constructor(self.loader, node)
+
+    def _value(self, event: Optional[yaml.Event] = None) -> Any:
+        """Собирает значение целиком начиная с очередного события."""
+        if event is None:
+            event = self.loader.get_event()
+        if isinstance(event, yaml.AliasEvent):
+            return self._anchors[event.anchor]
+        if isinstance(event, yaml.ScalarEvent):
+            value = self._scalar(event)
+        elif isinstance(event, yaml.SequenceStartEvent):
+            value = []
+            while not self.loader.check_event(yaml.SequenceEndEvent):
+                value.append(self._value())
+            self.loader.get_event()
+        elif isinstance(event, yaml.MappingStartEvent):
+            value = {}
+            while not self.loader.check_event(yaml.MappingEndEvent):
+                key = self._value()
+                value[key] = self._value()
+            self.loader.get_event()
+        else:
+            raise yaml.YAMLError(f"Неожиданное событие YAML: {event}")
+        if getattr(event, 'anchor', None):
+            self._anchors[event.anchor] = value
+        return value
+
+    def _read_top_level(self) -> None:
+        # Читает ключи верхнего уровня до раздела structure или конца документа
+        while not self.loader.check_event(yaml.MappingEndEvent):
+            key = self._value()
+            if key == 'structure' and not self.has_structure:
+                self.has_structure = True
+                return
+            self.header[key] = self._value()
+        self.loader.get_event()
+
+    def read_header(self) -> Dict[str, Any]:
+        """Читает разделы перед structure (metadata и др.), не трогая содержимое файлов."""
+        self.loader.get_event()  # StreamStart
+        if not self.loader.check_event(yaml.DocumentStartEvent):
+            return self.header
+        self.loader.get_event()
+        if not self.loader.check_event(yaml.MappingStartEvent):
+            return self.header
+        self.loader.get_event()
+        self._read_top_level()
+        return self.header
+
+    def iter_entries(self) -> Iterator[Tuple[Any, ...]]:
+        """Перебирает записи structure: ('dir', путь) и ('file', путь, запись).
+
+        Путь — относительный, с разделителем '/'. Директория всегда отдается
+        раньше вложенных в нее файлов. Если после structure идет таблица blobs
+        дедуплицированного бэкапа, ее элементы отдаются как ('blob', хеш, запись).
+
+        Фрагменты большого файла (поле chunks) разбираются лениво: их нужно
+        перебрать до перехода к следующей записи, иначе они будут пропущены.
+        """
+        if not self.has_structure:
+            return
+        event = self.loader.get_event()
+        if not isinstance(event, yaml.MappingStartEvent):
+            self._value(event)
+            yield from self._iter_trailing()
+            return
+
+        prefixes = ['']
+        pending_key = None
+        while prefixes:
+            if pending_key is None and self.loader.check_event(yaml.MappingEndEvent):
+                self.loader.get_event()
+                prefixes.pop()
+                continue
+            name = pending_key if pending_key is not None else self._value()
+            pending_key = None
+            path = prefixes[-1] + str(name)
+
+            event = self.loader.get_event()
+            if not isinstance(event, yaml.MappingStartEvent):
+                # Скаляры и списки на месте директорий игнорируются, как и раньше
+                self._value(event)
+                continue
+            if self.loader.check_event(yaml.MappingEndEvent):
+                self.loader.get_event()
+                yield ('dir', path)
+                continue
+
+            first_key = self._value()
+            if self.loader.check_event(yaml.MappingStartEvent):
+                # Первый же потомок — отображение, значит это директория
+                yield ('dir', path)
+                prefixes.append(path + '/')
+                pending_key = first_key
+                continue
+
+            entry = {first_key: self._value()}
+            chunks = self._read_fields(entry)
+            if entry.get('type') == 'file':
+                yield ('file', path, entry)
+            else:
+                yield ('dir', path)
+            if chunks is not None:
+                self._skip_rest(chunks)
+
+        yield from self._iter_trailing()
+
+    def _read_fields(self, entry: Dict[str, Any]) -> Optional[Iterator[str]]:
+        # Дочитывает поля записи до конца отображения. На последовательности
+        # chunks останавливается: фрагменты разбираются лениво, по мере перебора
+        while not self.loader.check_event(yaml.MappingEndEvent):
+            key = self._value()
+            if key == 'chunks' and self.loader.check_event(yaml.SequenceStartEvent):
+                self.loader.get_event()
+                chunks = self._iter_chunks(entry)
+                entry['chunks'] = chunks
+                return chunks
+            entry[key] = self._value()
+        self.loader.get_event()
+        return None
+
+    def _iter_chunks(self, entry: Dict[str, Any]) -> Iterator[str]:
+        # Поля после chunks (hash) попадают в запись, когда фрагменты перебраны
+        while not self.loader.check_event(yaml.SequenceEndEvent):
+            yield self._value()
+        self.loader.get_event()
+        while not self.loader.check_event(yaml.MappingEndEvent):
+            key = self._value()
+            entry[key] = self._value()
+        self.loader.get_event()
+
+    def _skip_rest(self, chunks: Iterator[str]) -> None:
+        # Пропускает фрагменты, которые потребитель не дочитал, вместе с остатком записи
+        for _ in chunks:
+            pass
+
+    def _iter_trailing(self) -> Iterator[Tuple[Any, ...]]:
+        # Разделы после structure; таблица blobs отдается по одному блобу
+        while not self.loader.check_event(yaml.MappingEndEvent):
+            key = self._value()
+            if key == 'blobs' and self.loader.check_event(yaml.MappingStartEvent):
+                self.loader.get_event()
+                while not self.loader.check_event(yaml.MappingEndEvent):
+                    digest = self._value()
+                    event = self.loader.get_event()
+                    if not isinstance(event, yaml.MappingStartEvent):
+                        yield ('blob', digest, self._value(event))
+                        continue
+                    blob: Dict[str, Any] = {}
+                    chunks = self._read_fields(blob)
+                    yield ('blob', digest, blob)
+                    if chunks is not None:
+                        self._skip_rest(chunks)
+                self.loader.get_event()
+            else:
+                self.header[key] = self._value()
+        self.loader.get_event()
+
+
+def read_record(stream: ReadStream) -> Dict[str, Any]:
+    """Читает одну запись формата records вместе с байтами содержимого (ключ data)."""
+    line = stream.readline()
+    if not line.endswith(b'\n'):
+        raise ValueError("Бэкап обрезан: нет завершающей записи")
+    record: Dict[str, Any] = json.loads(line)
+    length = record.pop('length', None)
+    if length is not None:
+        record['data'] = stream.read(length)
+        if len(record['data']) != length or stream.read(1) != b'\n':
+            raise ValueError(f"Бэкап обрезан на записи {record.get('path') or record.get('digest')}")
+    return record
+
+
+def read_chunks(stream: ReadStream, entry: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    """Перебирает фрагменты большого файла формата records до завершающего пустого.
+
+    Хеш и кодировка файла из завершающего фрагмента попадают в entry['hash'] и
+    entry['encoding'].
+    """
+    while True:
+        record = read_record(stream)
+        if record.get('type') != 'chunk':
+            raise ValueError("Бэкап поврежден: ожидался фрагмент файла")
+        if not record['data']:
+            if entry is not None:
+                entry.update((key, record[key]) for key in ('hash', 'encoding') if record.get(key) is not None)
+            return
+        yield record['data']
+
+
+class BackupRecordsReader:
+    """Потоковое чтение бэкапа в формате records.
+
+    Интерфейс совпадает с BackupYamlReader; записи файлов вместо content несут
+    исходные байты в ключе data, поэтому восстановлению не нужно ничего кодировать.
+    """
+
+    def __init__(self, stream: ReadStream):
+        self.stream = stream
+        self.header: Dict[str, Any] = {}
+        self.has_structure = False
+
+    def read_header(self) -> Dict[str, Any]:
+        """Читает сигнатуру и строку заголовка."""
+        if self.stream.read(len(RECORDS_MAGIC)) != RECORDS_MAGIC:
+            raise ValueError("Неверная сигнатура бэкапа records")
+        self.header = json.loads(self.stream.readline())
+        self.has_structure = True
+        return self.header
+
+    def iter_entries(self) -> Iterator[Tuple[Any, ...]]:
+        """Перебирает записи так же, как BackupYamlReader.iter_entries.
+
+        Фрагменты большого файла (поле chunks), как и там, читаются из потока
+        по мере перебора.
+        """
+        while True:
+            record = read_record(self.stream)
+            kind = record.pop('type')
+            if kind == 'end':
+                return
+            if kind == 'file':
+                record = {'type': 'file', **record}
+            chunks = None
+            if record.pop('chunked', False):
+                chunks = record['chunks'] = read_chunks(self.stream, record)
+            if kind == 'dir':
+                yield ('dir', record['path'])
+            elif kind == 'file':
+                yield ('file', record.pop('path'), record)
+            elif kind == 'blob':
+                yield ('blob', record.pop('digest'), record)
+            if chunks is not None:
+                # Фрагменты, которые потребитель не дочитал
+                for _ in chunks:
+                    pass
+
+
+def backup_reader(stream: BackupStream) -> Union[BackupYamlReader, BackupRecordsReader]:
+    """Создает потоковый читатель под формат бэкапа, определяя его по сигнатуре."""
+    if stream.peek(len(RECORDS_MAGIC)).startswith(RECORDS_MAGIC):
+        return BackupRecordsReader(stream)
+    return BackupYamlReader(stream)
+
+
+class DigestReader:
+    """Поток бэкапа, считающий его контрольную сумму по мере чтения парсером.
+
+    Последние trailer_size байт прочитанного придерживаются: если поток на них
+    кончается, это завершающая строка backup_trailer, которая в сумму не входит.
+    """
+
+    def __init__(self, stream: BackupStream, trailer_size: int):
+        self.stream = stream
+        self.trailer_size = trailer_size
+        self.tail = b''
+        self._digest = hashlib.blake2b(digest_size=16)
+
+    def _feed(self, data: bytes) -> bytes:
+        if data:
+            buffered = self.tail + data
+            cut = max(len(buffered) - self.trailer_size, 0)
+            self._digest.update(memoryview(buffered)[:cut])
+            self.tail = buffered[cut:]
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        return self._feed(self.stream.read(size))
+
+    def readline(self) -> bytes:
+        return self._feed(self.stream.readline())
+
+    def hexdigest(self) -> str:
+        """Сумма всего прочитанного, кроме придержанного хвоста."""
+        return self._digest.hexdigest()
+
+
+def entry_bytes(entry: Dict[str, Any]) -> bytes:
+    """Возвращает исходные байты файла из записи бэкапа.
+
+    Записи формата records и двоичные файлы YAML (!!binary) уже несут байты.
+    Текст YAML кодируется обратно в исходную кодировку файла, а старые бэкапы
+    без поля encoding — в UTF-8.
+    """
+    data: Optional[bytes] = entry.get('data')
+    if data is not None:
+        return data
+    if entry.get('chunks') is not None:
+        return b''.join(iter_chunks(entry, raw=True))
+    content: Union[str, bytes] = entry['content']
+    if isinstance(content, bytes):
+        return content
+    return content.encode(entry.get('encoding') or 'utf-8')
+
+
+def iter_chunks(entry: Dict[str, Any], raw: bool) -> Iterator[Any]:
+    """Перебирает фрагменты большого файла из поля chunks: байты при raw, иначе текст.
+
+    Фрагменты records и FileChunks разрезаны по байтам, а не по символам, поэтому
+    текст собирается инкрементальным декодером. Фрагменты двоичного файла всегда
+    отдаются байтами. Пустые фрагменты пропускаются.
+    """
+    encoding = entry.get('encoding') or 'utf-8'
+    decoder = None if raw or encoding == BINARY_ENCODING else codecs.getincrementaldecoder(encoding)()
+    for chunk in entry['chunks']:
+        if isinstance(chunk, str):
+            if raw:
+                chunk = chunk.encode(encoding)
+        elif decoder is not None:
+            chunk = decoder.decode(chunk)
+        if chunk:
+            yield chunk
+    if decoder is not None:
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+
+def has_content(entry: Dict[str, Any]) -> bool:
+    """Проверяет, что в записи есть само содержимое файла, а не только ссылка на блоб."""
+    return 'content' in entry or 'data' in entry or 'chunks' in entry
+
+
+def entry_text(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Возвращает запись с содержимым-строкой вместо байтов, как ее хранит YAML.
+
+    Записи с полем chunks возвращаются как есть: BackupYamlWriter декодирует фрагменты сам.
+    Содержимое двоичного файла остается байтами и пишется как !!binary.
+    """
+    if entry.get('data') is None:
+        return entry
+    record = {'type': entry['type']} if 'type' in entry else {}
+    encoding = entry.get('encoding') or 'utf-8'
+    record['content'] = entry['data'] if encoding == BINARY_ENCODING else str(entry['data'], encoding)
+    record.update((key, value) for key, value in entry.items() if key not in record and key != 'data')
+    return record
+
+
+def open_restore_target(path: Path) -> BinaryIO:
+    """Открывает восстанавливаемый файл на запись, создавая родителя, если его нет."""
+    try:
+        return open(path, 'wb')
+    except FileNotFoundError:
+        # Директория не была объявлена в бэкапе заранее
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return open(path, 'wb')
+
+
+class RestoreWriter:
+    """Записывает файлы при восстановлении, при jobs > 1 — в пуле потоков.
+
+    Директории создаются заранее вызывающим потоком через make_dir, поэтому
+    запись файла не тратит системные вызовы на mkdir родителя. Ошибка по одному
+    файлу выводится, но не прерывает восстановление; счетчики и прогресс-бар
+    обновляются под блокировкой.
+
+    Файлы дедуплицированного бэкапа: содержимое каждого блоба записывается один
+    раз, остальные файлы копируются с первого (или связываются при link).
+    Файлы, чей блоб еще не прочитан, ждут его появления в потоке.
+
+    С sync файл, совпадающий с записью по размеру и mtime (а с checksum — по
+    хешу содержимого при другом mtime), не перезаписывается и учитывается в
+    skipped_files. С preserve_mtime файлам возвращается исходное время изменения.
+    Хеш большого файла в бэкапе идет после фрагментов, поэтому с checksum файл
+    на диске сверяется с ними по ходу разбора и переписывается, только если
+    содержимое разошлось.
+
+    Фрагменты большого файла читаются из потока бэкапа по мере записи, поэтому
+    такой файл пишется сразу в вызывающем потоке, до разбора следующей записи.
+
+    С verify содержимое каждой записи сверяется с ее hash (у блоба — с ключом)
+    в том же потоке, что и запись файла. Поврежденный файл все равно
+    записывается, но выводится и учитывается в corrupted_files.
+
+    written_bytes — байты, записанные в файлы (жесткие ссылки не в счет). Время
+    разбора фрагментов, которые читаются во время записи, копится в этапе parse
+    собственной статистики stats.
+    """
+
+    def __init__(self, progress_bar: Optional[Progress] = None, jobs: int = 1, link: bool = False,
+                 blobs: Optional[Dict[str, Any]] = None, sync: bool = False,
+                 checksum: bool = False, preserve_mtime: bool = False, verify: bool = False):
+        self.progress_bar = progress_bar
+        self.jobs = jobs
+        self.link = link
+        self.blobs = blobs or {}
+        self.sync = sync
+        self.checksum = checksum
+        self.preserve_mtime = preserve_mtime
+        self.verify = verify
+        self.created_files = 0
+        self.skipped_files = 0
+        self.verified_files = 0
+        self.corrupted_files = 0
+        self.written_bytes = 0
+        self.stats = StageStats()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        # Ограничивает число файлов, ожидающих записи, а с ними и память
+        self._window: Deque['Future[bool]'] = deque()
+        # Хеш -> (первый файл с этим содержимым, его запись)
+        self._blob_sources: Dict[str, Tuple[Path, 'Future[bool]']] = {}
+        # Хеш -> файлы (путь, запись), ждущие блоб
+        self._pending_blobs: Dict[str, List[Tuple[Path, Dict[str, Any]]]] = {}
+
+    def _call(self, func: Callable[..., bool], *args: Any) -> 'Future[bool]':
+        # Выполняет запись в вызывающем потоке и оборачивает результат в Future
+        future: 'Future[bool]' = Future()
+        future.set_result(func(*args))
+        return future
+
+    def _submit(self, func: Callable[..., bool], *args: Any) -> 'Future[bool]':
+        if self._executor is None:
+            return self._call(func, *args)
+        future = self._executor.submit(func, *args)
+        self._window.append(future)
+        if len(self._window) >= self.jobs * 4:
+            self._window.popleft().result()
+        return future
+
+    def _report(self, message: str) -> None:
+        with self._lock:
+            click.echo(message)
+
+    def _created(self, current_path: Path, nbytes: int = 0) -> None:
+        with self._lock:
+            self.created_files += 1
+            self.written_bytes += nbytes
+            if self.progress_bar:
+                self.progress_bar.update(1)
+            else:
+                click.echo(f"✓ Создан файл: {current_path}")
+
+    def _skipped(self, current_path: Path) -> None:
+        with self._lock:
+            self.skipped_files += 1
+            if self.progress_bar:
+                self.progress_bar.update(1)
+            else:
+                click.echo(f"= Без изменений: {current_path}")
+
+    def _verified(self, current_path: Path, expected: Optional[str], actual: str) -> None:
+        # Записи без хеша (старые бэкапы) не проверяются
+        if expected is None:
+            return
+        with self._lock:
+            self.verified_files += 1
+            if actual != expected:
+                self.corrupted_files += 1
+                click.echo(f"✗ Поврежден файл {current_path}: хеш содержимого не совпадает с бэкапом")
+
+    def _existing(self, current_path: Path, meta: Dict[str, Any]) -> Optional[os.stat_result]:
+        # stat обычного файла того же размера, что в записи, иначе None
+        try:
+            info = os.stat(current_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if not stat.S_ISREG(info.st_mode) or info.st_size != meta.get('size'):
+            return None
+        return info
+
+    def _keep(self, current_path: Path, meta: Dict[str, Any], info: os.stat_result) -> None:
+        # Поправляет права и mtime совпавшего файла на месте
+        modified = meta.get('modified')
+        if self.preserve_mtime and modified is not None and info.st_mtime != modified:
+            os.utime(current_path, (info.st_atime, modified))
+        mode = meta.get('mode')
+        if mode is not None and stat.S_IMODE(info.st_mode) != mode:
+            os.chmod(current_path, mode)
+
+    def _unchanged(self, current_path: Path, meta: Dict[str, Any],
+                   digest: Callable[[], Optional[str]]) -> bool:
+        # Сравнение для sync; digest() возвращает None, если хеш до записи неизвестен
+        info = self._existing(current_path, meta)
+        if info is None:
+            return False
+        if info.st_mtime != meta.get('modified'):
+            if not self.checksum:
+                return False
+            expected = digest()
+            if expected is None or hash_file(current_path) != expected:
+                return False
+        self._keep(current_path, meta, info)
+        return True
+
+    def _write_chunks(self, current_path: Path, entry: Dict[str, Any]) -> Tuple[int, str]:
+        """Пишет фрагменты большого файла по мере разбора; возвращает записанные байты и хеш."""
+        digest = hashlib.blake2b(digest_size=16)
+        written = 0
+        with open_restore_target(current_path) as target:
+            for chunk in self.stats.timed('parse', iter_chunks(entry, raw=True)):
+                digest.update(chunk)
+                written += target.write(chunk)
+        return written, digest.hexdigest()
+
+    def _sync_chunks(self, current_path: Path, entry: Dict[str, Any]) -> Tuple[int, str, bool]:
+        """Сверяет файл на диске с фрагментами по мере разбора; возвращает байты, хеш и было ли расхождение.
+
+        Пока фрагменты совпадают с файлом, ничего не пишется. С первого
+        расхождения совпавшее начало и остальные фрагменты пишутся во временный
+        файл рядом, который затем заменяет исходный.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        tmp_path = current_path.with_name(current_path.name + '.tmp')
+        target: Optional[BinaryIO] = None
+        matched = 0
+        written = 0
+        with open(current_path, 'rb') as source:
+            try:
+                for chunk in self.stats.timed('parse', iter_chunks(entry, raw=True)):
+                    digest.update(chunk)
+                    if target is None:
+                        if source.read(len(chunk)) == chunk:
+                            matched += len(chunk)
+                            continue
+                        target = open(tmp_path, 'wb')
+                        source.seek(0)
+                        while written < matched:
+                            written += target.write(source.read(min(CHUNK_SIZE, matched - written)))
+                    written += target.write(chunk)
+            except BaseException:
+                if target is not None:
+                    target.close()
+                    tmp_path.unlink(missing_ok=True)
+                raise
+        if target is None:
+            return 0, digest.hexdigest(), False
+        target.close()
+        os.replace(tmp_path, current_path)
+        return written, digest.hexdigest(), True
+
+    def _finish(self, current_path: Path, meta: Dict[str, Any], chmod: bool = True) -> None:
+        # Права и время изменения из записи бэкапа
+        if chmod and meta.get('mode') is not None:
+            os.chmod(current_path, meta['mode'])
+        if self.preserve_mtime and meta.get('modified') is not None:
+            os.utime(current_path, (time.time(), meta['modified']))
+
+    def _write_file(self, current_path: Path, entry: Dict[str, Any], meta: Dict[str, Any]) -> bool:
+        try:
+            if entry.get('chunks') is not None:
+                return self._write_large_file(current_path, entry, meta)
+            data = entry_bytes(entry)
+            if self.verify:
+                self._verified(current_path, entry.get('hash') or meta.get('blob'), content_hash(data))
+            if self.sync and self._unchanged(current_path, meta, lambda: meta.get('blob') or content_hash(data)):
+                self._skipped(current_path)
+                return True
+            with open_restore_target(current_path) as f:
+                nbytes = f.write(data)
+            self._finish(current_path, meta)
+            self._created(current_path, nbytes)
+            return True
+            
+        except Exception as e:
+            self._report(f"✗ Ошибка при создании файла {current_path}: {e}")
+            return False
+
+    def _write_large_file(self, current_path: Path, entry: Dict[str, Any], meta: Dict[str, Any]) -> bool:
+        # Фрагменты читаются из потока бэкапа во время записи
+        if self.sync and self._unchanged(current_path, meta, lambda: meta.get('blob')):
+            self._skipped(current_path)
+            return True
+        # Хеш фрагментов без их чтения неизвестен: файл того же размера сверяется с ними при записи
+        info = self._existing(current_path, meta) if self.sync and self.checksum else None
+        if info is None:
+            nbytes, digest = self._write_chunks(current_path, entry)
+            changed = True
+        else:
+            nbytes, digest, changed = self._sync_chunks(current_path, entry)
+        if self.verify:
+            # hash большого файла читается из бэкапа вслед за фрагментами
+            self._verified(current_path, entry.get('hash') or meta.get('blob'), digest)
+        if info is not None and not changed:
+            self._keep(current_path, meta, info)
+            self._skipped(current_path)
+            return True
+        self._finish(current_path, meta)
+        self._created(current_path, nbytes)
+        return True
+
+    def _duplicate(self, source: Path, source_written: 'Future[bool]', current_path: Path,
+                   meta: Dict[str, Any]) -> bool:
+        try:
+            if not source_written.result():
+                raise OSError(f"не удалось записать исходный файл {source}")
+            if self.sync and self._unchanged(current_path, meta, lambda: meta['blob']):
+                self._skipped(current_path)
+                return True
+            nbytes = 0
+            if self.link:
+                # Жесткие ссылки делят права и mtime с исходным файлом
+                if current_path.exists():
+                    current_path.unlink()
+                os.link(source, current_path)
+            else:
+                shutil.copyfile(source, current_path)
+                self._finish(current_path, meta)
+                nbytes = os.path.getsize(current_path)
+            self._created(current_path, nbytes)
+            return True
+            
+        except Exception as e:
+            self._report(f"✗ Ошибка при создании файла {current_path}: {e}")
+            return False
+
+    def _place_blob(self, digest: str, blob: Dict[str, Any], current_path: Path,
+                    meta: Dict[str, Any]) -> None:
+        if digest in self._blob_sources:
+            source, written = self._blob_sources[digest]
+            self._submit(self._duplicate, source, written, current_path, meta)
+        else:
+            submit = self._call if blob.get('chunks') is not None else self._submit
+            self._blob_sources[digest] = (current_path, submit(self._write_file, current_path, blob, meta))
+
+    def make_dir(self, current_path: Path) -> None:
+        """Создает директорию в вызывающем потоке."""
+        try:
+            current_path.mkdir(parents=True, exist_ok=True)
+            if not self.progress_bar:
+                click.echo(f"📁 Создана директория: {current_path}")
+        except Exception as e:
+            click.echo(f"✗ Ошибка при создании директории {current_path}: {e}")
+
+    def write_entry(self, current_path: Path, entry: Dict[str, Any]) -> None:
+        """Ставит файл из записи бэкапа в очередь на запись."""
+        digest = entry.get('blob')
+        if digest is None and entry.get('chunks') is not None:
+            self._call(self._write_file, current_path, entry, entry)
+        elif digest is None:
+            self._submit(self._write_file, current_path, entry, entry)
+        elif digest in self._blob_sources or digest in self.blobs:
+            self._place_blob(digest, self.blobs.get(digest, {}), current_path, entry)
+        else:
+            self._pending_blobs.setdefault(digest, []).append((current_path, entry))
+
+    def add_blob(self, digest: str, blob: Dict[str, Any]) -> None:
+        """Раскладывает прочитанный блоб по ожидавшим его файлам."""
+        for current_path, meta in self._pending_blobs.pop(digest, []):
+            self._place_blob(digest, blob, current_path, meta)
+
+    def close(self) -> int:
+        """Дожидается записи всех файлов и возвращает число созданных."""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        for digest, paths in self._pending_blobs.items():
+            for current_path, _ in paths:
+                click.echo(f"✗ Ошибка при создании файла {current_path}: нет блоба {digest}")
+        return self.created_files
+
+
+def delete_paths(base_path: Path, paths: Iterable[str]) -> int:
+    """Удаляет файлы, исчезнувшие из проекта, вместе с опустевшими директориями.
+
+    Директория уже отсутствующего файла тоже удаляется, если пуста: при sync по
+    цепочке файл, удаленный позже, не записывается, а его директория создается.
+    Возвращает число удаленных файлов.
+    """
+    removed = 0
+    for rel_path in paths:
+        current_path = base_path / rel_path
+        try:
+            current_path.unlink()
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            click.echo(f"✗ Ошибка при удалении файла {current_path}: {e}")
+            continue
+        
+        parent = current_path.parent
+        while parent != base_path and parent.is_dir() and not any(parent.iterdir()):
+            parent.rmdir()
+            parent = parent.parent
+    return removed
+
+
+def restore_backup_stream(reader: Union[BackupYamlReader, BackupRecordsReader], base_path: Path,
+                          progress_bar: Optional[Progress] = None, link: bool = False, jobs: int = 1,
+                          stats: Optional[StageStats] = None, sync: bool = False,
+                          checksum: bool = False, preserve_mtime: bool = False,
+                          verify: bool = False, only: Optional[Set[str]] = None,
+                          keep: Collection[str] = ()) -> int:
+    """Восстанавливает файлы по мере разбора бэкапа, не загружая его целиком.
+
+    Для инкрементального бэкапа сначала удаляются файлы из раздела deleted,
+    кроме путей из keep. only ограничивает запись файлов заданными путями
+    (см. chain_sources).
+    Директории создаются по мере разбора (раньше вложенных файлов), а запись
+    файлов при jobs > 1 идет параллельно в пуле потоков. В stats попадают этапы
+    delete, parse, write, skip (файлы, пропущенные при sync) и verify (файлы,
+    сверенные с хешем, при verify; число поврежденных — в info['corrupted_files']).
+    """
+    stats = stats or StageStats()
+    deleted = [rel_path for rel_path in reader.header.get('deleted') or [] if rel_path not in keep]
+    if deleted:
+        with stats.stage('delete'):
+            removed = delete_paths(base_path, deleted)
+        stats.add('delete', files=removed)
+    writer = RestoreWriter(progress_bar, jobs, link, reader.header.get('blobs'),
+                           sync, checksum, preserve_mtime, verify)
+    
+    try:
+        for item in stats.timed('parse', reader.iter_entries()):
+            with stats.stage('write'):
+                if item[0] == 'blob':
+                    writer.add_blob(item[1], item[2])
+                elif item[0] == 'file':
+                    if only is not None and item[1] not in only:
+                        continue
+                    writer.write_entry(base_path / item[1], item[2])
+                    stats.add('parse', files=1, nbytes=item[2].get('size') or 0)
+                else:
+                    writer.make_dir(base_path / item[1])
+    finally:
+        with stats.stage('write'):
+            created_files = writer.close()
+    # Фрагменты разбирались внутри этапа write: их время переносится в parse
+    parse_seconds = writer.stats.stages.get('parse', {}).get('seconds', 0.0)
+    stats.merge(writer.stats)
+    stats.add('write', -parse_seconds, created_files, writer.written_bytes)
+    if sync:
+        stats.add('skip', files=writer.skipped_files)
+    if verify:
+        stats.add('verify', files=writer.verified_files)
+        stats.info['corrupted_files'] = stats.info.get('corrupted_files', 0) + writer.corrupted_files
+    
+    return created_files
+
+
+def convert_backup(reader: Union[BackupYamlReader, BackupRecordsReader],
+                   writer: Union[BackupYamlWriter, BackupRecordsWriter],
+                   metadata: Optional[Dict[str, Any]] = None) -> Dict[str, List[Any]]:
+    """Переписывает бэкап в формат writer потоком, запись за записью.
+
+    Директории открываются и закрываются по путям записей, поэтому в памяти
+    держится только текущий путь. metadata, если задана, заменяет исходную.
+    Возвращает индекс нового бэкапа в том же виде, что и write_backup.
+    """
+    to_text = isinstance(writer, BackupYamlWriter)
+    header = reader.read_header()
+    if metadata is not None:
+        header['metadata'] = metadata
+    # Контрольную сумму writer считает заново
+    header.pop('digest', None)
+    for key, value in header.items():
+        writer.write_entry(key, value)
+    writer.begin_mapping('structure')
+    
+    opened: List[str] = []
+    index: Dict[str, List[Any]] = {}
+    file_blobs: Dict[str, str] = {}
+    blob_index: Dict[str, List[int]] = {}
+    in_blobs = False
+    for item in reader.iter_entries():
+        if item[0] == 'blob':
+            if not in_blobs:
+                for _ in range(len(opened) + 1):
+                    writer.end_mapping()
+                opened = []
+                writer.begin_mapping('blobs')
+                in_blobs = True
+            start = writer.write_entry(item[1], entry_text(item[2]) if to_text else item[2])
+            blob_index[item[1]] = [start, writer.offset - start]
+            continue
+        
+        parts = item[1].split('/')
+        target = parts if item[0] == 'dir' else parts[:-1]
+        common = 0
+        while common < min(len(opened), len(target)) and opened[common] == target[common]:
+            common += 1
+        for _ in range(len(opened) - common):
+            writer.end_mapping()
+        del opened[common:]
+        for name in target[common:]:
+            writer.begin_mapping(name)
+            opened.append(name)
+        
+        if item[0] == 'file':
+            entry = entry_text(item[2]) if to_text else item[2]
+            start = writer.write_entry(parts[-1], entry)
+            index[item[1]] = [start, writer.offset - start]
+            if entry.get('blob') is not None:
+                file_blobs[item[1]] = entry['blob']
+    writer.finish()
+    
+    for rel_path, digest in file_blobs.items():
+        index[rel_path].extend(blob_index.get(digest, []))
+    return index
+
+
+def open_backup_output(path: Path, level: Optional[int] = None, suffix: Optional[str] = None) -> BinaryIO:
+    """Открывает файл бэкапа на запись, сжимая поток по суффиксу (.gz, .bz2, .xz).
+
+    suffix — суффикс, по которому выбирается сжатие, если он отличается от суффикса path.
+    """
+    codec = COMPRESSION_SUFFIXES.get((path.suffix if suffix is None else suffix).lower())
+    if codec is None:
+        return open(path, 'wb')
+    
+    if level is None:
+        level = COMPRESSION_DEFAULT_LEVELS[codec]
+    stream: Any
+    if codec == 'gzip':
+        stream = gzip.open(path, 'wb', compresslevel=level)
+    elif codec == 'bz2':
+        stream = bz2.open(path, 'wb', compresslevel=max(level, 1))
+    else:
+        stream = lzma.open(path, 'wb', preset=level)
+    return io.BufferedWriter(stream, buffer_size=WRITE_BUFFER_SIZE)
+
+
+@contextmanager
+def backup_output(path: Path, level: Optional[int] = None) -> Iterator[BinaryIO]:
+    """Пишет бэкап во временный <path>.tmp и переименовывает его в path после успешной записи.
+
+    При ошибке временный файл удаляется, так что неудачный запуск не оставляет
+    файла, похожего на бэкап, и не портит прежний бэкап с тем же именем.
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        with open_backup_output(tmp_path, level, path.suffix) as f:
+            yield f
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+
+
+def detect_compression(path: Path) -> Optional[str]:
+    """Определяет кодек сжатия файла по магическим байтам."""
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    for codec, signature in COMPRESSION_MAGIC.items():
+        if magic.startswith(signature):
+            return codec
+    return None
+
+
+def open_backup(path: Path) -> BackupStream:
+    """Открывает бэкап на чтение, прозрачно распаковывая его потоком."""
+    codec = detect_compression(path)
+    if codec == 'gzip':
+        return gzip.open(path, 'rb')
+    if codec == 'bz2':
+        return bz2.open(path, 'rb')
+    if codec == 'xz':
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def manifest_path(backup_path: Path) -> Path:
+    """Путь к манифесту, который create кладет рядом с бэкапом."""
+    return backup_path.with_name(backup_path.name + '.manifest')
+
+
+def write_manifest(path: Path, files: Dict[str, List[Any]], header: Dict[str, Any]) -> None:
+    """Записывает манифест: строка заголовка и по строке JSON на файл, по порядку путей."""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'format': MANIFEST_FORMAT, 'version': 1, **header}, ensure_ascii=False) + '\n')
+        for rel_path in sorted(files):
+            f.write(json.dumps([rel_path] + files[rel_path], ensure_ascii=False) + '\n')
+
+
+def read_manifest(path: Path) -> Dict[str, List[Any]]:
+    """Читает манифест в словарь путь -> [размер, mtime, хеш].
+
+    Манифест снимка watch может быть разностным: в заголовке base — путь к
+    базовому бэкапу, к манифесту которого применяются deleted и записи файла.
+    """
+    layers: List[Tuple[Dict[str, Any], List[List[Any]]]] = []
+    files: Dict[str, List[Any]] = {}
+    seen = set()
+    while True:
+        with open(path, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('format') != MANIFEST_FORMAT:
+                raise ValueError(f"{path} не является манифестом simple-backup")
+            # Строки склеиваются в один JSON-массив: один вызов декодера вместо вызова на файл
+            layers.append((header, json.loads('[' + ','.join(f.read().splitlines()) + ']')))
+        if not header.get('base'):
+            break
+        seen.add(path.resolve())
+        base_path = path.parent / header['base']
+        path = manifest_path(base_path)
+        if path.resolve() in seen:
+            raise ValueError(f"Цепочка манифестов зациклена на {path}")
+        if not path.exists():
+            files = load_manifest(base_path)
+            break
+    for header, records in reversed(layers):
+        for rel_path in header.get('deleted') or []:
+            files.pop(rel_path, None)
+        for record in records:
+            files[record[0]] = record[1:]
+    return files
+
+
+def read_backup_header(backup_path: Path) -> Tuple[Dict[str, Any], bool]:
+    """Читает только заголовок бэкапа; возвращает (разделы, есть ли structure)."""
+    with open_backup(backup_path) as f:
+        reader = backup_reader(f)
+        header = reader.read_header()
+        return header, reader.has_structure
+
+
+def backup_file_paths(backup_path: Path) -> Set[str]:
+    """Пути файлов, записанных в самом бэкапе (без его баз): по индексу или разбором бэкапа."""
+    sidecar = index_path(backup_path)
+    if sidecar.exists():
+        with open(sidecar, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('format') == INDEX_FORMAT and header.get('backup_size') == backup_path.stat().st_size:
+                return {json.loads(line)[0] for line in f}
+    with open_backup(backup_path) as f:
+        reader = backup_reader(f)
+        reader.read_header()
+        return {item[1] for item in reader.iter_entries() if item[0] == 'file'}
+
+
+def chain_sources(chain: List[Path]) -> List[Set[str]]:
+    """Для каждого бэкапа цепочки — пути файлов, последняя версия которых лежит в нем.
+
+    Файл, перезаписанный или удаленный дальше по цепочке, не попадает ни в одно
+    множество, поэтому restore --sync пишет и сверяет только итоговые версии.
+    Объединение множеств — итоговый набор файлов.
+    """
+    final: Dict[str, int] = {}
+    for step, backup_path in enumerate(chain):
+        for rel_path in read_backup_header(backup_path)[0].get('deleted') or []:
+            final.pop(rel_path, None)
+        final.update((rel_path, step) for rel_path in backup_file_paths(backup_path))
+    sources: List[Set[str]] = [set() for _ in chain]
+    for rel_path, step in final.items():
+        sources[step].add(rel_path)
+    return sources
+
+
+def resolve_backup_chain(backup_path: Path) -> List[Path]:
+    """Возвращает цепочку бэкапов от полного до backup_path включительно.
+
+    Инкрементальный бэкап хранит в metadata.base путь к предыдущему бэкапу
+    относительно своей директории.
+    """
+    chain = [backup_path]
+    while True:
+        metadata = read_backup_header(chain[0])[0].get('metadata') or {}
+        if metadata.get('backup_type') != 'incremental':
+            return chain
+        base_path = chain[0].parent / metadata['base']
+        if any(base_path.resolve() == path.resolve() for path in chain):
+            raise ValueError(f"Цепочка инкрементальных бэкапов зациклена на {base_path}")
+        if not base_path.exists():
+            raise FileNotFoundError(errno.ENOENT, "Базовый бэкап не найден", str(base_path))
+        chain.insert(0, base_path)
+
+
+def load_manifest(backup_path: Path) -> Dict[str, List[Any]]:
+    """Загружает манифест бэкапа: из файла рядом с ним или по цепочке самих бэкапов."""
+    sidecar = manifest_path(backup_path)
+    if sidecar.exists():
+        return read_manifest(sidecar)
+    
+    files: Dict[str, List[Any]] = {}
+    shards = read_shard_set(backup_path)
+    if shards is not None:
+        # Набор шардов: пути шарда отсчитываются от его директории target
+        for shard in shards:
+            prefix = shard['target'] + '/' if shard['target'] else ''
+            files.update((prefix + rel_path, known) for rel_path, known in load_manifest(shard['path']).items())
+        return files
+    
+    for path in resolve_backup_chain(backup_path):
+        with open_backup(path) as f:
+            reader = backup_reader(f)
+            reader.read_header()
+            for rel_path in reader.header.get('deleted') or []:
+                files.pop(rel_path, None)
+            for item in reader.iter_entries():
+                if item[0] == 'file':
+                    entry = item[2]
+                    digest = entry.get('blob') or entry.get('hash') or content_hash(entry_bytes(entry))
+                    files[item[1]] = [entry.get('size'), entry.get('modified'), digest]
+    return files
+
+
+def index_path(backup_path: Path) -> Path:
+    """Путь к индексу смещений, который create кладет рядом с бэкапом."""
+    return backup_path.with_name(backup_path.name + '.index')
+
+
+def write_index(path: Path, entries: Dict[str, List[Any]], header: Dict[str, Any]) -> None:
+    """Записывает индекс: строка заголовка и по строке JSON на файл, по порядку путей.
+
+    Строка файла — [путь, смещение, длина] его записи в несжатом потоке бэкапа,
+    для дедуплицированного бэкапа дополненная смещением и длиной блоба.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'format': INDEX_FORMAT, 'version': 1, **header}, ensure_ascii=False) + '\n')
+        for rel_path in sorted(entries):
+            f.write(json.dumps([rel_path] + entries[rel_path], ensure_ascii=False) + '\n')
+
+
+def lookup_index(index: BinaryIO, rel_path: str) -> Optional[List[Any]]:
+    """Ищет строку файла в индексе двоичным поиском по байтам, не читая индекс целиком."""
+    index.seek(0)
+    index.readline()
+    lo = index.tell()
+    hi = index.seek(0, os.SEEK_END)
+    # Все строки, начинающиеся до lo, меньше искомой, а начинающиеся с hi — больше
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mid > lo:
+            # Переходим к началу первой строки не раньше mid
+            index.seek(mid - 1)
+            index.readline()
+        else:
+            index.seek(lo)
+        start = index.tell()
+        if start >= hi:
+            hi = mid
+            continue
+        record: List[Any] = json.loads(index.readline())
+        if record[0] == rel_path:
+            return record[1:]
+        if record[0] < rel_path:
+            lo = index.tell()
+        else:
+            hi = start
+    return None
+
+
+def read_fragment(stream: BackupStream, offset: int, length: int, backup_format: str = 'yaml') -> Any:
+    """Читает одну запись бэкапа по смещению из индекса и возвращает ее значение."""
+    stream.seek(offset)
+    if backup_format == 'records':
+        record = read_record(stream)
+        record.pop('path', None)
+        if record.pop('chunked', False):
+            record['chunks'] = list(read_chunks(stream, record))
+        if record.get('type') == 'blob':
+            # Блоб дополняет запись файла, поэтому его тип и ключ не нужны
+            del record['type'], record['digest']
+        return record
+    data = yaml.load(stream.read(length).decode('utf-8'), Loader=YAML_LOADER)
+    if not isinstance(data, dict) or len(data) != 1:
+        raise ValueError("Индекс не соответствует бэкапу")
+    return next(iter(data.values()))
+
+
+def read_indexed_entries(backup_path: Path, rel_paths: Iterable[str]) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Читает записи файлов по индексу; None, если индекса нет или он устарел.
+
+    Фрагменты читаются по возрастанию смещений, чтобы сжатый поток
+    распаковывался только вперед и не дальше последней нужной записи.
+    """
+    sidecar = index_path(backup_path)
+    if not sidecar.exists():
+        return None
+    with open(sidecar, 'rb') as index:
+        header = json.loads(index.readline() or b'{}')
+        if header.get('format') != INDEX_FORMAT or header.get('backup_size') != backup_path.stat().st_size:
+            return None
+        records = {rel_path: lookup_index(index, rel_path) for rel_path in rel_paths}
+    
+    # (смещение, длина, путь): запись файла и, для dedup, его блоб
+    fragments = []
+    for rel_path, record in records.items():
+        if record is not None:
+            fragments.append((record[0], record[1], rel_path))
+            if len(record) > 2:
+                fragments.append((record[2], record[3], rel_path))
+    fragments.sort()
+    
+    found: Dict[str, Dict[str, Any]] = {}
+    backup_format = header.get('backup_format', 'yaml')
+    with open_backup(backup_path) as f:
+        for offset, length, rel_path in fragments:
+            found.setdefault(rel_path, {}).update(read_fragment(f, offset, length, backup_format))
+    return found
+
+
+def scan_backup_entries(backup_path: Path, rel_paths: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Находит записи файлов потоковым чтением бэкапа — для бэкапов без индекса."""
+    wanted = set(rel_paths)
+    found: Dict[str, Dict[str, Any]] = {}
+    with open_backup(backup_path) as f:
+        reader = backup_reader(f)
+        reader.read_header()
+        for item in reader.iter_entries():
+            if item[0] == 'file' and item[1] in wanted:
+                found[item[1]] = item[2]
+                owners = []
+            elif item[0] == 'blob':
+                owners = [entry for entry in found.values() if entry.get('blob') == item[1]]
+                if not owners:
+                    continue
+            else:
+                continue
+            if item[2].get('chunks') is not None:
+                # Ленивые фрагменты нужно прочитать до перехода к следующей записи
+                item[2]['chunks'] = list(item[2]['chunks'])
+            for entry in owners:
+                entry.update(item[2])
+            if len(found) == len(wanted) and all(has_content(entry) for entry in found.values()):
+                break
+    return found
+
+
+def check_backup(backup_path: Path, jobs: int = 1) -> Dict[str, Any]:
+    """Проверяет целостность одного файла бэкапа за один проход потокового чтения.
+
+    Контрольная сумма файла считается по мере разбора, а хеши записей
+    сверяются в пуле потоков (фрагменты больших файлов — в вызывающем потоке,
+    по мере чтения). Возвращает digest (True/False — совпала ли сумма, None —
+    ее нет), checked и unverified (записи с хешем и без), corrupted (пути и
+    ключи поврежденных записей) и error (ошибка разбора или None).
+    """
+    result: Dict[str, Any] = {'digest': None, 'checked': 0, 'unverified': 0, 'corrupted': [], 'error': None}
+    
+    def contents(reader: Union[BackupYamlReader, BackupRecordsReader]) -> Iterator[Tuple[str, Any, Any]]:
+        # (имя, запись или хеш фрагментов, ключ блоба); ссылки на блобы без содержимого пропускаются
+        for item in reader.iter_entries():
+            if item[0] == 'dir' or not has_content(item[2]):
+                continue
+            entry = item[2]
+            blob = item[1] if item[0] == 'blob' else None
+            name = f'блоб {blob}' if blob else item[1]
+            if entry.get('chunks') is not None:
+                digest = hashlib.blake2b(digest_size=16)
+                for chunk in iter_chunks(entry, raw=True):
+                    digest.update(chunk)
+                yield name, entry, (blob, digest.hexdigest())
+            else:
+                yield name, entry, (blob, None)
+    
+    def verify(item: Tuple[str, Any, Any]) -> Tuple[str, Optional[str], str]:
+        name, entry, (blob, actual) = item
+        return name, blob or entry.get('hash'), actual or content_hash(entry_bytes(entry))
+    
+    with open_backup(backup_path) as f:
+        backup_format = 'records' if f.peek(len(RECORDS_MAGIC)).startswith(RECORDS_MAGIC) else 'yaml'
+        stream = DigestReader(f, len(backup_trailer(backup_format, '0' * 32)))
+        reader = BackupRecordsReader(stream) if backup_format == 'records' else BackupYamlReader(stream)
+        try:
+            reader.read_header()
+            for name, expected, actual in parallel_map(verify, contents(reader), jobs):
+                if expected is None:
+                    result['unverified'] += 1
+                    continue
+                result['checked'] += 1
+                if actual != expected:
+                    result['corrupted'].append(name)
+            # Дочитываем поток до конца, чтобы хвостом оказалась последняя строка
+            while stream.read(WRITE_BUFFER_SIZE):
+                pass
+        except (yaml.YAMLError, ValueError, EOFError, OSError, lzma.LZMAError) as e:
+            result['error'] = str(e)
+            return result
+    
+    trailer = backup_trailer(backup_format, stream.hexdigest())
+    prefix = trailer[:trailer.index(stream.hexdigest().encode('ascii'))]
+    if stream.tail == trailer:
+        result['digest'] = True
+    elif stream.tail.startswith(prefix):
+        result['digest'] = False
+    return result
+
+
+def extract_entries(backup_path: Path, rel_paths: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Находит записи файлов в бэкапе с учетом цепочки инкрементов.
+
+    Бэкапы цепочки просматриваются от последнего к полному; поиск пути
+    прекращается на бэкапе, который его содержит или отмечает удаленным.
+    В наборе шардов путь ищется в шардах, чей target его содержит.
+    """
+    wanted = set(rel_paths)
+    found: Dict[str, Dict[str, Any]] = {}
+    shards = read_shard_set(backup_path)
+    if shards is not None:
+        for shard in shards:
+            prefix = shard['target'] + '/' if shard['target'] else ''
+            local = {rel_path[len(prefix):]: rel_path for rel_path in wanted
+                     if rel_path.startswith(prefix) and rel_path not in found}
+            if local:
+                for rel_path, entry in extract_entries(shard['path'], local).items():
+                    found[local[rel_path]] = entry
+        return found
+    
+    for path in reversed(resolve_backup_chain(backup_path)):
+        if not wanted:
+            break
+        entries = read_indexed_entries(path, wanted)
+        if entries is None:
+            entries = scan_backup_entries(path, wanted)
+        found.update(entries)
+        wanted.difference_update(entries)
+        if wanted:
+            wanted.difference_update(read_backup_header(path)[0].get('deleted') or [])
+    return found
+
+
+def diff_structure(root_path: Path, structure: Dict[str, Any], manifest: Dict[str, List[Any]],
+                   checksum: bool = False,
+                   jobs: int = 1) -> Tuple[Dict[str, Any], List[str], Dict[str, List[Any]]]:
+    """Сравнивает скелет структуры с манифестом базового бэкапа.
+
+    Файл считается неизмененным, если совпали размер и mtime. С checksum файлы того
+    же размера, но с другим mtime, дополнительно сверяются по хешу содержимого
+    (при jobs > 1 — в пуле потоков); остальные файлы не читаются.
+    Возвращает (структура только с новыми и измененными файлами, удаленные пути,
+    манифест неизмененных файлов).
+    """
+    unchanged: Dict[str, List[Any]] = {}
+    seen = set()
+    
+    def needs_hash(rel_path: str, entry: Dict[str, Any]) -> bool:
+        known = manifest.get(rel_path)
+        return (known is not None and known[0] == entry['size'] and known[1] != entry['modified']
+                and known[2] is not None)
+    
+    hashes: Dict[str, str] = {}
+    if checksum:
+        candidates = [rel_path for rel_path, entry in iter_structure_files(structure) if needs_hash(rel_path, entry)]
+        hashes = dict(zip(candidates, parallel_map(lambda rel_path: hash_file(root_path / rel_path),
+                                                   candidates, jobs)))
+    
+    def is_unchanged(rel_path: str, entry: Dict[str, Any], known: List[Any]) -> bool:
+        if known[0] != entry['size']:
+            return False
+        if known[1] == entry['modified']:
+            return True
+        return hashes.get(rel_path) == known[2] and known[2] is not None
+    
+    # Стек отфильтрованных директорий, параллельный обходу walk_structure
+    results: List[Dict[str, Any]] = [{}]
+    for kind, rel_path, name, entry in walk_structure(structure):
+        if kind == 'file':
+            seen.add(rel_path)
+            known = manifest.get(rel_path)
+            if known and is_unchanged(rel_path, entry, known):
+                unchanged[rel_path] = [entry['size'], entry['modified'], known[2]]
+            else:
+                results[-1][name] = entry
+        elif kind == 'begin':
+            results.append({})
+        else:
+            # Пустые директории сохраняются всегда, чтобы восстановить их в цепочке
+            child = results.pop()
+            if child or not entry:
+                results[-1][name] = child
+    
+    changed = results[0]
+    deleted = sorted(rel_path for rel_path in manifest if rel_path not in seen)
+    return changed, deleted, unchanged
+
+
+def backup_roots(backup_path: Path) -> List[Tuple[Path, str]]:
+    """Корни, с которых снят бэкап: пары (директория, target внутри бэкапа).
+
+    У набора шардов корень берется из метаданных каждого шарда.
+    """
+    shards = read_shard_set(backup_path)
+    paths = [backup_path] if shards is None else [shard['path'] for shard in shards]
+    targets = [''] if shards is None else [shard['target'] for shard in shards]
+    roots: List[Tuple[Path, str]] = []
+    for path, target in zip(paths, targets):
+        metadata = read_backup_header(path)[0].get('metadata') or {}
+        if not metadata.get('root_path'):
+            raise ValueError(f"В бэкапе {path} не записан корень проекта — укажите --path")
+        root = (Path(metadata['root_path']), target)
+        if root not in roots:
+            roots.append(root)
+    return roots
+
+
+def compare_tree(backup_path: Path, roots: List[Tuple[Path, str]], rules: Optional[ScanRules] = None,
+                 checksum: bool = False, jobs: int = 1,
+                 stats: Optional[StageStats] = None) -> Dict[str, List[str]]:
+    """Сравнивает дерево на диске с манифестом бэкапа, не читая сам бэкап.
+
+    roots — пары (директория, target), как у backup_roots. Сверяются только
+    размер и mtime из сканирования; содержимое хешируется лишь у файлов с
+    другим mtime при checksum. Возвращает отсортированные списки путей
+    added, removed и modified.
+    """
+    stats = stats or StageStats()
+    with stats.stage('diff'):
+        manifest = load_manifest(backup_path)
+    changes: Dict[str, List[str]] = {'added': [], 'removed': [], 'modified': []}
+    for root_path, target in roots:
+        prefix = target + '/' if target else ''
+        known = manifest if not prefix else {
+            rel_path[len(prefix):]: value for rel_path, value in manifest.items() if rel_path.startswith(prefix)}
+        structure = scan_project(root_path, backup_path, rules or ScanRules(), stats)['structure']
+        with stats.stage('diff'):
+            changed, deleted, _ = diff_structure(root_path, structure, known, checksum, jobs)
+        for rel_path, _ in iter_structure_files(changed):
+            changes['modified' if rel_path in known else 'added'].append(prefix + rel_path)
+        changes['removed'].extend(prefix + rel_path for rel_path in deleted)
+    return {key: sorted(paths) for key, paths in changes.items()}
+
+
+def create_directory_structure(base_path: Path, structure: Dict[str, Any],
+                               progress_bar: Optional[Progress] = None,
+                               blobs: Optional[Dict[str, Any]] = None, link: bool = False,
+                               jobs: int = 1) -> int:
+    """Создает структуру директорий и файлов.
+
+    Сначала одним проходом создаются все директории, затем файлы записываются
+    (при jobs > 1 — в пуле потоков). blobs — таблица дедуплицированного бэкапа:
+    содержимое каждого блоба пишется один раз, а остальные файлы с ним
+    копируются (или связываются при link).
+    """
+    writer = RestoreWriter(progress_bar, jobs, link, blobs)
+    
+    try:
+        base_path.mkdir(parents=True, exist_ok=True)
+        for kind, rel_path, _, _ in walk_structure(structure):
+            if kind == 'begin':
+                writer.make_dir(base_path / rel_path)
+        
+        for rel_path, entry in iter_structure_files(structure):
+            writer.write_entry(base_path / rel_path, entry)
+    finally:
+        created_files = writer.close()
+    
+    return created_files
+
+
+class NullProgress:
+    """Прогресс-бар без вывода: в дочернем процессе восстановление не печатает каждый файл."""
+
+    def update(self, n_steps: int) -> None:
+        pass
+
+
+def scan_project(root_path: Path, output_path: Path, rules: ScanRules, stats: StageStats,
+                 top_level: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """Сканирует проект для create: скелет структуры без содержимого файлов.
+
+    Сам файл бэкапа, если он сохраняется внутрь проекта, из структуры убирается.
+    Правила отбора записываются в metadata.rules.
+    """
+    with stats.stage('scan'):
+        project_structure = scan_directory(root_path, read_content=False, rules=rules, top_level=top_level)
+    metadata = project_structure['metadata']
+    metadata['rules'] = rules.as_dict()
+    
+    # Бэкап, сохраняемый внутрь проекта, не должен попасть сам в себя
+    try:
+        own_path = output_path.resolve().relative_to(root_path).as_posix()
+    except ValueError:
+        own_path = None
+    if own_path and remove_structure_file(project_structure['structure'], own_path):
+        metadata['total_files'] -= 1
+    stats.add('scan', files=metadata['total_files'],
+              nbytes=sum(entry['size'] for _, entry in iter_structure_files(project_structure['structure'])))
+    return project_structure
+
+
+def make_incremental(project_structure: Dict[str, Any], root_path: Path, base_path: Path,
+                     output_path: Path, checksum: bool = False, stats: Optional[StageStats] = None,
+                     jobs: int = 1) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, List[Any]]]:
+    """Оставляет в структуре только новые и измененные файлы относительно base_path.
+
+    Возвращает (структура инкремента, разделы заголовка с deleted, манифест
+    неизмененных файлов).
+    """
+    stats = stats or StageStats()
+    with stats.stage('diff'):
+        changed, deleted, unchanged = diff_structure(
+            root_path, project_structure['structure'], load_manifest(base_path), checksum, jobs)
+    metadata = project_structure['metadata']
+    mark_incremental(metadata, base_path, output_path, sum(1 for _ in iter_structure_files(changed)), len(deleted))
+    return {'metadata': metadata, 'structure': changed}, {'deleted': deleted}, unchanged
+
+
+def mark_incremental(metadata: Dict[str, Any], base_path: Path, output_path: Path,
+                     changed_files: int, deleted_files: int) -> None:
+    """Помечает метаданные как инкремент: base — путь к базе относительно директории бэкапа."""
+    metadata['backup_type'] = 'incremental'
+    metadata['base'] = os.path.relpath(base_path.resolve(), output_path.resolve().parent)
+    metadata['changed_files'] = changed_files
+    metadata['deleted_files'] = deleted_files
+
+
+def save_backup(output_path: Path, root_path: Path, project_structure: Dict[str, Any],
+                progress_bar: Optional[Progress] = None, jobs: int = 1, sections: Optional[Dict[str, Any]] = None,
+                dedup: bool = False, backup_format: str = 'yaml', level: Optional[int] = None,
+                stats: Optional[StageStats] = None,
+                unchanged: Optional[Dict[str, List[Any]]] = None,
+                delta_manifest: bool = False) -> Dict[str, Any]:
+    """Пишет файл бэкапа, а рядом с ним — манифест и индекс смещений.
+
+    unchanged — манифест файлов, не попавших в инкремент: манифест описывает
+    полное состояние проекта. С delta_manifest инкремент получает разностный
+    манифест — только свои файлы и deleted со ссылкой на базу, — и его запись
+    не зависит от размера проекта. Возвращает результат write_backup.
+    """
+    stats = stats or StageStats()
+    total_files = project_structure['metadata']['total_files']
+    exclude: List[str] = []
+    while True:
+        try:
+            with backup_output(output_path, level) as f:
+                result = write_backup(f, root_path, project_structure, progress_bar, jobs, sections, dedup,
+                                      backup_format, stats, exclude)
+            break
+        except UnreadableBlob as e:
+            # Ссылки на непрочитанный блоб уже в бэкапе: он пишется заново без этих файлов
+            exclude = e.skipped
+            project_structure['metadata']['total_files'] = total_files
+    
+    with stats.stage('index'):
+        # Манифест описывает полное состояние проекта (разностный — вместе с манифестами
+        # баз), поэтому следующий инкремент сравнивается только с ним, не разбирая бэкапы
+        metadata = project_structure['metadata']
+        header = {'backup_type': metadata.get('backup_type', 'full')}
+        if delta_manifest:
+            manifest = result['manifest']
+            header.update(base=metadata['base'], deleted=(sections or {}).get('deleted') or [])
+        else:
+            manifest = dict(unchanged or {})
+            manifest.update(result['manifest'])
+        write_manifest(manifest_path(output_path), manifest, header)
+        # Индекс смещений позволяет извлекать отдельные файлы без разбора всего бэкапа
+        write_index(index_path(output_path), result['index'],
+                    {'backup_size': output_path.stat().st_size, 'backup_format': backup_format})
+    stats.info['backup_bytes'] = output_path.stat().st_size
+    return result
+
+
+class TreeIndex:
+    """Индекс дерева в памяти для watch: состояние последнего снимка и несохраненные изменения.
+
+    files — путь -> [размер, mtime, хеш], как в манифесте; dirs — директория ('' —
+    корень) -> имена включенных в нее файлов и поддиректорий. Источник событий
+    только помечает директории (mark), а refresh перечитывает помеченные без
+    рекурсии, поэтому обновление стоит пропорционально числу изменений, а не
+    размеру дерева. Изменения копятся в changed, deleted и new_dirs до commit.
+    """
+
+    def __init__(self, root_path: Path, rules: ScanRules, structure: Dict[str, Any],
+                 manifest: Dict[str, List[Any]]):
+        self.root_path = root_path
+        self.rules = rules
+        self.files = manifest
+        self.dirs: Dict[str, set] = {'': set()}
+        for kind, rel_path, name, _ in walk_structure(structure):
+            if kind == 'end':
+                continue
+            self.dirs[rel_path.rpartition('/')[0]].add(name)
+            if kind == 'begin':
+                self.dirs[rel_path] = set()
+        # Цепочки правил директорий (None — исключена), вычисляются при первом обращении
+        self.chains: Dict[str, Optional[Tuple[IgnoreRules, ...]]] = {}
+        # Собственные файлы watch (снимки и их индексы), которые не должны попасть в снимки
+        self.ignored: set = set()
+        # Помеченная директория -> перечитать ли ее поддерево (изменился файл правил)
+        self.dirty: Dict[str, bool] = {}
+        self.changed: Dict[str, Dict[str, Any]] = {}
+        self.deleted: set = set()
+        self.new_dirs: set = set()
+
+    def mark(self, events: Optional[Iterable[Tuple[str, str]]]) -> None:
+        """Помечает директории по событиям (директория, имя); None — перечитать все дерево."""
+        if events is None:
+            self.chains.clear()
+            self.dirty.update(dict.fromkeys(self.dirs, False))
+            return
+        for rel_dir, name in events:
+            if name in self.rules.ignore_files:
+                self.dirty[rel_dir] = True
+            else:
+                self.dirty.setdefault(rel_dir, False)
+
+    def ignore_outputs(self, backup_path: Path) -> None:
+        """Исключает из индекса файл снимка и его манифест и индекс, если они лежат внутри дерева."""
+        for path in (backup_path, manifest_path(backup_path), index_path(backup_path)):
+            try:
+                self.ignored.add(path.resolve().relative_to(self.root_path).as_posix())
+            except ValueError:
+                continue
+
+    def chain_for(self, rel_dir: str) -> Optional[Tuple[IgnoreRules, ...]]:
+        """Цепочка правил директории, как при сканировании; None, если директория исключена."""
+        if rel_dir in self.chains:
+            return self.chains[rel_dir]
+        if rel_dir:
+            parent, _, name = rel_dir.rpartition('/')
+            chain = self.chain_for(parent)
+            if chain is not None and self.rules.is_excluded(chain, rel_dir, name, True):
+                chain = None
+        else:
+            chain = self.rules.root_chain
+        if chain is not None and self.rules.ignore_files:
+            chain = self.rules.extend_chain(chain, os.path.join(self.root_path, rel_dir),
+                                            rel_dir + '/' if rel_dir else '', self.rules.ignore_files)
+        self.chains[rel_dir] = chain
+        return chain
 
+    def list_dir(self, rel_dir: str) -> Optional[Dict[str, Optional[os.stat_result]]]:
+        """Включенные имена директории: stat для файлов, None для поддиректорий.
 
-def should_include_file(file_path: Path) -> bool:
-    """Проверяет, нужно ли включить файл в бэкап."""
-    extensions = {'.py', '.md', '.yml', '.yaml', '.txt', '.json', '.toml', '.cfg', '.ini'}
-    return file_path.suffix.lower() in extensions
+        Возвращает None, если директория исчезла, недоступна или теперь исключена.
+        """
+        chain = self.chain_for(rel_dir)
+        if chain is None:
+            return None
+        try:
+            with os.scandir(os.path.join(self.root_path, rel_dir)) as it:
+                items = list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            if not rel_dir:
+                raise
+            return None
+        prefix = rel_dir + '/' if rel_dir else ''
+        listing: Dict[str, Optional[os.stat_result]] = {}
+        for item in items:
+            rel_path = prefix + item.name
+            try:
+                if item.is_file():
+                    if rel_path not in self.ignored and self.rules.include_file(chain, rel_path, item.name):
+                        listing[item.name] = item.stat()
+                elif item.is_dir() and not self.rules.is_excluded(chain, rel_path, item.name, True):
+                    listing[item.name] = None
+            except FileNotFoundError:
+                # Файл удален во время обхода
+                continue
+        return listing
 
+    def refresh(self, watcher: Any = None) -> int:
+        """Перечитывает помеченные директории и возвращает число найденных изменений.
 
-def read_file_content(file_path: Path) -> str:
-    """Читает содержимое файла с обработкой ошибок кодировки."""
-    encodings = ['utf-8', 'cp1251', 'latin-1']
-    
-    for encoding in encodings:
+        watcher получает add_dir для новых директорий до того, как они прочитаны
+        (файлы, созданные между чтением и подпиской, не теряются), и remove_dir
+        для исчезнувших.
+        """
+        queue: Deque[str] = deque()
+        for rel_dir, deep in self.dirty.items():
+            if not deep:
+                queue.append(rel_dir)
+                continue
+            prefix = rel_dir + '/' if rel_dir else ''
+            subtree = [path for path in self.dirs if path == rel_dir or path.startswith(prefix)]
+            for path in subtree:
+                self.chains.pop(path, None)
+            queue.extend(subtree)
+        self.dirty = {}
+
+        found = 0
+        seen = set()
+        while queue:
+            rel_dir = queue.popleft()
+            if rel_dir in seen or rel_dir not in self.dirs:
+                continue
+            seen.add(rel_dir)
+            listing = self.list_dir(rel_dir)
+            if listing is None:
+                found += self.drop(rel_dir, watcher)
+                continue
+            prefix = rel_dir + '/' if rel_dir else ''
+            names = self.dirs[rel_dir]
+            for name in names.difference(listing):
+                found += self.drop(prefix + name, watcher)
+            for name, item in listing.items():
+                rel_path = prefix + name
+                if item is None:
+                    if rel_path in self.dirs:
+                        continue
+                    if name in names:
+                        # Файл заменен директорией
+                        found += self.drop(rel_path, watcher)
+                    self.dirs[rel_path] = set()
+                    names.add(name)
+                    self.new_dirs.add(rel_path)
+                    if watcher is not None:
+                        watcher.add_dir(rel_path)
+                    queue.append(rel_path)
+                    continue
+                if rel_path in self.dirs:
+                    # Директория заменена файлом
+                    found += self.drop(rel_path, watcher)
+                entry = self.file_entry(rel_path, item)
+                if entry is None:
+                    if name in names:
+                        found += self.drop(rel_path, watcher)
+                    continue
+                previous = self.changed.get(rel_path)
+                known = [previous['size'], previous['modified']] if previous else self.files.get(rel_path, [])[:2]
+                if known != [entry['size'], entry['modified']] or rel_path in self.deleted:
+                    self.changed[rel_path] = entry
+                    self.deleted.discard(rel_path)
+                    names.add(name)
+                    found += 1
+        return found
+
+    def file_entry(self, rel_path: str, item: os.stat_result) -> Optional[Dict[str, Any]]:
+        """Запись файла для структуры снимка с учетом max_file_size; None — файл пропускается."""
+        entry: Dict[str, Any] = {'type': 'file', 'size': item.st_size, 'modified': item.st_mtime,
+                                 'mode': item.st_mode & 0o7777}
+        max_file_size = self.rules.max_file_size
+        if max_file_size is not None and item.st_size > max_file_size:
+            self.rules.oversized.append((rel_path, item.st_size))
+            if self.rules.oversize != 'truncate':
+                return None
+            entry['truncated'] = max_file_size
+        return entry
+
+    def drop(self, rel_path: str, watcher: Any = None) -> int:
+        """Убирает из индекса файл или директорию со всем поддеревом; возвращает число удаленных путей."""
+        if rel_path in self.dirs:
+            prefix = rel_path + '/'
+            subtree = [path for path in self.dirs if path == rel_path or path.startswith(prefix)]
+            files = [path + '/' + name for path in subtree for name in self.dirs[path]
+                     if path + '/' + name not in self.dirs]
+            for path in subtree:
+                del self.dirs[path]
+                self.chains.pop(path, None)
+                self.new_dirs.discard(path)
+                if watcher is not None:
+                    watcher.remove_dir(path)
+        else:
+            files = [rel_path]
+        for path in files:
+            self.changed.pop(path, None)
+            if path in self.files:
+                self.deleted.add(path)
+        parent, _, name = rel_path.rpartition('/')
+        if parent in self.dirs:
+            self.dirs[parent].discard(name)
+        return len(files)
+
+    def pending(self) -> bool:
+        """Есть ли изменения, еще не попавшие в снимок."""
+        return bool(self.changed or self.deleted or self.new_dirs)
+
+    def snapshot_structure(self) -> Dict[str, Any]:
+        """Скелет структуры инкремента: измененные и новые файлы, новые и опустевшие директории.
+
+        Директория, из которой удален последний файл, пишется явно, как пустая
+        директория в create --incremental: иначе восстановление цепочки удалит ее
+        вместе с этим файлом.
+        """
+        structure: Dict[str, Any] = {}
+        emitted = set(self.new_dirs)
+        for rel_path in self.deleted:
+            parent = rel_path.rpartition('/')[0]
+            while parent and parent not in self.dirs:
+                parent = parent.rpartition('/')[0]
+            if parent and not self.dirs[parent]:
+                emitted.add(parent)
+        for rel_path in sorted(emitted):
+            node = structure
+            for part in rel_path.split('/'):
+                node = node.setdefault(part, {})
+        for rel_path in sorted(self.changed):
+            *dirs, name = rel_path.split('/')
+            node = structure
+            for part in dirs:
+                node = node.setdefault(part, {})
+            node[name] = dict(self.changed[rel_path])
+        return structure
+
+    def unchanged(self) -> Dict[str, List[Any]]:
+        """Манифест файлов, не попавших в снимок (удаленные исключены)."""
+        if not self.deleted:
+            return self.files
+        return {rel_path: value for rel_path, value in self.files.items() if rel_path not in self.deleted}
+
+    def commit(self, manifest: Dict[str, List[Any]]) -> None:
+        """Переносит записанный снимок в индекс: manifest — результат write_backup."""
+        for rel_path in self.deleted:
+            self.files.pop(rel_path, None)
+        self.files.update(manifest)
+        self.changed.clear()
+        self.deleted.clear()
+        self.new_dirs.clear()
+
+    def total_files(self) -> int:
+        """Число файлов в дереве с учетом несохраненных изменений."""
+        return (len(self.files) - len(self.deleted)
+                + sum(1 for rel_path in self.changed if rel_path not in self.files))
+
+    def memory(self) -> int:
+        """Приблизительный объем индекса в памяти, байт."""
+        size = sys.getsizeof(self.files) + sys.getsizeof(self.dirs)
+        for rel_path, value in self.files.items():
+            size += sys.getsizeof(rel_path) + sys.getsizeof(value) + sum(map(sys.getsizeof, value))
+        for rel_dir, names in self.dirs.items():
+            size += sys.getsizeof(rel_dir) + sys.getsizeof(names) + sum(map(sys.getsizeof, names))
+        return size
+
+
+class InotifyWatcher:
+    """Источник событий на inotify (Linux, через ctypes): по наблюдению на директорию индекса.
+
+    read отдает пары (директория, имя); при переполнении очереди ядра — None,
+    и индекс перечитывается целиком. Если наблюдение поставить не удалось
+    (обычно исчерпан fs.inotify.max_user_watches), в failed сохраняется errno.
+    """
+
+    def __init__(self, root_path: Path):
         try:
-            with open(file_path, 'r', encoding=encoding) as f:
-                return f.read()
-        except UnicodeDecodeError:
-            continue
-    
-    return f"<ОШИБКА: Не удалось прочитать файл {file_path}>"
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.init1 = libc.inotify_init1
+            self.add_watch = libc.inotify_add_watch
+            self.rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError, TypeError):
+            raise OSError(errno.ENOSYS, "inotify не поддерживается системой")
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = self.init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.root_path = root_path
+        self.watches: Dict[int, str] = {}
+        self.paths: Dict[str, int] = {}
+        self.events = 0
+        self.failed = 0
 
+    def add_dir(self, rel_dir: str) -> None:
+        """Подписывается на события директории."""
+        wd = self.add_watch(self.fd, os.fsencode(os.path.join(self.root_path, rel_dir)), INOTIFY_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # Исчезнувшую или недоступную директорию индекс уберет при следующем чтении родителя
+            if err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                self.failed = err
+            return
+        self.watches[wd] = rel_dir
+        self.paths[rel_dir] = wd
 
-def scan_directory_optimized(root_path: Path) -> Dict[str, Any]:
-    """Оптимизированное сканирование директории с пропуском исключаемых папок."""
-    project_structure = {
-        'metadata': {
-            'root_path': str(root_path.absolute()),
-            'backup_date': str(Path().cwd()),
-            'total_files': 0,
-            'total_directories': 0
-        },
-        'structure': {}
-    }
-    
-    files_count = 0
-    dirs_count = 0
-    
-    def scan_recursive(current_path: Path, current_structure: Dict[str, Any]):
-        nonlocal files_count, dirs_count
-        
+    def remove_dir(self, rel_dir: str) -> None:
+        """Снимает наблюдение с директории, убранной из индекса."""
+        wd = self.paths.pop(rel_dir, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            self.rm_watch(self.fd, wd)
+
+    def read(self, timeout: float) -> Optional[List[Tuple[str, str]]]:
+        """Ждет события до timeout секунд и возвращает их (пустой список — событий не было)."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events: List[Tuple[str, str]] = []
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            self.events += 1
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif mask & IN_IGNORED:
+                # Ядро само сняло наблюдение с удаленной директории
+                rel_dir = self.watches.pop(wd, None)
+                if rel_dir is not None and self.paths.get(rel_dir) == wd:
+                    del self.paths[rel_dir]
+            elif wd in self.watches:
+                events.append((self.watches[wd], name))
+        return None if overflow else events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Запасной источник событий: раз в interval секунд просит перечитать весь индекс.
+
+    Содержимое файлов при этом не читается — только stat каждого файла.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_poll = time.monotonic() + interval
+        self.events = 0
+        self.failed = 0
+
+    def add_dir(self, rel_dir: str) -> None:
+        pass
+
+    def remove_dir(self, rel_dir: str) -> None:
+        pass
+
+    def read(self, timeout: float) -> Optional[List[Tuple[str, str]]]:
+        """Ждет до timeout секунд; когда подошел срок опроса, возвращает None."""
+        now = time.monotonic()
+        if self.next_poll > now:
+            time.sleep(min(timeout, self.next_poll - now))
+            if self.next_poll > time.monotonic():
+                return []
+        self.next_poll = time.monotonic() + self.interval
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+def open_watch_source(index: TreeIndex, poll: bool, interval: float) -> Union[InotifyWatcher, PollingWatcher]:
+    """inotify с наблюдением на каждую директорию индекса, а если он недоступен — опрос."""
+    if not poll:
         try:
-            for item in current_path.iterdir():
-                if item.is_file() and should_include_file(item):
-                    # Обрабатываем файл
-                    content = read_file_content(item)
-                    current_structure[item.name] = {
-                        'type': 'file',
-                        'content': content,
-                        'size': item.stat().st_size,
-                        'modified': item.stat().st_mtime
-                    }
-                    files_count += 1
-                    
-                elif item.is_dir():
-                    # Проверяем, нужно ли пропустить директорию
-                    if should_skip_directory(item.name):
+            source = InotifyWatcher(index.root_path)
+        except OSError as e:
+            click.echo(f"⚠ inotify недоступен ({e.strerror}), опрос каждые {interval} с", err=True)
+        else:
+            for rel_dir in index.dirs:
+                source.add_dir(rel_dir)
+            if not source.failed:
+                # Изменения между сканированием и подпиской подхватит первое чтение индекса
+                index.mark(None)
+                return source
+            source.close()
+            click.echo(f"⚠ Не удалось следить за всеми директориями ({os.strerror(source.failed)}), "
+                       f"опрос каждые {interval} с", err=True)
+    return PollingWatcher(interval)
+
+
+class WatchSession:
+    """Цикл watch: события источника -> индекс -> отложенные инкрементальные снимки.
+
+    Снимок пишется, когда события затихли на debounce секунд, но не позже
+    max_delay секунд после первого несохраненного события. Каждый снимок —
+    инкремент к предыдущему (backup.yml, backup.0001.yml, backup.0002.yml...),
+    так что restore последнего применяет всю цепочку. save_options — аргументы
+    save_backup: jobs, dedup, backup_format, level.
+    """
+
+    def __init__(self, index: TreeIndex, source: Union[InotifyWatcher, PollingWatcher], output_path: Path,
+                 metadata: Dict[str, Any], debounce: float, interval: float, save_options: Dict[str, Any],
+                 stats: StageStats, max_delay: Optional[float] = None):
+        self.index = index
+        self.source = source
+        self.output_path = output_path
+        self.base_path = output_path
+        self.metadata = metadata
+        self.debounce = debounce
+        self.interval = interval
+        self.max_delay = max_delay if max_delay is not None else max(debounce * 10, 1.0)
+        self.save_options = save_options
+        self.stats = stats
+        self.started = time.perf_counter()
+        self.snapshots = 0
+        self.events = 0
+        self.changes = 0
+        self.flush_seconds: List[float] = []
+
+    def run(self, count: Optional[int] = None, duration: Optional[float] = None) -> None:
+        """Следит за деревом до count снимков, duration секунд или Ctrl+C; несохраненное дописывается."""
+        deadline = None if duration is None else time.monotonic() + duration
+        # Время первого и последнего несохраненного события
+        first: Optional[float] = time.monotonic() if self.index.dirty else None
+        last = first
+        try:
+            while count is None or self.snapshots < count:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                if first is not None and last is not None:
+                    if now - last >= self.debounce or now - first >= self.max_delay:
+                        first = last = None if self.flush() else now
                         continue
-                    
-                    # Создаем директорию в структуре
-                    if item.name not in current_structure:
-                        current_structure[item.name] = {}
-                        dirs_count += 1
-                    
-                    # Рекурсивно сканируем только если не пропускаем
-                    scan_recursive(item, current_structure[item.name])
-                    
-        except PermissionError:
-            # Пропускаем директории без доступа
-            pass
-    
-    scan_recursive(root_path, project_structure['structure'])
-    
-    project_structure['metadata']['total_files'] = files_count
-    project_structure['metadata']['total_directories'] = dirs_count
-    
-    return project_structure
+                    timeout = min(last + self.debounce, first + self.max_delay) - now
+                else:
+                    timeout = 1.0
+                if deadline is not None:
+                    timeout = min(timeout, deadline - now)
+                events = self.source.read(max(timeout, 0.0))
+                if events is None or events:
+                    self.index.mark(events)
+                    last = time.monotonic()
+                    first = first or last
+        except KeyboardInterrupt:
+            click.echo()
+        if (count is None or self.snapshots < count) and (self.index.dirty or self.index.pending()):
+            self.flush()
 
+    def flush(self) -> bool:
+        """Обновляет индекс и пишет снимок, если есть изменения; False — запись не удалась."""
+        start = time.perf_counter()
+        with self.stats.stage('refresh'):
+            self.changes += self.index.refresh(self.source)
+        rules = self.index.rules
+        report_oversized(rules.oversized, rules.max_file_size, rules.oversize)
+        rules.oversized.clear()
+        if self.source.failed:
+            click.echo(f"⚠ Не удалось следить за новой директорией ({os.strerror(self.source.failed)}), "
+                       f"опрос каждые {self.interval} с", err=True)
+            self.events += self.source.events
+            self.source.close()
+            self.source = PollingWatcher(self.interval)
+        if not self.index.pending():
+            return True
 
-def scan_directory(root_path: Path) -> Dict[str, Any]:
-    """Сканирует директорию и возвращает структуру проекта."""
-    return scan_directory_optimized(root_path)
+        path = sibling_path(self.output_path, f'{self.snapshots + 1:04d}')
+        self.index.ignore_outputs(path)
+        metadata = dict(self.metadata, total_files=self.index.total_files(),
+                        total_directories=len(self.index.dirs) - 1)
+        changed, deleted = len(self.index.changed), sorted(self.index.deleted)
+        mark_incremental(metadata, self.base_path, path, changed, len(deleted))
+        try:
+            result = save_backup(path, self.index.root_path,
+                                 {'metadata': metadata, 'structure': self.index.snapshot_structure()},
+                                 sections={'deleted': deleted}, stats=self.stats,
+                                 **self.save_options, **self.manifest_options())
+        except OSError as e:
+            # Чаще всего файл удален между чтением индекса и записью: перечитываем его директорию
+            click.echo(f"⚠ Снимок {path.name} не записан: {e}", err=True)
+            self.index.mark((rel_path.rpartition('/')[0], '') for rel_path in self.index.changed)
+            return False
+        self.index.commit(result['manifest'])
+        self.base_path = path
+        self.snapshots += 1
+        seconds = time.perf_counter() - start
+        self.flush_seconds.append(seconds)
+        click.echo(f"📸 {path.name}: изменено {changed}, удалено {len(deleted)} ({seconds * 1000:.0f} мс)")
+        return True
+
+    def manifest_options(self) -> Dict[str, Any]:
+        """Аргументы манифеста для следующего снимка: разностный, а каждый WATCH_MANIFEST_INTERVAL-й — полный."""
+        if (self.snapshots + 1) % WATCH_MANIFEST_INTERVAL == 0:
+            return {'unchanged': self.index.unchanged()}
+        return {'delta_manifest': True}
+
+    def counters(self) -> Dict[str, Any]:
+        """Счетчики для отчета и --stats-json: события, задержка записи снимка, память индекса."""
+        elapsed = time.perf_counter() - self.started
+        events = self.events + self.source.events
+        return {
+            'events': events,
+            'events_per_second': events / elapsed if elapsed else 0.0,
+            'changes': self.changes,
+            'snapshots': self.snapshots,
+            'flush_seconds_avg': sum(self.flush_seconds) / len(self.flush_seconds) if self.flush_seconds else None,
+            'flush_seconds_max': max(self.flush_seconds, default=None),
+            'index_files': len(self.index.files),
+            'index_bytes': self.index.memory(),
+        }
+
+
+def plan_shards(root_path: Path, rules: ScanRules) -> List[Tuple[str, List[str]]]:
+    """Делит корень на шарды: по одному на директорию верхнего уровня и ROOT_SHARD на файлы корня.
+
+    Возвращает (имя шарда, имена в корне, которые он охватывает); исключенные
+    правилами директории шардов не образуют.
+    """
+    with os.scandir(root_path) as it:
+        items = sorted(it, key=lambda item: item.name)
+    chain = rules.extend_chain(rules.root_chain, str(root_path), '',
+                               (item.name for item in items if item.name in rules.ignore_files))
+    shards = []
+    files = []
+    for item in items:
+        if item.is_dir():
+            if not rules.is_excluded(chain, item.name, item.name, True):
+                shards.append((item.name, [item.name]))
+        elif item.is_file() and rules.include_file(chain, item.name, item.name):
+            files.append(item.name)
+    if files:
+        shards.append((ROOT_SHARD, files))
+    return shards
+
+
+def shard_file_path(output_path: Path, name: str, used: set) -> Path:
+    """Путь к файлу шарда рядом с манифестом набора: backup.yml.gz -> backup.<шард>.yml.gz."""
+    label = '-'.join('root' if part == ROOT_SHARD else re.sub(r'[^\w.-]+', '_', part)
+                     for part in name.split('/'))
+    candidate = label
+    counter = 1
+    while candidate in used:
+        counter += 1
+        candidate = f'{label}-{counter}'
+    used.add(candidate)
+    return sibling_path(output_path, candidate)
 
 
-def create_directory_structure(base_path: Path, structure: Dict[str, Any], progress_bar=None) -> int:
-    """Рекурсивно создает структуру директорий и файлов."""
+def sibling_path(output_path: Path, label: str) -> Path:
+    """Путь рядом с бэкапом с меткой перед расширением: backup.yml.gz -> backup.<метка>.yml.gz."""
+    compression = output_path.suffix if output_path.suffix.lower() in COMPRESSION_SUFFIXES else ''
+    core = PurePosixPath(output_path.name[:len(output_path.name) - len(compression)])
+    return output_path.with_name(f'{core.stem}.{label}{core.suffix}{compression}')
+
+
+def create_shard(task: Dict[str, Any]) -> Dict[str, Any]:
+    """Создает бэкап одного шарда; выполняется в отдельном процессе.
+
+    task — словарь из простых значений (пути строками, аргументы ScanRules), чтобы
+    его можно было передать в процесс. Шард — обычный бэкап со своими манифестом
+    и индексом. Возвращает сводку для манифеста набора и статистику этапов.
+    """
+    stats = StageStats()
+    rules = ScanRules(**task['rules'])
+    root_path = Path(task['root'])
+    output_path = Path(task['output'])
+    project_structure = scan_project(root_path, output_path, rules, stats, task['top_level'])
+    metadata = project_structure['metadata']
+    metadata['shard'] = task['name']
+    sections: Dict[str, Any] = {}
+    unchanged: Dict[str, List[Any]] = {}
+    if task['base']:
+        project_structure, sections, unchanged = make_incremental(
+            project_structure, root_path, Path(task['base']), output_path, task['checksum'], stats, task['jobs'])
+    result = save_backup(output_path, root_path, project_structure, None, task['jobs'], sections,
+                         task['dedup'], task['backup_format'], task['level'], stats, unchanged)
+    return {
+        'name': task['name'],
+        'file': output_path.name,
+        'target': task['target'],
+        'files': metadata['total_files'],
+        'directories': metadata['total_directories'],
+        'changed_files': metadata.get('changed_files'),
+        'blobs': result['blobs'],
+        'saved_bytes': result['saved_bytes'],
+        'oversized': rules.oversized,
+        'stats': stats,
+    }
+
+
+def restore_shard(task: Dict[str, Any]) -> Dict[str, Any]:
+    """Восстанавливает один шард вместе с цепочкой его инкрементов; выполняется в отдельном процессе."""
+    stats = StageStats()
+    output_path = Path(task['output'])
+    output_path.mkdir(parents=True, exist_ok=True)
     created_files = 0
+    chain = resolve_backup_chain(Path(task['file']))
+    sources = chain_sources(chain) if task['sync'] and len(chain) > 1 else None
+    final = set().union(*sources) if sources else set()
+    for step, backup_path in enumerate(chain):
+        with open_backup(backup_path) as f:
+            reader = backup_reader(f)
+            reader.read_header()
+            created_files += restore_backup_stream(reader, output_path, NullProgress(), task['link'],
+                                                   task['jobs'], stats, task['sync'], task['checksum'],
+                                                   task['preserve_mtime'], task['verify'],
+                                                   sources[step] if sources else None, final)
+    return {'name': task['name'], 'created_files': created_files, 'stats': stats}
+
+
+def run_processes(func: Callable[[Dict[str, Any]], Dict[str, Any]], tasks: List[Dict[str, Any]],
+                  processes: int) -> Iterator[Dict[str, Any]]:
+    """Выполняет func для каждой задачи в пуле процессов и отдает результаты по мере готовности.
+
+    При processes <= 1 задачи выполняются по очереди в текущем процессе.
+    """
+    if processes <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield func(task)
+        return
     
-    for name, content in structure.items():
-        current_path = base_path / name
-        
-        if isinstance(content, dict) and content.get('type') == 'file':
-            try:
-                current_path.parent.mkdir(parents=True, exist_ok=True)
-                
-                with open(current_path, 'w', encoding='utf-8') as f:
-                    f.write(content['content'])
-                
-                created_files += 1
-                if progress_bar:
-                    progress_bar.update(1)
-                else:
-                    click.echo(f"✓ Создан файл: {current_path}")
-                
-            except Exception as e:
-                click.echo(f"✗ Ошибка при создании файла {current_path}: {e}")
-                
-        elif isinstance(content, dict):
-            try:
-                current_path.mkdir(parents=True, exist_ok=True)
-                if not progress_bar:  # Показываем только если нет прогресс-бара
-                    click.echo(f"📁 Создана директория: {current_path}")
-                
-                created_files += create_directory_structure(current_path, content, progress_bar)
-                
-            except Exception as e:
-                click.echo(f"✗ Ошибка при создании директории {current_path}: {e}")
-    
-    return created_files
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(func, task) for task in tasks]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def write_shard_set(path: Path, metadata: Dict[str, Any], shards: List[Dict[str, Any]],
+                    backup_format: str = 'yaml', level: Optional[int] = None) -> None:
+    """Записывает манифест набора шардов: бэкап с разделами metadata и shards без structure."""
+    with open_backup_output(path, level) as f:
+        writer = BackupRecordsWriter(f) if backup_format == 'records' else BackupYamlWriter(f)
+        writer.write_entry('metadata', metadata)
+        writer.write_entry('shards', shards)
+        writer.finish()
+
+
+def read_shard_set(path: Path) -> Optional[List[Dict[str, Any]]]:
+    """Возвращает шарды набора (с путем к файлу в ключе path) или None для обычного бэкапа."""
+    shards = read_backup_header(path)[0].get('shards')
+    if shards is None:
+        return None
+    return [dict(shard, path=path.parent / shard['file']) for shard in shards]
+
+
+class ByteSize(click.ParamType):
+    """Размер в байтах: число с необязательным суффиксом K, M или G (степени 1024)."""
+
+    name = 'size'
+
+    def convert(self, value: Any, param: Optional[click.Parameter], ctx: Optional[click.Context]) -> int:
+        if isinstance(value, int):
+            return value
+        match = re.fullmatch(r'\s*(\d+)\s*([KMG]?)B?\s*', str(value), re.IGNORECASE)
+        if not match:
+            self.fail(f"{value!r} не похоже на размер (например, 500K, 100M, 2G)", param, ctx)
+        size: int = int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' ')
+        return size
 
 
 @click.group()
 @click.version_option(version='0.1.8')
-def cli():
+def cli() -> None:
     """Simple Backup - Простой инструмент для создания и восстановления бэкапов проектов."""
     pass
 
 
 @cli.command()
 @click.argument('output_file', type=click.Path())
-@click.option('--path', '-p', default='.', help='Путь к корневой директории проекта')
+@click.option('--path', '-p', 'paths', multiple=True, default=['.'],
+              help='Путь к корневой директории проекта (можно повторять: каждый корень — отдельный шард)')
 @click.option('--verbose', '-v', is_flag=True, help='Подробный вывод')
-def create(output_file, path, verbose):
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Число потоков для чтения файлов')
+@click.option('--incremental', '-i', is_flag=True, help='Сохранить только изменения относительно --base')
+@click.option('--base', '-b', type=click.Path(exists=True), help='Предыдущий бэкап для инкрементального режима')
+@click.option('--checksum', is_flag=True, help='Сверять хеш файлов, у которых изменился только mtime')
+@click.option('--dedup', is_flag=True, help='Хранить одинаковые файлы один раз (таблица blobs)')
+@click.option('--level', type=click.IntRange(0, 9), help='Уровень сжатия для .gz, .bz2 и .xz')
+@click.option('--format', 'backup_format', type=click.Choice(BACKUP_FORMATS), default='yaml',
+              show_default=True, help='Формат бэкапа: YAML или плоские записи с сырыми байтами')
+@click.option('--profile', is_flag=True, help='Показать время, объем и скорость по этапам')
+@click.option('--stats-json', type=click.Path(), help='Записать статистику по этапам в JSON ("-" — в stdout)')
+@click.option('--include', multiple=True, help='Дополнительно включать файлы по glob (можно повторять)')
+@click.option('--exclude', multiple=True, help='Исключать пути по шаблону .gitignore (можно повторять)')
+@click.option('--no-gitignore', is_flag=True, help='Не читать .gitignore (.backupignore читается всегда)')
+@click.option('--all-files', is_flag=True, help='Сохранять файлы любых типов, а не только текстовые по расширению')
+@click.option('--max-file-size', type=ByteSize(), help='Предельный размер файла, например 100M')
+@click.option('--oversize', type=click.Choice(OVERSIZE_POLICIES), default='warn', show_default=True,
+              help='Файлы больше --max-file-size: пропустить, пропустить с предупреждением или обрезать')
+@click.option('--shard', is_flag=True, help='Разбить бэкап на шарды по директориям верхнего уровня')
+@click.option('--processes', '-P', type=click.IntRange(min=1),
+              help='Число процессов для шардов (по умолчанию — по числу ядер)')
+@stats_json_output
+def create(output_file: str, paths: Tuple[str, ...], verbose: bool, jobs: int, incremental: bool,
+           base: Optional[str], checksum: bool, dedup: bool, level: Optional[int], backup_format: str,
+           profile: bool, stats_json: Optional[str], include: Tuple[str, ...], exclude: Tuple[str, ...],
+           no_gitignore: bool, all_files: bool, max_file_size: Optional[int], oversize: str, shard: bool,
+           processes: Optional[int]) -> None:
     """Создать бэкап проекта в YAML файл."""
-    root_path = Path(path).resolve()
+    roots = [Path(path).resolve() for path in paths]
     
-    if not root_path.exists():
-        click.echo(f"✗ Ошибка: Директория {root_path} не существует!", err=True)
+    for root_path in roots:
+        if not root_path.exists():
+            click.echo(f"✗ Ошибка: Директория {root_path} не существует!", err=True)
+            raise click.Abort()
+    
+    if incremental and not base:
+        click.echo("✗ Ошибка: Для инкрементального бэкапа укажите предыдущий бэкап через --base!", err=True)
         raise click.Abort()
     
     if verbose:
-        click.echo(f"Сканирование директории: {root_path}")
+        for root_path in roots:
+            click.echo(f"Сканирование директории: {root_path}")
         click.echo("Исключаемые директории: .venv, __pycache__, .git, node_modules, .pytest_cache, .mypy_cache, build, dist")
-        click.echo("Включаемые файлы: .py, .md, .yml, .yaml, .txt, .json, .toml, .cfg, .ini")
+        if all_files:
+            click.echo("Включаемые файлы: все (двоичные сохраняются байтами)")
+        else:
+            click.echo("Включаемые файлы: .py, .md, .yml, .yaml, .txt, .json, .toml, .cfg, .ini")
+        if include:
+            click.echo(f"Дополнительно включаются: {', '.join(include)}")
+        if exclude:
+            click.echo(f"Дополнительно исключаются: {', '.join(exclude)}")
+        click.echo("Файлы правил: .backupignore" + ("" if no_gitignore else ", .gitignore"))
+        if max_file_size is not None:
+            click.echo(f"Предельный размер файла: {max_file_size} байт ({oversize})")
+    
+    # Аргументы правил передаются в процессы шардов, поэтому хранятся простыми значениями
+    rules_args: Dict[str, Any] = {'includes': list(include), 'excludes': list(exclude),
+                                  'ignore_files': ['.backupignore'] if no_gitignore else list(IGNORE_FILES),
+                                  'max_file_size': max_file_size, 'oversize': oversize, 'all_files': all_files}
+    rules = ScanRules(**rules_args)
+    output_path = Path(output_file)
+    base_path = Path(base) if incremental and base is not None else None
     
     try:
+        stats = StageStats()
+        is_shard_set = base_path is not None and read_shard_set(base_path) is not None
+        if shard or len(roots) > 1:
+            create_shard_set(output_path, roots, shard, rules_args, processes, jobs, base_path,
+                             checksum, dedup, level, backup_format, stats)
+            emit_stats(stats, 'create', profile, stats_json)
+            return
+        if is_shard_set:
+            click.echo("✗ Ошибка: Базовый бэкап разбит на шарды — создайте инкремент с --shard!", err=True)
+            raise click.Abort()
+        root_path = roots[0]
+        
         # Этап 1: Сканирование
-        with click.progressbar(length=1, label='Сканирование директории') as bar:
-            project_structure = scan_directory(root_path)
-            bar.update(1)
+        # Содержимое файлов на этом этапе не читается — только структура и размеры
+        click.echo("🔍 Сканирование директории...")
+        project_structure = scan_project(root_path, output_path, rules, stats)
+        metadata = project_structure['metadata']
+        click.echo(f"   найдено файлов: {metadata['total_files']}, директорий: {metadata['total_directories']}, "
+                   f"{stats.stages['scan']['bytes'] / 1024 / 1024:.1f} MB")
+        report_oversized(rules.oversized, max_file_size, oversize)
+        sections: Dict[str, Any] = {}
+        unchanged: Dict[str, List[Any]] = {}
         
-        # Этап 2: Сохранение в YAML
-        output_path = Path(output_file)
-        click.echo("💾 Сохранение в YAML файл...")
+        # Инкрементальный режим: в бэкап попадают только новые и измененные файлы
+        if base_path is not None:
+            project_structure, sections, unchanged = make_incremental(
+                project_structure, root_path, base_path, output_path, checksum, stats, jobs)
         
-        # Показываем прогресс для записи YAML (более честно)
-        total_files = project_structure['metadata']['total_files']
-        with click.progressbar(length=total_files, label='Запись YAML файла') as bar:
-            # Сначала записываем в буфер
-            import io
-            buffer = io.StringIO()
-            yaml.dump(project_structure, buffer, default_flow_style=False, 
-                     allow_unicode=True, sort_keys=False, indent=2)
-            
-            # Затем записываем в файл с прогрессом
-            content = buffer.getvalue()
-            lines = content.split('\n')
-            lines_per_file = max(1, len(lines) // total_files) if total_files > 0 else 1
-            
-            with open(output_path, 'w', encoding='utf-8') as f:
-                for i, line in enumerate(lines):
-                    f.write(line + '\n')
-                    # Обновляем прогресс каждые N строк
-                    if i % lines_per_file == 0:
-                        bar.update(1)
+        # Этап 2: Потоковое сохранение
+        if backup_format == 'yaml':
+            click.echo("💾 Сохранение в YAML файл...")
+        else:
+            click.echo("💾 Сохранение в формате records...")
+        
+        # Прогресс считается по байтам исходных файлов, записанных в бэкап
+        total_bytes = sum(entry['size'] for _, entry in iter_structure_files(project_structure['structure']))
+        label = 'Запись YAML файла' if backup_format == 'yaml' else 'Запись бэкапа'
+        bar: Progress
+        with click.progressbar(length=total_bytes, label=label) as bar:
+            result = save_backup(output_path, root_path, project_structure, bar, jobs, sections, dedup,
+                                 backup_format, level, stats, unchanged)
         
         click.echo(f"\n✓ Бэкап создан успешно!")
         click.echo(f"📄 Файл сохранен: {output_path.absolute()}")
         click.echo(f"📊 Статистика:")
-        click.echo(f"   - Всего файлов: {project_structure['metadata']['total_files']}")
-        click.echo(f"   - Всего директорий: {project_structure['metadata']['total_directories']}")
-        click.echo(f"   - Размер YAML файла: {output_path.stat().st_size / 1024:.1f} KB")
+        click.echo(f"   - Всего файлов: {metadata['total_files']}")
+        click.echo(f"   - Всего директорий: {metadata['total_directories']}")
+        if incremental:
+            click.echo(f"   - Изменено и добавлено файлов: {metadata['changed_files']}")
+            click.echo(f"   - Удалено файлов: {metadata['deleted_files']}")
+        if dedup:
+            click.echo(f"   - Уникальных блобов: {result['blobs']}")
+            click.echo(f"   - Сэкономлено дедупликацией: {result['saved_bytes'] / 1024:.1f} KB")
+        click.echo(f"   - Размер файла бэкапа: {output_path.stat().st_size / 1024:.1f} KB")
+        emit_stats(stats, 'create', profile, stats_json)
         
+    except click.Abort:
+        raise
     except Exception as e:
         click.echo(f"✗ Ошибка при создании бэкапа: {e}", err=True)
         raise click.Abort()
 
 
+def report_oversized(oversized: List[Tuple[str, int]], max_file_size: Optional[int], oversize: str) -> None:
+    """Печатает файлы, превысившие --max-file-size (при политике skip — только их число)."""
+    if not oversized:
+        return
+    truncate = oversize == 'truncate'
+    click.echo(f"   {'обрезано' if truncate else 'пропущено'} файлов больше {max_file_size} байт: "
+               f"{len(oversized)}")
+    if oversize != 'skip':
+        for rel_path, size in oversized:
+            click.echo(f"⚠ {'Обрезан' if truncate else 'Пропущен'} большой файл {rel_path}: "
+                       f"{size / 1024 / 1024:.1f} MB")
+
+
+def create_shard_set(output_path: Path, roots: List[Path], shard: bool, rules: Dict[str, Any],
+                     processes: Optional[int] = None, jobs: int = 1, base_path: Optional[Path] = None,
+                     checksum: bool = False, dedup: bool = False, level: Optional[int] = None,
+                     backup_format: str = 'yaml', stats: Optional[StageStats] = None) -> None:
+    """Создает набор шардов: каждый шард пишется в свой файл отдельным процессом.
+
+    Шард — корень из roots или, при shard, директория верхнего уровня корня
+    (файлы самого корня образуют шард ROOT_SHARD). output_path — манифест набора
+    со списком шардов; target шарда — директория внутри цели восстановления
+    (имя корня, если корней несколько). С base_path каждый шард становится
+    инкрементом одноименного шарда базового набора.
+    """
+    stats = stats or StageStats()
+    base_files: Dict[str, Path] = {}
+    if base_path is not None:
+        base_shards = read_shard_set(base_path)
+        if base_shards is None:
+            click.echo("✗ Ошибка: Базовый бэкап не разбит на шарды!", err=True)
+            raise click.Abort()
+        base_files = {item['name']: item['path'] for item in base_shards}
+    
+    click.echo("🔍 Разбиение на шарды...")
+    scan_rules = ScanRules(**rules)
+    targets: Set[str] = set()
+    used: Set[str] = set()
+    tasks: List[Dict[str, Any]] = []
+    for root_path in roots:
+        target = ''
+        if len(roots) > 1:
+            target = root_path.name or 'root'
+            while target in targets:
+                target = f'{root_path.name or "root"}-{len(targets) + 1}'
+            targets.add(target)
+        groups: List[Tuple[Optional[str], Optional[List[str]]]] = \
+            list(plan_shards(root_path, scan_rules)) if shard else [(None, None)]
+        for top, top_level in groups:
+            name = '/'.join(part for part in (target, top) if part)
+            base_file = base_files.get(name)
+            tasks.append({
+                'name': name, 'root': str(root_path), 'top_level': top_level, 'target': target,
+                'output': str(shard_file_path(output_path, name, used)), 'rules': rules,
+                'base': str(base_file) if base_file is not None else None, 'checksum': checksum,
+                'jobs': jobs, 'dedup': dedup, 'backup_format': backup_format, 'level': level,
+            })
+    if processes is None:
+        processes = min(len(tasks), os.cpu_count() or 1)
+    click.echo(f"   шардов: {len(tasks)}, процессов: {processes}")
+    
+    results: Dict[str, Dict[str, Any]] = {}
+    bar: Progress
+    with click.progressbar(length=len(tasks), label='Запись шардов') as bar:
+        for result in run_processes(create_shard, tasks, processes):
+            stats.merge(result.pop('stats'))
+            results[result['name']] = result
+            bar.update(1)
+    
+    shards = []
+    oversized: List[Tuple[str, int]] = []
+    for task in tasks:
+        result = results[task['name']]
+        prefix = task['target'] + '/' if task['target'] else ''
+        oversized.extend((prefix + rel_path, size) for rel_path, size in result['oversized'])
+        record = {key: result[key] for key in ('name', 'file', 'target', 'files', 'directories')}
+        if result['changed_files'] is not None:
+            record['changed_files'] = result['changed_files']
+        shards.append(record)
+    report_oversized(oversized, rules['max_file_size'], rules['oversize'])
+    
+    metadata = {
+        'backup_type': 'sharded',
+        'roots': [str(root_path) for root_path in roots],
+        'total_files': sum(item['files'] for item in shards),
+        'total_directories': sum(item['directories'] for item in shards),
+    }
+    with stats.stage('index'):
+        write_shard_set(output_path, metadata, shards, backup_format, level)
+    shard_bytes = sum((output_path.parent / item['file']).stat().st_size for item in shards)
+    stats.info['backup_bytes'] = shard_bytes + output_path.stat().st_size
+    
+    click.echo(f"\n✓ Бэкап создан успешно!")
+    click.echo(f"📄 Манифест набора шардов: {output_path.absolute()}")
+    click.echo(f"📊 Статистика:")
+    click.echo(f"   - Шардов: {len(shards)}")
+    click.echo(f"   - Всего файлов: {metadata['total_files']}")
+    click.echo(f"   - Всего директорий: {metadata['total_directories']}")
+    if base_path is not None:
+        click.echo(f"   - Изменено и добавлено файлов: {sum(item.get('changed_files') or 0 for item in shards)}")
+    if dedup:
+        click.echo(f"   - Уникальных блобов: {sum(result['blobs'] for result in results.values())}")
+        click.echo(f"   - Сэкономлено дедупликацией: "
+                   f"{sum(result['saved_bytes'] for result in results.values()) / 1024:.1f} KB")
+    click.echo(f"   - Размер шардов: {shard_bytes / 1024:.1f} KB")
+
+
 @cli.command()
 @click.argument('yaml_file', type=click.Path(exists=True))
 @click.argument('output_dir', type=click.Path())
 @click.option('--preview', '-p', is_flag=True, help='Показать предварительный просмотр')
 @click.option('--force', '-f', is_flag=True, help='Принудительно перезаписать существующую директорию')
 @click.option('--overwrite', '-o', is_flag=True, help='Перезаписать файлы без удаления директорий')
-def restore(yaml_file, output_dir, preview, force, overwrite):
+@click.option('--link', is_flag=True, help='Одинаковые файлы дедуплицированного бэкапа связывать жесткими ссылками')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Число потоков для записи файлов')
+@click.option('--profile', is_flag=True, help='Показать время, объем и скорость по этапам')
+@click.option('--stats-json', type=click.Path(), help='Записать статистику по этапам в JSON ("-" — в stdout)')
+@click.option('--sync', is_flag=True, help='Записывать только файлы, отличающиеся от уже существующих (как --overwrite)')
+@click.option('--checksum', is_flag=True, help='При --sync сверять хеш файлов того же размера с другим mtime')
+@click.option('--preserve-mtime', is_flag=True, help='Восстанавливать исходное время изменения файлов')
+@click.option('--shard', 'shards', multiple=True, help='Восстановить только этот шард набора (можно повторять)')
+@click.option('--processes', '-P', type=click.IntRange(min=1),
+              help='Число процессов для шардов (по умолчанию — по числу ядер)')
+@click.option('--verify', is_flag=True, help='Сверять содержимое файлов с хешами из бэкапа')
+@stats_json_output
+def restore(yaml_file: str, output_dir: str, preview: bool, force: bool, overwrite: bool, link: bool,
+            jobs: int, profile: bool, stats_json: Optional[str], sync: bool, checksum: bool,
+            preserve_mtime: bool, shards: Tuple[str, ...], processes: Optional[int], verify: bool) -> None:
     """Восстановить проект из YAML файла."""
     yaml_path = Path(yaml_file)
     output_path = Path(output_dir)
+    stats = StageStats()
     
     try:
-        with open(yaml_path, 'r', encoding='utf-8') as f:
-            project_data = yaml.safe_load(f)
-        
-        if not project_data or 'structure' not in project_data:
-            click.echo("✗ Неверный формат YAML файла!", err=True)
+        if read_shard_set(yaml_path) is not None:
+            restore_shard_set(yaml_path, output_path, preview, force, overwrite, shards, processes,
+                              link, jobs, stats, sync, checksum, preserve_mtime, verify)
+        elif shards:
+            click.echo("✗ Ошибка: --shard применим только к набору шардов!", err=True)
             raise click.Abort()
-        
-        metadata = project_data.get('metadata', {})
-        
-        if preview:
-            click.echo("🔍 Предварительный просмотр восстановления:")
-            click.echo("=" * 50)
-            click.echo(f"Оригинальный проект: {metadata.get('root_path', 'неизвестно')}")
-            click.echo(f"Дата бэкапа: {metadata.get('backup_date', 'неизвестно')}")
-            click.echo(f"Всего файлов: {metadata.get('total_files', 'неизвестно')}")
-            click.echo(f"Всего директорий: {metadata.get('total_directories', 'неизвестно')}")
-            return
-        
-        if output_path.exists() and not force and not overwrite:
-            if not click.confirm(f"Директория {output_path} уже существует. Удалить и пересоздать?"):
-                click.echo("Отменено пользователем")
-                return
-            else:
-                shutil.rmtree(output_path)
-                click.echo(f"🗑️  Удалена существующая директория: {output_path}")
-        
-        if overwrite:
-            click.echo(f"🔄 Перезапись файлов в: {output_path.absolute()}")
-        else:
-            click.echo(f"🔄 Восстановление проекта в: {output_path.absolute()}")
-        
-        output_path.mkdir(parents=True, exist_ok=True)
-        
-        with click.progressbar(length=metadata.get('total_files', 1), label='Восстановление файлов') as bar:
-            created_files = create_directory_structure(output_path, project_data['structure'], bar)
-        
-        if overwrite:
-            click.echo(f"\n✓ Перезапись завершена!")
         else:
-            click.echo(f"\n✓ Восстановление завершено!")
-        click.echo(f"📊 Статистика:")
-        click.echo(f"   - Создано файлов: {created_files}")
-        click.echo(f"   - Ожидалось файлов: {metadata.get('total_files', 'неизвестно')}")
-        click.echo(f"   - Восстановлено в: {output_path.absolute()}")
+            restore_backup_chain(resolve_backup_chain(yaml_path), output_path, preview, force, overwrite,
+                                 link, jobs, stats, sync, checksum, preserve_mtime, verify)
+        emit_stats(stats, 'restore', profile, stats_json)
+        if stats.info.get('corrupted_files'):
+            # Восстановление доведено до конца, но результат нельзя считать успешным
+            raise SystemExit(1)
         
-    except FileNotFoundError:
-        click.echo(f"✗ Файл {yaml_path} не найден!", err=True)
+    except FileNotFoundError as e:
+        click.echo(f"✗ Файл {e.filename or yaml_path} не найден!", err=True)
         raise click.Abort()
     except yaml.YAMLError as e:
         click.echo(f"✗ Ошибка при чтении YAML файла: {e}", err=True)
         raise click.Abort()
+    except click.Abort:
+        raise
     except Exception as e:
         click.echo(f"✗ Ошибка при восстановлении: {e}", err=True)
         raise click.Abort()
 
 
+def prepare_restore_dir(output_path: Path, force: bool, overwrite: bool, sync: bool) -> bool:
+    """Готовит директорию восстановления; False, если пользователь отказался ее пересоздавать."""
+    if output_path.exists() and not force and not overwrite:
+        if not click.confirm(f"Директория {output_path} уже существует. Удалить и пересоздать?"):
+            click.echo("Отменено пользователем")
+            return False
+        else:
+            shutil.rmtree(output_path)
+            click.echo(f"🗑️  Удалена существующая директория: {output_path}")
+    
+    if sync:
+        click.echo(f"🔄 Синхронизация файлов в: {output_path.absolute()}")
+    elif overwrite:
+        click.echo(f"🔄 Перезапись файлов в: {output_path.absolute()}")
+    else:
+        click.echo(f"🔄 Восстановление проекта в: {output_path.absolute()}")
+    
+    output_path.mkdir(parents=True, exist_ok=True)
+    return True
+
+
+def report_restore(created_files: int, expected_files: Any, stats: StageStats,
+                   sync: bool, overwrite: bool) -> None:
+    """Печатает итог восстановления: созданные (или записанные и пропущенные) файлы."""
+    if sync:
+        click.echo(f"\n✓ Синхронизация завершена!")
+    elif overwrite:
+        click.echo(f"\n✓ Перезапись завершена!")
+    else:
+        click.echo(f"\n✓ Восстановление завершено!")
+    click.echo(f"📊 Статистика:")
+    if sync:
+        click.echo(f"   - Записано файлов: {created_files}")
+        click.echo(f"   - Пропущено без изменений: {stats.stages.get('skip', {}).get('files', 0)}")
+    else:
+        click.echo(f"   - Создано файлов: {created_files}")
+    click.echo(f"   - Ожидалось файлов: {expected_files}")
+    if 'verify' in stats.stages:
+        click.echo(f"   - Проверено по хешу: {stats.stages['verify']['files']}")
+        if stats.info.get('corrupted_files'):
+            click.echo(f"   - Повреждено файлов: {stats.info['corrupted_files']}")
+
+
+def restore_backup_chain(chain: List[Path], output_path: Path, preview: bool,
+                         force: bool, overwrite: bool, link: bool = False, jobs: int = 1,
+                         stats: Optional[StageStats] = None, sync: bool = False,
+                         checksum: bool = False, preserve_mtime: bool = False,
+                         verify: bool = False) -> None:
+    """Восстанавливает полный бэкап и последовательно применяет инкременты цепочки.
+
+    sync работает как overwrite, но пропускает файлы, уже совпадающие с бэкапом;
+    файл пишется и сверяется только из бэкапа с его последней версией, а файлы,
+    удаленные дальше по цепочке, не создаются.
+    """
+    stats = stats or StageStats()
+    overwrite = overwrite or sync
+    header, has_structure = read_backup_header(chain[-1])
+    metadata = header.get('metadata') or {}
+    
+    if not has_structure:
+        click.echo("✗ Неверный формат YAML файла!", err=True)
+        raise click.Abort()
+    
+    if preview:
+        click.echo("🔍 Предварительный просмотр восстановления:")
+        click.echo("=" * 50)
+        click.echo(f"Оригинальный проект: {metadata.get('root_path', 'неизвестно')}")
+        click.echo(f"Дата бэкапа: {metadata.get('backup_date', 'неизвестно')}")
+        click.echo(f"Всего файлов: {metadata.get('total_files', 'неизвестно')}")
+        click.echo(f"Всего директорий: {metadata.get('total_directories', 'неизвестно')}")
+        if len(chain) > 1:
+            click.echo(f"Цепочка бэкапов: {' → '.join(path.name for path in chain)}")
+        return
+    
+    if not prepare_restore_dir(output_path, force, overwrite, sync):
+        return
+    
+    created_files = 0
+    # С sync каждый файл пишется и сверяется один раз — из бэкапа с его последней версией
+    sources = chain_sources(chain) if sync and len(chain) > 1 else None
+    final = set().union(*sources) if sources else set()
+    bar: Progress
+    for step, backup_path in enumerate(chain):
+        with open_backup(backup_path) as f:
+            reader = backup_reader(f)
+            step_metadata = reader.read_header().get('metadata') or {}
+            if step_metadata.get('backup_type') == 'incremental':
+                length = step_metadata.get('changed_files', 1)
+                label = f'Применение {backup_path.name}'
+            else:
+                length = step_metadata.get('total_files', 1)
+                label = 'Восстановление файлов'
+            with click.progressbar(length=length, label=label) as bar:
+                created_files += restore_backup_stream(reader, output_path, bar, link, jobs, stats,
+                                                       sync, checksum, preserve_mtime, verify,
+                                                       sources[step] if sources else None, final)
+    
+    report_restore(created_files, metadata.get('total_files', 'неизвестно'), stats, sync, overwrite)
+    if len(chain) > 1:
+        click.echo(f"   - Применено инкрементов: {len(chain) - 1}")
+    click.echo(f"   - Восстановлено в: {output_path.absolute()}")
+
+
+def restore_shard_set(set_path: Path, output_path: Path, preview: bool, force: bool, overwrite: bool,
+                      names: Iterable[str] = (), processes: Optional[int] = None, link: bool = False,
+                      jobs: int = 1, stats: Optional[StageStats] = None, sync: bool = False,
+                      checksum: bool = False, preserve_mtime: bool = False, verify: bool = False) -> None:
+    """Восстанавливает набор шардов: каждый шард — отдельным процессом в свою директорию target.
+
+    names ограничивает восстановление выбранными шардами. Цепочка инкрементов
+    каждого шарда применяется внутри его процесса.
+    """
+    stats = stats or StageStats()
+    overwrite = overwrite or sync
+    metadata = read_backup_header(set_path)[0].get('metadata') or {}
+    shards = read_shard_set(set_path) or []
+    names = set(names)
+    if names:
+        unknown = sorted(names - {shard['name'] for shard in shards})
+        if unknown:
+            click.echo(f"✗ Шарды не найдены: {', '.join(unknown)}", err=True)
+            raise click.Abort()
+        shards = [shard for shard in shards if shard['name'] in names]
+    expected_files = sum(shard.get('files') or 0 for shard in shards)
+    
+    if preview:
+        click.echo("🔍 Предварительный просмотр восстановления:")
+        click.echo("=" * 50)
+        click.echo(f"Оригинальные проекты: {', '.join(metadata.get('roots') or ['неизвестно'])}")
+        click.echo(f"Всего файлов: {expected_files}")
+        click.echo(f"Шарды ({len(shards)}):")
+        for shard in shards:
+            click.echo(f"   - {shard['name']}: {shard.get('files', '?')} файлов → "
+                       f"{shard['target'] or '.'} ({shard['file']})")
+        return
+    
+    if not prepare_restore_dir(output_path, force, overwrite, sync):
+        return
+    
+    tasks = [{'name': shard['name'], 'file': str(shard['path']), 'output': str(output_path / shard['target']),
+              'link': link, 'jobs': jobs, 'sync': sync, 'checksum': checksum,
+              'preserve_mtime': preserve_mtime, 'verify': verify} for shard in shards]
+    if processes is None:
+        processes = min(len(tasks), os.cpu_count() or 1)
+    created_files = 0
+    bar: Progress
+    with click.progressbar(length=len(tasks), label='Восстановление шардов') as bar:
+        for result in run_processes(restore_shard, tasks, processes):
+            created_files += result['created_files']
+            stats.merge(result['stats'])
+            bar.update(1)
+    
+    report_restore(created_files, expected_files, stats, sync, overwrite)
+    click.echo(f"   - Восстановлено шардов: {len(shards)}")
+    click.echo(f"   - Восстановлено в: {output_path.absolute()}")
+
+
+@cli.command()
+@click.argument('backup_file', type=click.Path(exists=True))
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--output', '-o', default='.', type=click.Path(), help='Директория, куда извлечь файлы')
+@click.option('--stdout', 'to_stdout', is_flag=True, help='Вывести содержимое файлов в stdout')
+def extract(backup_file: str, paths: Tuple[str, ...], output: str, to_stdout: bool) -> None:
+    """Извлечь отдельные файлы из бэкапа, не восстанавливая весь проект."""
+    backup_path = Path(backup_file)
+    output_path = Path(output)
+    rel_paths = [PurePosixPath(path.replace('\\', '/')).as_posix() for path in paths]
+    
+    try:
+        found = extract_entries(backup_path, rel_paths)
+        for rel_path in rel_paths:
+            entry = found.get(rel_path)
+            if entry is None or not has_content(entry):
+                continue
+            if to_stdout:
+                click.get_binary_stream('stdout').write(entry_bytes(entry))
+                continue
+            file_path = output_path / rel_path
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_bytes(entry_bytes(entry))
+            click.echo(f"✓ {file_path}")
+    except FileNotFoundError as e:
+        click.echo(f"✗ Файл {e.filename or backup_path} не найден!", err=True)
+        raise click.Abort()
+    except (yaml.YAMLError, ValueError) as e:
+        click.echo(f"✗ Ошибка при чтении бэкапа: {e}", err=True)
+        raise click.Abort()
+    
+    missing = [rel_path for rel_path in rel_paths if not has_content(found.get(rel_path, {}))]
+    for rel_path in missing:
+        click.echo(f"✗ Файл {rel_path} не найден в бэкапе", err=True)
+    if missing:
+        raise click.Abort()
+
+
+@cli.command()
+@click.argument('input_file', type=click.Path(exists=True))
+@click.argument('output_file', type=click.Path())
+@click.option('--format', 'backup_format', type=click.Choice(BACKUP_FORMATS),
+              help='Формат результата (по умолчанию — другой, чем у исходного бэкапа)')
+@click.option('--level', type=click.IntRange(0, 9), help='Уровень сжатия для .gz, .bz2 и .xz')
+def convert(input_file: str, output_file: str, backup_format: Optional[str], level: Optional[int]) -> None:
+    """Преобразовать бэкап между форматами YAML и records."""
+    input_path = Path(input_file)
+    output_path = Path(output_file)
+    
+    if output_path.exists() and output_path.resolve() == input_path.resolve():
+        click.echo("✗ Ошибка: Бэкап нельзя преобразовать в самого себя!", err=True)
+        raise click.Abort()
+    
+    try:
+        # Инкремент ссылается на базу относительно своей директории — пересчитываем путь
+        metadata = read_backup_header(input_path)[0].get('metadata')
+        if isinstance(metadata, dict) and metadata.get('backup_type') == 'incremental':
+            base_path = (input_path.parent / metadata['base']).resolve()
+            metadata['base'] = os.path.relpath(base_path, output_path.resolve().parent)
+        
+        with open_backup(input_path) as source:
+            reader = backup_reader(source)
+            source_format = 'records' if isinstance(reader, BackupRecordsReader) else 'yaml'
+            if backup_format is None:
+                backup_format = 'yaml' if source_format == 'records' else 'records'
+            with backup_output(output_path, level) as target:
+                writer = BackupRecordsWriter(target) if backup_format == 'records' else BackupYamlWriter(target)
+                index = convert_backup(reader, writer, metadata)
+        
+        write_index(index_path(output_path), index,
+                    {'backup_size': output_path.stat().st_size, 'backup_format': backup_format})
+        if manifest_path(input_path).exists():
+            # Манифест описывает файлы, а не формат, и переносится как есть
+            shutil.copyfile(manifest_path(input_path), manifest_path(output_path))
+    except (yaml.YAMLError, ValueError) as e:
+        click.echo(f"✗ Ошибка при чтении бэкапа: {e}", err=True)
+        raise click.Abort()
+    
+    click.echo(f"✓ Бэкап преобразован: {input_path} ({source_format}) → {output_path} ({backup_format})")
+    click.echo(f"   - Размер файла бэкапа: {output_path.stat().st_size / 1024:.1f} KB")
+
+
+@cli.command(name='list')
+@click.argument('backup_file', type=click.Path(exists=True))
+@click.option('--long', '-l', 'long_format', is_flag=True, help='Показать размер и время изменения')
+def list_files(backup_file: str, long_format: bool) -> None:
+    """Показать файлы, сохраненные в бэкапе."""
+    try:
+        manifest = load_manifest(Path(backup_file))
+    except FileNotFoundError as e:
+        click.echo(f"✗ Файл {e.filename or backup_file} не найден!", err=True)
+        raise click.Abort()
+    except (yaml.YAMLError, ValueError) as e:
+        click.echo(f"✗ Ошибка при чтении бэкапа: {e}", err=True)
+        raise click.Abort()
+    
+    for rel_path in sorted(manifest):
+        if long_format:
+            size, modified = manifest[rel_path][:2]
+            date = time.strftime('%Y-%m-%d %H:%M', time.localtime(modified)) if modified else '-'
+            click.echo(f"{size if size is not None else '-':>10}  {date}  {rel_path}")
+        else:
+            click.echo(rel_path)
+
+
+def backup_rules(backup_path: Path) -> Dict[str, Any]:
+    """Аргументы ScanRules, с которыми снят бэкап (metadata.rules); у старых бэкапов — пустой словарь.
+
+    У набора шардов правила берутся из первого шарда: все шарды сняты с одними правилами.
+    """
+    shards = read_shard_set(backup_path)
+    path = shards[0]['path'] if shards else backup_path
+    metadata = read_backup_header(path)[0].get('metadata') or {}
+    return dict(metadata.get('rules') or {})
+
+
+def compare_backup(backup_file: str, path: Optional[str], include: Tuple[str, ...], exclude: Tuple[str, ...],
+                   no_gitignore: bool, all_files: bool, max_file_size: Optional[int], oversize: Optional[str],
+                   checksum: bool, jobs: int, stats: StageStats) -> Dict[str, List[str]]:
+    """Общая часть verify и diff: сравнивает дерево с бэкапом, печатая ошибки в стиле CLI.
+
+    Файлы отбираются по правилам, записанным в бэкапе при create; опции
+    командной строки дополняют их (include, exclude) или заменяют.
+    """
+    backup_path = Path(backup_file)
+    try:
+        rules_args = backup_rules(backup_path)
+        rules_args['includes'] = list(rules_args.get('includes') or []) + list(include)
+        rules_args['excludes'] = list(rules_args.get('excludes') or []) + list(exclude)
+        if no_gitignore:
+            rules_args['ignore_files'] = ['.backupignore']
+        if all_files:
+            rules_args['all_files'] = True
+        if max_file_size is not None:
+            rules_args['max_file_size'] = max_file_size
+        if oversize is not None:
+            rules_args['oversize'] = oversize
+        rules = ScanRules(**rules_args)
+        roots = [(Path(path).resolve(), '')] if path else backup_roots(backup_path)
+        for root_path, _ in roots:
+            if not root_path.is_dir():
+                click.echo(f"✗ Ошибка: Директория {root_path} не существует!", err=True)
+                raise click.Abort()
+        return compare_tree(backup_path, roots, rules, checksum, jobs, stats)
+    except FileNotFoundError as e:
+        click.echo(f"✗ Файл {e.filename or backup_path} не найден!", err=True)
+        raise click.Abort()
+    except (yaml.YAMLError, ValueError) as e:
+        click.echo(f"✗ Ошибка при чтении бэкапа: {e}", err=True)
+        raise click.Abort()
+
+
+def print_changes(changes: Dict[str, List[str]], as_json: bool) -> None:
+    """Печатает изменения: JSON или строки «A/D/M<TAB>путь» в порядке путей, как git --name-status."""
+    if as_json:
+        click.echo(json.dumps(changes, ensure_ascii=False, indent=2))
+        return
+    codes = {'added': 'A', 'removed': 'D', 'modified': 'M'}
+    lines = sorted((rel_path, codes[kind]) for kind, paths in changes.items() for rel_path in paths)
+    for rel_path, code in lines:
+        click.echo(f"{code}\t{rel_path}")
+
+
+@cli.command()
+@click.argument('backup_file', type=click.Path(exists=True))
+@click.option('--path', '-p', type=click.Path(), help='Дерево для сравнения (по умолчанию — корень, с которого снят бэкап)')
+@click.option('--checksum', is_flag=True, help='Сверять хеш файлов, у которых изменился только mtime')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Число потоков для хеширования')
+@click.option('--json', 'as_json', is_flag=True, help='Вывести изменения в JSON')
+@click.option('--include', multiple=True, help='Дополнительно включать файлы по glob (к правилам бэкапа)')
+@click.option('--exclude', multiple=True, help='Дополнительно исключать пути по шаблону .gitignore (к правилам бэкапа)')
+@click.option('--no-gitignore', is_flag=True, help='Не читать .gitignore')
+@click.option('--all-files', is_flag=True, help='Сравнивать файлы любых типов')
+@click.option('--max-file-size', type=ByteSize(), help='Предельный размер файла (по умолчанию — как при create)')
+@click.option('--oversize', type=click.Choice(OVERSIZE_POLICIES),
+              help='Политика для файлов больше предела (по умолчанию — как при create)')
+@click.option('--profile', is_flag=True, help='Показать время, объем и скорость по этапам')
+def diff(backup_file: str, path: Optional[str], checksum: bool, jobs: int, as_json: bool,
+         include: Tuple[str, ...], exclude: Tuple[str, ...], no_gitignore: bool, all_files: bool,
+         max_file_size: Optional[int], oversize: Optional[str], profile: bool) -> None:
+    """Показать файлы, добавленные, удаленные и измененные с момента бэкапа.
+
+    Файл считается измененным, если у него другой размер или mtime; с --checksum
+    файлы с другим mtime, но тем же размером, сверяются по хешу. Файлы отбираются
+    по правилам, с которыми создан бэкап.
+    """
+    stats = StageStats()
+    changes = compare_backup(backup_file, path, include, exclude, no_gitignore, all_files, max_file_size, oversize,
+                             checksum, jobs, stats)
+    print_changes(changes, as_json)
+    emit_stats(stats, 'diff', profile, None)
+
+
+@cli.command()
+@click.argument('backup_file', type=click.Path(exists=True))
+@click.option('--path', '-p', type=click.Path(), help='Дерево для сравнения (по умолчанию — корень, с которого снят бэкап)')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Число потоков для хеширования')
+@click.option('--json', 'as_json', is_flag=True, help='Вывести расхождения в JSON')
+@click.option('--include', multiple=True, help='Дополнительно включать файлы по glob (к правилам бэкапа)')
+@click.option('--exclude', multiple=True, help='Дополнительно исключать пути по шаблону .gitignore (к правилам бэкапа)')
+@click.option('--no-gitignore', is_flag=True, help='Не читать .gitignore')
+@click.option('--all-files', is_flag=True, help='Сравнивать файлы любых типов')
+@click.option('--max-file-size', type=ByteSize(), help='Предельный размер файла (по умолчанию — как при create)')
+@click.option('--oversize', type=click.Choice(OVERSIZE_POLICIES),
+              help='Политика для файлов больше предела (по умолчанию — как при create)')
+@click.option('--profile', is_flag=True, help='Показать время, объем и скорость по этапам')
+def verify(backup_file: str, path: Optional[str], jobs: int, as_json: bool, include: Tuple[str, ...],
+           exclude: Tuple[str, ...], no_gitignore: bool, all_files: bool, max_file_size: Optional[int],
+           oversize: Optional[str], profile: bool) -> None:
+    """Проверить, что дерево совпадает с бэкапом; при расхождениях код выхода 1.
+
+    Файлы с тем же размером и mtime считаются совпадающими без чтения, а файлы
+    того же размера с другим mtime (например, после restore) сверяются по хешу.
+    """
+    stats = StageStats()
+    changes = compare_backup(backup_file, path, include, exclude, no_gitignore, all_files, max_file_size, oversize,
+                             True, jobs, stats)
+    print_changes(changes, as_json)
+    emit_stats(stats, 'verify', profile, None)
+    mismatches = sum(len(paths) for paths in changes.values())
+    if not as_json:
+        if mismatches:
+            click.echo(f"✗ Расхождений: {mismatches} (добавлено {len(changes['added'])}, "
+                       f"удалено {len(changes['removed'])}, изменено {len(changes['modified'])})", err=True)
+        else:
+            click.echo("✓ Дерево совпадает с бэкапом", err=True)
+    if mismatches:
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.argument('backup_file', type=click.Path(exists=True))
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Число потоков для хеширования')
+def check(backup_file: str, jobs: int) -> None:
+    """Проверить целостность бэкапа: контрольную сумму файла и хеш каждой записи.
+
+    Проверяется вся цепочка инкрементов и все шарды набора; при повреждениях
+    код выхода 1.
+    """
+    backup_path = Path(backup_file)
+    try:
+        shards = read_shard_set(backup_path)
+        paths = [backup_path]
+        for shard in shards or []:
+            paths.extend(resolve_backup_chain(shard['path']))
+        if shards is None:
+            paths = resolve_backup_chain(backup_path)
+    except FileNotFoundError as e:
+        click.echo(f"✗ Файл {e.filename or backup_path} не найден!", err=True)
+        raise click.Abort()
+    except (yaml.YAMLError, ValueError, EOFError, OSError, lzma.LZMAError):
+        # Заголовок не читается — проверяем сам файл, чтобы показать, что с ним не так
+        paths = [backup_path]
+    
+    failed = False
+    for path in paths:
+        result = check_backup(path, jobs)
+        for name in result['corrupted']:
+            click.echo(f"✗ {path.name}: повреждена запись {name}")
+        if result['error']:
+            click.echo(f"✗ {path.name}: бэкап поврежден: {result['error']}")
+        elif result['digest'] is False:
+            click.echo(f"✗ {path.name}: контрольная сумма не совпадает")
+        elif result['digest'] is None:
+            click.echo(f"⚠ {path.name}: нет контрольной суммы (бэкап создан старой версией)")
+        if result['unverified']:
+            click.echo(f"⚠ {path.name}: записей без хеша: {result['unverified']}")
+        ok = not result['error'] and not result['corrupted'] and result['digest'] is not False
+        failed = failed or not ok
+        click.echo(f"{'✓' if ok else '✗'} {path.name}: проверено записей: {result['checked']}, "
+                   f"повреждено: {len(result['corrupted'])}")
+    if failed:
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.argument('output_file', type=click.Path())
+@click.option('--path', '-p', default='.', help='Путь к корневой директории проекта')
+@click.option('--debounce', default=2.0, type=click.FloatRange(min=0), show_default=True,
+              help='Писать снимок, когда события затихли на столько секунд')
+@click.option('--poll', is_flag=True, help='Опрашивать дерево вместо inotify')
+@click.option('--interval', default=5.0, type=click.FloatRange(min=0.01), show_default=True,
+              help='Период опроса в секундах (с --poll или без inotify)')
+@click.option('--count', type=click.IntRange(min=1), help='Завершиться после N инкрементальных снимков')
+@click.option('--duration', type=click.FloatRange(min=0), help='Завершиться через N секунд')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Число потоков для чтения файлов')
+@click.option('--dedup', is_flag=True, help='Хранить одинаковые файлы один раз (таблица blobs)')
+@click.option('--level', type=click.IntRange(0, 9), help='Уровень сжатия для .gz, .bz2 и .xz')
+@click.option('--format', 'backup_format', type=click.Choice(BACKUP_FORMATS), default='yaml',
+              show_default=True, help='Формат снимков: YAML или плоские записи с сырыми байтами')
+@click.option('--profile', is_flag=True, help='Показать время, объем и скорость по этапам')
+@click.option('--stats-json', type=click.Path(), help='Записать статистику и счетчики в JSON ("-" — в stdout)')
+@click.option('--include', multiple=True, help='Дополнительно включать файлы по glob (можно повторять)')
+@click.option('--exclude', multiple=True, help='Исключать пути по шаблону .gitignore (можно повторять)')
+@click.option('--no-gitignore', is_flag=True, help='Не читать .gitignore (.backupignore читается всегда)')
+@click.option('--all-files', is_flag=True, help='Сохранять файлы любых типов, а не только текстовые по расширению')
+@click.option('--max-file-size', type=ByteSize(), help='Предельный размер файла, например 100M')
+@click.option('--oversize', type=click.Choice(OVERSIZE_POLICIES), default='warn', show_default=True,
+              help='Файлы больше --max-file-size: пропустить, пропустить с предупреждением или обрезать')
+@stats_json_output
+def watch(output_file: str, path: str, debounce: float, poll: bool, interval: float, count: Optional[int],
+          duration: Optional[float], jobs: int, dedup: bool, level: Optional[int], backup_format: str,
+          profile: bool, stats_json: Optional[str], include: Tuple[str, ...], exclude: Tuple[str, ...],
+          no_gitignore: bool, all_files: bool, max_file_size: Optional[int], oversize: str) -> None:
+    """Следить за проектом и непрерывно сохранять инкрементальные снимки.
+
+    Сначала сохраняется полный бэкап OUTPUT_FILE, затем после каждой серии
+    изменений — инкремент к предыдущему снимку (backup.0001.yml, ...). Дерево
+    не пересканируется: индекс в памяти обновляется по событиям inotify или
+    опросом, и снимок содержит только изменившиеся файлы.
+    """
+    root_path = Path(path).resolve()
+    if not root_path.exists():
+        click.echo(f"✗ Ошибка: Директория {root_path} не существует!", err=True)
+        raise click.Abort()
+    
+    rules = ScanRules(includes=include, excludes=exclude,
+                      ignore_files=['.backupignore'] if no_gitignore else IGNORE_FILES,
+                      max_file_size=max_file_size, oversize=oversize, all_files=all_files)
+    output_path = Path(output_file)
+    save_options: Dict[str, Any] = {'jobs': jobs, 'dedup': dedup, 'backup_format': backup_format, 'level': level}
+    stats = StageStats()
+    source = session = None
+    
+    try:
+        click.echo("🔍 Сканирование директории...")
+        project_structure = scan_project(root_path, output_path, rules, stats)
+        metadata = project_structure['metadata']
+        click.echo(f"   найдено файлов: {metadata['total_files']}, директорий: {metadata['total_directories']}")
+        report_oversized(rules.oversized, max_file_size, oversize)
+        rules.oversized.clear()
+        result = save_backup(output_path, root_path, project_structure, stats=stats, **save_options)
+        click.echo(f"💾 Полный снимок: {output_path.absolute()}")
+        
+        index = TreeIndex(root_path, rules, project_structure['structure'], result['manifest'])
+        index.ignore_outputs(output_path)
+        source = open_watch_source(index, poll, interval)
+        session = WatchSession(index, source, output_path, dict(metadata), debounce, interval, save_options, stats)
+        how = 'inotify' if isinstance(source, InotifyWatcher) else f'опрос каждые {interval} с'
+        click.echo(f"👀 Слежение за {root_path} ({how}), Ctrl+C — остановить")
+        session.run(count, duration)
+    except click.Abort:
+        raise
+    except Exception as e:
+        click.echo(f"✗ Ошибка при слежении: {e}", err=True)
+        raise click.Abort()
+    finally:
+        # Сессия могла перейти на опрос, закрыв inotify сама
+        source = session.source if session is not None else source
+        if source is not None:
+            source.close()
+    
+    counters = session.counters()
+    stats.info.update(counters)
+    click.echo(f"📊 Снимков: {counters['snapshots']}, событий: {counters['events']} "
+               f"({counters['events_per_second']:.1f}/с), изменений: {counters['changes']}")
+    if counters['flush_seconds_avg'] is not None:
+        click.echo(f"   - Запись снимка: в среднем {counters['flush_seconds_avg'] * 1000:.0f} мс, "
+                   f"максимум {counters['flush_seconds_max'] * 1000:.0f} мс")
+    click.echo(f"   - Индекс: {counters['index_files']} файлов, {counters['index_bytes'] / 1024 / 1024:.1f} MB")
+    emit_stats(stats, 'watch', profile, stats_json)
+
+
 if __name__ == '__main__':
     cli()
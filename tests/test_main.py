@@ -3,12 +3,18 @@
 Тесты для simple-backup
 """
 
+import inspect
+import json
+import os
 import pytest
 import tempfile
 import shutil
+import threading
+import time
 from pathlib import Path
 from unittest.mock import patch, mock_open
 import yaml
+from click.testing import CliRunner
 
 # Импортируем функции из main.py
 import sys
@@ -18,8 +24,27 @@ from main import (
     should_skip_directory,
     should_include_file,
     read_file_content,
+    read_file_text,
+    read_file_data,
     scan_directory,
-    create_directory_structure
+    create_directory_structure,
+    write_backup,
+    BackupYamlReader,
+    BackupRecordsReader,
+    restore_backup_stream,
+    write_index,
+    lookup_index,
+    IgnoreRules,
+    ScanRules,
+    read_shard_set,
+    iter_structure_files,
+    content_hash,
+    InotifyWatcher,
+    StageStats,
+    TreeIndex,
+    save_backup,
+    scan_project,
+    cli
 )
 
 
@@ -58,6 +83,18 @@ class TestUtilityFunctions:
             assert content == "Тестовый контент"
         finally:
             temp_path.unlink()
+    
+    def test_read_file_text_detects_encoding(self):
+        """Кодировка определяется по однократно прочитанным байтам"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            (temp_path / 'utf8.txt').write_bytes('Привет\r\n'.encode('utf-8'))
+            (temp_path / 'cp1251.txt').write_bytes('Привет\r\n'.encode('cp1251'))
+            (temp_path / 'latin1.txt').write_bytes(b'\x98caf\xe9')
+            
+            assert read_file_text(temp_path / 'utf8.txt') == ('Привет\r\n', 'utf-8')
+            assert read_file_text(temp_path / 'cp1251.txt') == ('Привет\r\n', 'cp1251')
+            assert read_file_text(temp_path / 'latin1.txt') == ('\x98café', 'latin-1')
 
 
 class TestDirectoryScanning:
@@ -93,6 +130,66 @@ class TestDirectoryScanning:
             assert 'README.md' in result['structure']
             assert 'config.yml' in result['structure']
             assert 'image.jpg' not in result['structure']
+    
+    def test_parallel_scan_matches_sequential(self):
+        """Параллельное чтение дает ту же упорядоченную структуру"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            for i in range(5):
+                subdir = temp_path / f'pkg{i}'
+                subdir.mkdir()
+                for j in range(10):
+                    (subdir / f'module{j}.py').write_text(f'value = {i * j}\n', encoding='utf-8')
+            
+            sequential = scan_directory(temp_path)
+            parallel = scan_directory(temp_path, jobs=4)
+            
+            assert parallel == sequential
+            assert list(parallel['structure']) == list(sequential['structure'])
+            assert parallel['metadata']['total_files'] == 50
+            assert parallel['metadata']['total_directories'] == 5
+    
+    @pytest.mark.parametrize('jobs', [1, 4])
+    def test_scan_skips_files_vanished_before_read(self, jobs):
+        """Файл, исчезнувший или замененный директорией между stat и чтением, пропускается"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            for name in ['a.py', 'gone.py', 'replaced.py', 'b.py']:
+                (temp_path / name).write_text(f'# {name}', encoding='utf-8')
+            real_read = read_file_text
+            
+            def fake_read(file_path, limit=None):
+                if file_path.name == 'gone.py':
+                    raise FileNotFoundError(2, 'No such file or directory', str(file_path))
+                if file_path.name == 'replaced.py':
+                    raise IsADirectoryError(21, 'Is a directory', str(file_path))
+                return real_read(file_path, limit)
+            
+            with patch('main.read_file_text', side_effect=fake_read):
+                result = scan_directory(temp_path, jobs=jobs)
+            
+            assert sorted(result['structure']) == ['a.py', 'b.py']
+            assert result['metadata']['total_files'] == 2
+    
+    def test_deep_tree_does_not_hit_recursion_limit(self):
+        """Итеративный обход проходит дерево глубже лимита рекурсии"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            current = temp_path
+            for _ in range(200):
+                current = current / 'd'
+                current.mkdir()
+            (current / 'deep.txt').write_text('deep', encoding='utf-8')
+            
+            limit = sys.getrecursionlimit()
+            sys.setrecursionlimit(len(inspect.stack()) + 100)
+            try:
+                result = scan_directory(temp_path)
+            finally:
+                sys.setrecursionlimit(limit)
+            
+            assert result['metadata']['total_files'] == 1
+            assert result['metadata']['total_directories'] == 200
 
 
 class TestDirectoryStructure:
@@ -128,6 +225,1327 @@ class TestDirectoryStructure:
             assert (output_path / 'subdir' / 'file2.md').exists()
             assert (output_path / 'file1.py').read_text(encoding='utf-8') == 'print("hello")'
             assert (output_path / 'subdir' / 'file2.md').read_text(encoding='utf-8') == '# Test'
+    
+    def test_parallel_structure_counts_and_errors(self):
+        """Параллельная запись считает файлы точно и сообщает об ошибках по каждому"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = Path(temp_dir) / 'output'
+            structure = {
+                f'pkg{i}': {
+                    f'module{j}.py': {'type': 'file', 'content': f'# {i}.{j}', 'size': 5, 'modified': 1.0}
+                    for j in range(20)
+                }
+                for i in range(10)
+            }
+            # На месте файла уже есть директория — запись этого файла должна завершиться ошибкой
+            (output_path / 'pkg3' / 'module7.py').mkdir(parents=True)
+            
+            with patch('main.click.echo') as echo:
+                created_files = create_directory_structure(output_path, structure, jobs=8)
+            
+            assert created_files == 199
+            errors = [call.args[0] for call in echo.call_args_list if call.args[0].startswith('✗')]
+            assert len(errors) == 1 and 'module7.py' in errors[0]
+            assert (output_path / 'pkg9' / 'module19.py').read_text(encoding='utf-8') == '# 9.19'
+
+
+class TestStreamingWriter:
+    """Тесты для потоковой записи YAML"""
+    
+    def test_streaming_output_matches_yaml_dump(self):
+        """Потоковый YAML загружается в ту же структуру, что и yaml.dump"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'main.py').write_text('print("hello")\n\n  x = 1\n', encoding='utf-8')
+            (source_path / 'true.txt').write_text('123', encoding='utf-8')
+            (source_path / 'empty').mkdir()
+            (source_path / 'a' / 'b').mkdir(parents=True)
+            (source_path / 'a' / 'b' / ('x' * 200 + '.md')).write_text('# Глубоко', encoding='utf-8')
+            
+            skeleton = scan_directory(source_path, read_content=False)
+            assert 'content' not in skeleton['structure']['main.py']
+            
+            backup_path = temp_path / 'backup.yml'
+            with open(backup_path, 'wb') as f:
+                write_backup(f, source_path, skeleton)
+            
+            with open(backup_path, 'r', encoding='utf-8') as f:
+                restored_data = yaml.safe_load(f)
+            
+            # Хеши записей и контрольная сумма документа дополняют структуру
+            assert len(restored_data.pop('digest')) == 32
+            for _, entry in iter_structure_files(restored_data['structure']):
+                assert entry.pop('hash') == content_hash(entry['content'].encode('utf-8'))
+            assert restored_data == scan_directory(source_path)
+            assert restored_data['structure']['empty'] == {}
+    
+    def test_create_command_roundtrip(self):
+        """Команда create пишет бэкап, который восстанавливается командой restore"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'config').mkdir(parents=True)
+            (source_path / 'config' / 'settings.yml').write_text('debug: true', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+            restore_path = temp_path / 'restore'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)])
+            assert result.exit_code == 0, result.output
+            
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path)])
+            assert result.exit_code == 0, result.output
+            assert (restore_path / 'config' / 'settings.yml').read_text(encoding='utf-8') == 'debug: true'
+
+
+    @pytest.mark.parametrize('options', [[], ['-j', '4'], ['--dedup'], ['--format', 'records', '-j', '4']])
+    def test_unreadable_file_is_skipped(self, options):
+        """Файл, ставший недоступным после сканирования, пропускается, а не прерывает create"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'pkg').mkdir(parents=True)
+            for i in range(10):
+                (source_path / 'pkg' / f'module{i}.py').write_text(f'# {i}', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+            real_open = open
+            
+            def fake_open(file, *args, **kwargs):
+                if str(file).endswith('module3.py'):
+                    raise PermissionError(13, 'Permission denied', str(file))
+                return real_open(file, *args, **kwargs)
+            
+            runner = CliRunner()
+            with patch('builtins.open', side_effect=fake_open):
+                result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)] + options)
+            assert result.exit_code == 0, result.output
+            assert 'pkg/module3.py пропущен' in result.output
+            assert 'Всего файлов: 9' in result.output
+            assert not backup_path.with_name('backup.yml.tmp').exists()
+            assert 'pkg/module3.py' not in backup_path.with_name('backup.yml.manifest').read_text(encoding='utf-8')
+            
+            restore_path = temp_path / 'restore'
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path), '--verify'])
+            assert result.exit_code == 0, result.output
+            assert sorted(path.name for path in (restore_path / 'pkg').iterdir()) == [
+                f'module{i}.py' for i in range(10) if i != 3]
+    
+    @pytest.mark.parametrize('backup_format', ['yaml', 'records'])
+    @pytest.mark.parametrize('unreadable, restored', [
+        (['a.py'], ['a.py', 'b.py', 'main.py']),
+        (['a.py', 'b.py'], ['main.py']),
+    ])
+    def test_unreadable_blob_is_skipped(self, backup_format, unreadable, restored):
+        """С --dedup блоб берется из другой копии, а без читаемых копий его файлы пропускаются"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'a.py').write_text('value = 1\n', encoding='utf-8')
+            (source_path / 'b.py').write_text('value = 1\n', encoding='utf-8')
+            (source_path / 'main.py').write_text('print(1)\n', encoding='utf-8')
+            backup_path = temp_path / f'backup.{backup_format}'
+            real_open = open
+            opened = []
+            
+            def fake_open(file, *args, **kwargs):
+                # Файл читается при хешировании, а к чтению блоба становится недоступен
+                name = Path(str(file)).name
+                if name in unreadable and name in opened:
+                    raise FileNotFoundError(2, 'No such file or directory', str(file))
+                opened.append(name)
+                return real_open(file, *args, **kwargs)
+            
+            runner = CliRunner()
+            with patch('builtins.open', side_effect=fake_open):
+                result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                             '--dedup', '--format', backup_format])
+            assert result.exit_code == 0, result.output
+            assert f'Всего файлов: {len(restored)}' in result.output
+            assert not backup_path.with_name(backup_path.name + '.tmp').exists()
+            manifest = backup_path.with_name(backup_path.name + '.manifest').read_text(encoding='utf-8')
+            assert ('a.py' in manifest) == ('a.py' in restored)
+            
+            restore_path = temp_path / 'restore'
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path), '--verify'])
+            assert result.exit_code == 0, result.output
+            assert 'Ошибка' not in result.output
+            assert sorted(path.name for path in restore_path.iterdir()) == restored
+    
+    def test_failed_create_leaves_no_backup(self):
+        """При ошибке записи временный файл удаляется, а прежний бэкап остается целым"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'main.py').write_text('print(1)', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml.gz'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)])
+            assert result.exit_code == 0, result.output
+            previous = backup_path.read_bytes()
+            
+            with patch('main.write_backup', side_effect=OSError(28, 'No space left on device')):
+                result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)])
+            assert result.exit_code != 0
+            assert backup_path.read_bytes() == previous
+            assert sorted(path.name for path in temp_path.iterdir() if path.name.startswith('backup')) == [
+                'backup.yml.gz', 'backup.yml.gz.index', 'backup.yml.gz.manifest']
+
+
+class TestStreamingRestore:
+    """Тесты для потокового восстановления"""
+    
+    def test_reader_handles_yaml_dump_output(self):
+        """Потоковое чтение бэкапа, записанного yaml.dump с сортировкой ключей"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            backup_path = temp_path / 'backup.yml'
+            restore_path = temp_path / 'restore'
+            
+            project_data = {
+                'structure': {
+                    'main.py': {'type': 'file', 'content': 'print("hello")', 'size': 14, 'modified': 1.5},
+                    'empty': {},
+                    'config': {
+                        'true.yml': {'type': 'file', 'content': '123', 'size': 3, 'modified': 1.5}
+                    }
+                },
+                'metadata': {'total_files': 2, 'total_directories': 2}
+            }
+            with open(backup_path, 'w', encoding='utf-8') as f:
+                yaml.dump(project_data, f, sort_keys=True)
+            
+            with open(backup_path, 'rb') as f:
+                reader = BackupYamlReader(f)
+                header = reader.read_header()
+                assert reader.has_structure
+                assert header['metadata']['total_files'] == 2
+                
+                # Ключи записей отсортированы: content идет раньше type
+                entries = list(reader.iter_entries())
+                assert ('dir', 'empty') in entries
+                assert ('file', 'config/true.yml', project_data['structure']['config']['true.yml']) in entries
+            
+            with open(backup_path, 'rb') as f:
+                reader = BackupYamlReader(f)
+                reader.read_header()
+                created_files = restore_backup_stream(reader, restore_path)
+            
+            assert created_files == 2
+            assert (restore_path / 'empty').is_dir()
+            assert (restore_path / 'config' / 'true.yml').read_text(encoding='utf-8') == '123'
+    
+    def test_restore_rejects_invalid_backup(self):
+        """Бэкап без раздела structure отклоняется"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            backup_path = temp_path / 'backup.yml'
+            backup_path.write_text('metadata:\n  total_files: 0\n', encoding='utf-8')
+            
+            result = CliRunner().invoke(cli, ['restore', str(backup_path), str(temp_path / 'out')])
+            assert result.exit_code != 0
+            assert 'Неверный формат' in result.output
+    
+    def test_roundtrip_preserves_original_bytes(self):
+        """Файлы в cp1251 и с CRLF восстанавливаются байт в байт"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            original = 'Настройки\r\nключ = значение\r\n'.encode('cp1251')
+            (source_path / 'legacy.ini').write_bytes(original)
+            backup_path = temp_path / 'backup.yml'
+            restore_path = temp_path / 'restore'
+            
+            runner = CliRunner()
+            assert runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)]).exit_code == 0
+            assert runner.invoke(cli, ['restore', str(backup_path), str(restore_path)]).exit_code == 0
+            
+            with open(backup_path, 'r', encoding='utf-8') as f:
+                assert yaml.safe_load(f)['structure']['legacy.ini']['encoding'] == 'cp1251'
+            assert (restore_path / 'legacy.ini').read_bytes() == original
+
+
+class TestIncrementalBackup:
+    """Тесты для инкрементальных бэкапов"""
+    
+    def _create(self, *args):
+        result = CliRunner().invoke(cli, ['create', *map(str, args)])
+        assert result.exit_code == 0, result.output
+    
+    def test_incremental_contains_only_changes(self):
+        """Инкремент содержит только измененные файлы и список удаленных"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'pkg').mkdir(parents=True)
+            (source_path / 'same.py').write_text('x = 1', encoding='utf-8')
+            (source_path / 'touched.py').write_text('y = 2', encoding='utf-8')
+            (source_path / 'pkg' / 'changed.py').write_text('z = 3', encoding='utf-8')
+            (source_path / 'pkg' / 'removed.md').write_text('# old', encoding='utf-8')
+            
+            self._create(temp_path / 'full.yml', '--path', source_path)
+            assert (temp_path / 'full.yml.manifest').exists()
+            
+            (source_path / 'pkg' / 'changed.py').write_text('z = 30', encoding='utf-8')
+            (source_path / 'pkg' / 'removed.md').unlink()
+            (source_path / 'added.txt').write_text('new', encoding='utf-8')
+            os.utime(source_path / 'touched.py', (1_000_000, 1_000_000))
+            
+            self._create(temp_path / 'inc.yml', '--path', source_path,
+                         '--incremental', '--base', temp_path / 'full.yml', '--checksum')
+            
+            with open(temp_path / 'inc.yml', 'r', encoding='utf-8') as f:
+                delta = yaml.safe_load(f)
+            assert delta['metadata']['backup_type'] == 'incremental'
+            assert delta['metadata']['base'] == 'full.yml'
+            assert delta['deleted'] == ['pkg/removed.md']
+            assert sorted(delta['structure']) == ['added.txt', 'pkg']
+            assert list(delta['structure']['pkg']) == ['changed.py']
+    
+    def test_restore_applies_chain(self):
+        """Восстановление инкремента применяет всю цепочку поверх полного бэкапа"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'a.py').write_text('a = 1', encoding='utf-8')
+            (source_path / 'old').mkdir()
+            (source_path / 'old' / 'b.py').write_text('b = 1', encoding='utf-8')
+            self._create(temp_path / 'full.yml', '--path', source_path)
+            
+            (source_path / 'a.py').write_text('a = 2', encoding='utf-8')
+            self._create(temp_path / 'inc1.yml', '--path', source_path, '-i', '-b', temp_path / 'full.yml')
+            
+            shutil.rmtree(source_path / 'old')
+            (source_path / 'c.py').write_text('c = 1', encoding='utf-8')
+            # Манифест не обязателен: без него состояние собирается по цепочке бэкапов
+            (temp_path / 'inc1.yml.manifest').unlink()
+            self._create(temp_path / 'inc2.yml', '--path', source_path, '-i', '-b', temp_path / 'inc1.yml')
+            
+            restore_path = temp_path / 'restore'
+            result = CliRunner().invoke(cli, ['restore', str(temp_path / 'inc2.yml'), str(restore_path)])
+            assert result.exit_code == 0, result.output
+            
+            assert (restore_path / 'a.py').read_text(encoding='utf-8') == 'a = 2'
+            assert (restore_path / 'c.py').read_text(encoding='utf-8') == 'c = 1'
+            assert not (restore_path / 'old').exists()
+
+
+class TestDeduplication:
+    """Тесты для дедупликации одинаковых файлов"""
+    
+    def test_dedup_backup_roundtrip(self):
+        """Одинаковые файлы хранятся одним блобом и восстанавливаются все"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            for package in ('a', 'b', 'c'):
+                (source_path / package).mkdir(parents=True)
+                (source_path / package / '__init__.py').write_text('', encoding='utf-8')
+                (source_path / package / 'LICENSE.txt').write_text('MIT License\n' * 50, encoding='utf-8')
+            (source_path / 'unique.py').write_text('print("unique")', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+            restore_path = temp_path / 'restore'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path), '--dedup'])
+            assert result.exit_code == 0, result.output
+            assert 'Уникальных блобов: 3' in result.output
+            
+            with open(backup_path, 'r', encoding='utf-8') as f:
+                data = yaml.safe_load(f)
+            assert len(data['blobs']) == 3
+            assert data['structure']['a']['LICENSE.txt']['blob'] == data['structure']['c']['LICENSE.txt']['blob']
+            assert 'content' not in data['structure']['unique.py']
+            
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path), '--link', '--jobs', '4'])
+            assert result.exit_code == 0, result.output
+            assert 'Создано файлов: 7' in result.output
+            assert (restore_path / 'b' / 'LICENSE.txt').read_text(encoding='utf-8') == 'MIT License\n' * 50
+            assert (restore_path / 'c' / 'LICENSE.txt').samefile(restore_path / 'a' / 'LICENSE.txt')
+            assert (restore_path / 'unique.py').read_text(encoding='utf-8') == 'print("unique")'
+    
+    def test_create_directory_structure_with_blobs(self):
+        """Блоб пишется один раз, остальные файлы копируются с первого"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = Path(temp_dir) / 'output'
+            structure = {
+                'one.json': {'type': 'file', 'blob': 'h1', 'size': 2, 'modified': 1.0},
+                'nested': {
+                    'two.json': {'type': 'file', 'blob': 'h1', 'size': 2, 'modified': 1.0}
+                }
+            }
+            blobs = {'h1': {'content': '{}', 'encoding': 'utf-8'}}
+            
+            created_files = create_directory_structure(output_path, structure, blobs=blobs)
+            
+            assert created_files == 2
+            assert (output_path / 'nested' / 'two.json').read_text(encoding='utf-8') == '{}'
+            assert not (output_path / 'nested' / 'two.json').samefile(output_path / 'one.json')
+
+
+class TestCompression:
+    """Тесты для сжатых бэкапов"""
+    
+    @pytest.mark.parametrize('suffix, magic', [
+        ('.gz', b'\x1f\x8b'),
+        ('.bz2', b'BZh'),
+        ('.xz', b'\xfd7zXZ\x00'),
+    ])
+    def test_compressed_roundtrip(self, suffix, magic):
+        """Бэкап сжимается по суффиксу и прозрачно распаковывается при восстановлении"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'main.py').write_text('print("hello")\n' * 100, encoding='utf-8')
+            backup_path = temp_path / f'backup.yml{suffix}'
+            restore_path = temp_path / 'restore'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path), '--level', '1'])
+            assert result.exit_code == 0, result.output
+            assert backup_path.read_bytes().startswith(magic)
+            
+            # Кодек определяется по содержимому, а не по имени файла
+            renamed_path = backup_path.rename(temp_path / 'renamed.yml')
+            result = runner.invoke(cli, ['restore', str(renamed_path), str(restore_path)])
+            assert result.exit_code == 0, result.output
+            assert (restore_path / 'main.py').read_text(encoding='utf-8') == 'print("hello")\n' * 100
+
+
+class TestExtract:
+    """Тесты для индекса смещений и команд extract и list"""
+    
+    def test_lookup_index_binary_search(self):
+        """Двоичный поиск находит каждую строку индекса и не находит отсутствующие"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_file = Path(temp_dir) / 'backup.yml.index'
+            entries = {f'dir{i % 7}/файл{i:04d}.py': [i * 100, i + 1] for i in range(300)}
+            write_index(index_file, entries, {'backup_size': 0})
+            
+            with open(index_file, 'rb') as index:
+                for rel_path, record in entries.items():
+                    assert lookup_index(index, rel_path) == record
+                for rel_path in ('', 'a', 'dir0', 'dir3/файл0003.py.bak', 'zzz'):
+                    assert lookup_index(index, rel_path) is None
+    
+    @pytest.mark.parametrize('suffix, options', [
+        ('', []),
+        ('.gz', []),
+        ('', ['--dedup']),
+        ('.xz', ['--dedup']),
+    ])
+    def test_extract_single_files(self, suffix, options):
+        """extract достает отдельные файлы по индексу с исходными байтами"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'conf').mkdir(parents=True)
+            for i in range(20):
+                (source_path / f'module{i}.py').write_text(f'# модуль {i}\n', encoding='utf-8')
+            (source_path / 'copy.py').write_text('# модуль 3\n', encoding='utf-8')
+            (source_path / 'conf' / 'app.ini').write_bytes('[секция]\r\nключ=значение\r\n'.encode('cp1251'))
+            backup_path = temp_path / f'backup.yml{suffix}'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)] + options)
+            assert result.exit_code == 0, result.output
+            assert Path(str(backup_path) + '.index').exists()
+            
+            out_path = temp_path / 'out'
+            result = runner.invoke(cli, ['extract', str(backup_path), 'conf/app.ini', './copy.py', '-o', str(out_path)])
+            assert result.exit_code == 0, result.output
+            assert (out_path / 'conf' / 'app.ini').read_bytes() == (source_path / 'conf' / 'app.ini').read_bytes()
+            assert (out_path / 'copy.py').read_text(encoding='utf-8') == '# модуль 3\n'
+            assert not (out_path / 'module0.py').exists()
+            
+            result = runner.invoke(cli, ['extract', str(backup_path), 'missing.py', '-o', str(out_path)])
+            assert result.exit_code != 0
+            assert 'missing.py' in result.output
+    
+    def test_extract_follows_chain_and_falls_back_without_index(self):
+        """extract ищет файл по цепочке инкрементов и читает бэкап без индекса потоком"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'kept.py').write_text('kept', encoding='utf-8')
+            (source_path / 'changed.py').write_text('old', encoding='utf-8')
+            (source_path / 'removed.py').write_text('removed', encoding='utf-8')
+            full_path = temp_path / 'full.yml'
+            inc_path = temp_path / 'inc.yml'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(full_path), '--path', str(source_path)])
+            assert result.exit_code == 0, result.output
+            (source_path / 'changed.py').write_text('new content', encoding='utf-8')
+            (source_path / 'removed.py').unlink()
+            result = runner.invoke(cli, ['create', str(inc_path), '--path', str(source_path),
+                                         '--incremental', '--base', str(full_path)])
+            assert result.exit_code == 0, result.output
+            Path(str(full_path) + '.index').unlink()
+            
+            result = runner.invoke(cli, ['extract', str(inc_path), 'kept.py', 'changed.py', '--stdout'])
+            assert result.exit_code == 0, result.output
+            assert result.stdout_bytes == b'keptnew content'
+            
+            result = runner.invoke(cli, ['extract', str(inc_path), 'removed.py', '--stdout'])
+            assert result.exit_code != 0
+            
+            result = runner.invoke(cli, ['list', str(inc_path)])
+            assert result.exit_code == 0, result.output
+            assert result.output.split() == ['changed.py', 'kept.py']
+
+
+class TestRecordsFormat:
+    """Тесты для формата records и команды convert"""
+    
+    def _make_source(self, source_path):
+        (source_path / 'pkg').mkdir(parents=True)
+        (source_path / 'empty').mkdir()
+        (source_path / 'pkg' / 'main.py').write_text('print("привет")\n', encoding='utf-8')
+        (source_path / 'pkg' / 'copy.py').write_text('print("привет")\n', encoding='utf-8')
+        (source_path / 'legacy.ini').write_bytes('[секция]\r\nключ=1'.encode('cp1251'))
+        (source_path / 'run.py').write_text('#!/usr/bin/env python3\n', encoding='utf-8')
+        os.chmod(source_path / 'run.py', 0o755)
+    
+    @pytest.mark.parametrize('options', [[], ['--dedup'], ['--jobs', '4']])
+    def test_records_roundtrip(self, options):
+        """Бэкап records восстанавливается байт в байт вместе с правами и пустыми директориями"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            self._make_source(source_path)
+            backup_path = temp_path / 'backup.rec'
+            restore_path = temp_path / 'restore'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--format', 'records'] + options)
+            assert result.exit_code == 0, result.output
+            assert backup_path.read_bytes().startswith(b'SIMPLE-BACKUP-RECORDS 1\n')
+            
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path)])
+            assert result.exit_code == 0, result.output
+            for name in ('pkg/main.py', 'pkg/copy.py', 'legacy.ini', 'run.py'):
+                assert (restore_path / name).read_bytes() == (source_path / name).read_bytes()
+            assert (restore_path / 'empty').is_dir()
+            assert (restore_path / 'run.py').stat().st_mode & 0o777 == 0o755
+            
+            result = runner.invoke(cli, ['extract', str(backup_path), 'pkg/copy.py', '--stdout'])
+            assert result.exit_code == 0, result.output
+            assert result.stdout_bytes == (source_path / 'pkg' / 'copy.py').read_bytes()
+    
+    def test_convert_is_lossless_both_ways(self):
+        """convert YAML → records → YAML дает исходный файл, а records читается как есть"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            self._make_source(source_path)
+            yaml_path = temp_path / 'backup.yml'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(yaml_path), '--path', str(source_path), '--dedup'])
+            assert result.exit_code == 0, result.output
+            
+            result = runner.invoke(cli, ['convert', str(yaml_path), str(temp_path / 'backup.rec.gz')])
+            assert result.exit_code == 0, result.output
+            result = runner.invoke(cli, ['convert', str(temp_path / 'backup.rec.gz'), str(temp_path / 'again.yml')])
+            assert result.exit_code == 0, result.output
+            assert (temp_path / 'again.yml').read_bytes() == yaml_path.read_bytes()
+            
+            result = runner.invoke(cli, ['extract', str(temp_path / 'backup.rec.gz'), 'legacy.ini', '--stdout'])
+            assert result.exit_code == 0, result.output
+            assert result.stdout_bytes == (source_path / 'legacy.ini').read_bytes()
+            
+            result = runner.invoke(cli, ['list', str(temp_path / 'backup.rec.gz')])
+            assert result.output.split() == ['legacy.ini', 'pkg/copy.py', 'pkg/main.py', 'run.py']
+
+
+class TestStageStats:
+    """Тесты для --profile и --stats-json"""
+    
+    def test_stats_json_reports_stages(self):
+        """create и restore пишут в JSON время, файлы и байты по этапам"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'pkg').mkdir(parents=True)
+            for i in range(5):
+                (source_path / 'pkg' / f'module{i}.py').write_text('x = 1\n' * 10, encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--stats-json', str(temp_path / 'create.json'), '--profile'])
+            assert result.exit_code == 0, result.output
+            assert 'serialize' in result.output
+            stats = json.loads((temp_path / 'create.json').read_text(encoding='utf-8'))
+            assert stats['command'] == 'create'
+            assert stats['backup_bytes'] == backup_path.stat().st_size
+            assert stats['stages']['scan']['files'] == 5
+            assert stats['stages']['read']['bytes'] == 5 * 60
+            assert stats['stages']['serialize']['files'] == 5
+            assert stats['stages']['serialize']['seconds'] > 0
+            
+            # С "-" в stdout только JSON: остальной вывод уходит в stderr.
+            # До click 8.2 stderr смешивается с stdout, если не попросить иначе
+            options = {'mix_stderr': False} if 'mix_stderr' in inspect.signature(CliRunner).parameters else {}
+            result = CliRunner(**options).invoke(cli, ['restore', str(backup_path), str(temp_path / 'restore'),
+                                                       '--stats-json', '-', '--profile'])
+            assert result.exit_code == 0, result.output
+            assert 'Этапы' in result.stderr and 'Этапы' not in result.stdout
+            stats = json.loads(result.stdout)
+            assert stats['stages']['parse']['files'] == 5
+            assert stats['stages']['write']['files'] == 5
+            assert stats['stages']['write']['bytes'] == 5 * 60
+
+
+class TestSyncRestore:
+    """Тесты для restore --sync"""
+    
+    @pytest.mark.parametrize('options', [[], ['--dedup']])
+    def test_sync_writes_only_changed_files(self, options):
+        """--sync пропускает совпадающие файлы и перезаписывает отличающиеся"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'pkg').mkdir(parents=True)
+            for i in range(4):
+                (source_path / 'pkg' / f'module{i}.py').write_text(f'value = {i}\n', encoding='utf-8')
+            (source_path / 'copy.py').write_text('value = 0\n', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+            restore_path = temp_path / 'restore'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)] + options)
+            assert result.exit_code == 0, result.output
+            
+            sync = ['restore', str(backup_path), str(restore_path), '--sync', '--preserve-mtime',
+                    '--stats-json', str(temp_path / 'stats.json')]
+            result = runner.invoke(cli, sync)
+            assert result.exit_code == 0, result.output
+            assert (restore_path / 'pkg' / 'module1.py').stat().st_mtime == \
+                (source_path / 'pkg' / 'module1.py').stat().st_mtime
+            
+            # Второй прогон ничего не пишет
+            result = runner.invoke(cli, sync)
+            assert result.exit_code == 0, result.output
+            stats = json.loads((temp_path / 'stats.json').read_text(encoding='utf-8'))
+            assert stats['stages']['write']['files'] == 0
+            assert stats['stages']['skip']['files'] == 5
+            
+            # Измененный файл перезаписывается, файл с тем же содержимым, но новым mtime — тоже
+            (restore_path / 'pkg' / 'module2.py').write_text('value = 99\n', encoding='utf-8')
+            os.utime(restore_path / 'copy.py', (1, 1))
+            result = runner.invoke(cli, sync)
+            assert 'Записано файлов: 2' in result.output
+            assert (restore_path / 'pkg' / 'module2.py').read_text(encoding='utf-8') == 'value = 2\n'
+            
+            # С --checksum файл с тем же содержимым не пишется, а mtime возвращается
+            os.utime(restore_path / 'copy.py', (1, 1))
+            result = runner.invoke(cli, sync + ['--checksum'])
+            assert 'Записано файлов: 0' in result.output
+            assert (restore_path / 'copy.py').stat().st_mtime == (source_path / 'copy.py').stat().st_mtime
+    
+    @pytest.mark.parametrize('backup_format, with_index', [('yaml', True), ('records', True), ('yaml', False)])
+    def test_sync_chain_writes_final_versions_once(self, backup_format, with_index):
+        """--sync по цепочке пишет только итоговые версии, а совпадающее дерево не трогает"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'sub').mkdir(parents=True)
+            for name in ['kept.py', 'changed.py', 'removed.py', 'back.py', 'sub/gone.py']:
+                (source_path / name).write_text(f'# {name}\n', encoding='utf-8')
+            chain = [temp_path / f'{name}.{backup_format}' for name in ['full', 'inc1', 'inc2']]
+            restore_path = temp_path / 'restore'
+            
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(chain[0]), '--path', str(source_path),
+                                         '--format', backup_format])
+            assert result.exit_code == 0, result.output
+            # inc1: изменение и удаления, inc2: повторное изменение и возврат удаленного файла
+            (source_path / 'changed.py').write_text('# v2\n', encoding='utf-8')
+            for name in ['removed.py', 'back.py', 'sub/gone.py']:
+                (source_path / name).unlink()
+            (source_path / 'sub').rmdir()
+            for steps in ([], ['changed.py', 'back.py']):
+                for name in steps:
+                    (source_path / name).write_text('# v3\n', encoding='utf-8')
+                backup_path = chain[2 if steps else 1]
+                result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                             '--format', backup_format, '--incremental',
+                                             '--base', str(chain[1 if steps else 0])])
+                assert result.exit_code == 0, result.output
+            if not with_index:
+                for backup_path in chain:
+                    backup_path.with_name(backup_path.name + '.index').unlink()
+            
+            sync = ['restore', str(chain[2]), str(restore_path), '--sync', '--preserve-mtime',
+                    '--stats-json', str(temp_path / 'stats.json')]
+            result = runner.invoke(cli, sync)
+            assert result.exit_code == 0, result.output
+            stats = json.loads((temp_path / 'stats.json').read_text(encoding='utf-8'))
+            assert stats['stages']['write']['files'] == 3
+            assert sorted(str(path.relative_to(restore_path)) for path in restore_path.rglob('*')) == [
+                'back.py', 'changed.py', 'kept.py']
+            for name in ['back.py', 'changed.py', 'kept.py']:
+                assert (restore_path / name).read_text(encoding='utf-8') == \
+                    (source_path / name).read_text(encoding='utf-8')
+            
+            # Дерево уже совпадает с цепочкой: ничего не пишется и не удаляется
+            result = runner.invoke(cli, sync)
+            assert result.exit_code == 0, result.output
+            stats = json.loads((temp_path / 'stats.json').read_text(encoding='utf-8'))
+            assert stats['stages']['write']['files'] == 0
+            assert stats['stages']['skip']['files'] == 3
+            assert stats['stages'].get('delete', {}).get('files', 0) == 0
+
+
+class TestScanRules:
+    """Тесты для правил .gitignore/.backupignore и --include/--exclude"""
+
+    @pytest.mark.parametrize('pattern, rel_path, is_dir, expected', [
+        ('*.log', 'a/b/debug.log', False, True),
+        ('/build', 'src/build', True, None),
+        ('/build', 'build', True, True),
+        ('docs/_build/', 'docs/_build', True, True),
+        ('docs/_build/', 'docs/_build', False, None),
+        ('**/generated/*.json', 'a/b/generated/x.json', False, True),
+        ('fixtures/**/snap-*.json', 'fixtures/snap-1.json', False, True),
+        ('data/**', 'data/x/y.txt', False, True),
+        ('module.py[cod]', 'module.pyc', False, True),
+    ])
+    def test_ignore_rules_match(self, pattern, rel_path, is_dir, expected):
+        """Шаблоны сопоставляются как в git"""
+        rules = IgnoreRules([pattern])
+        assert rules.match(rel_path, rel_path.rsplit('/', 1)[-1], is_dir) is expected
+
+    def test_nested_ignore_files_and_pruning(self):
+        """Вложенные файлы игнорирования, отрицание и отсечение поддеревьев"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            (temp_path / 'generated').mkdir()
+            (temp_path / 'generated' / 'data.json').write_text('{}', encoding='utf-8')
+            (temp_path / 'logs').mkdir()
+            (temp_path / 'logs' / 'debug.txt').write_text('debug', encoding='utf-8')
+            (temp_path / 'logs' / 'keep.txt').write_text('keep', encoding='utf-8')
+            (temp_path / 'logs' / '.gitignore').write_text('*.txt\n!keep.txt\n', encoding='utf-8')
+            (temp_path / 'main.py').write_text('print(1)', encoding='utf-8')
+            (temp_path / 'local.py').write_text('secret = 1', encoding='utf-8')
+            (temp_path / '.gitignore').write_text('generated/\n', encoding='utf-8')
+            (temp_path / '.backupignore').write_text('local.py\n', encoding='utf-8')
+
+            with patch('main.os.scandir', wraps=os.scandir) as scandir:
+                result = scan_directory(temp_path, read_content=False)
+
+            structure = result['structure']
+            assert sorted(structure) == ['logs', 'main.py']
+            assert list(structure['logs']) == ['keep.txt']
+            # Исключенная директория не читается
+            assert str(temp_path / 'generated') not in [str(call.args[0]) for call in scandir.call_args_list]
+
+            result = scan_directory(temp_path, read_content=False, rules=ScanRules(ignore_files=()))
+            assert 'generated' in result['structure'] and 'local.py' in result['structure']
+
+    def test_cli_include_exclude(self):
+        """--include, --exclude и --no-gitignore в команде create"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'tests').mkdir(parents=True)
+            (source_path / 'Makefile').write_text('all:', encoding='utf-8')
+            (source_path / 'app.py').write_text('print(1)', encoding='utf-8')
+            (source_path / 'tests' / 'test_app.py').write_text('assert 1', encoding='utf-8')
+            (source_path / 'notes.txt').write_text('notes', encoding='utf-8')
+            (source_path / '.gitignore').write_text('*.txt\n', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--include', 'Makefile', '--exclude', 'tests/'])
+            assert result.exit_code == 0, result.output
+            structure = yaml.safe_load(backup_path.read_text(encoding='utf-8'))['structure']
+            assert sorted(structure) == ['Makefile', 'app.py']
+
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--no-gitignore'])
+            assert result.exit_code == 0, result.output
+            structure = yaml.safe_load(backup_path.read_text(encoding='utf-8'))['structure']
+            assert sorted(structure) == ['app.py', 'notes.txt', 'tests']
+
+
+class TestLargeFiles:
+    """Тесты для фрагментированной записи больших файлов и --max-file-size"""
+
+    @pytest.mark.parametrize('backup_format', ['yaml', 'records'])
+    @pytest.mark.parametrize('options', [[], ['--dedup']])
+    def test_chunked_roundtrip(self, backup_format, options):
+        """Большие файлы пишутся фрагментами и восстанавливаются байт в байт"""
+        with tempfile.TemporaryDirectory() as temp_dir, patch('main.CHUNK_SIZE', 1000):
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'data').mkdir(parents=True)
+            # Многобайтовые символы попадают на границы фрагментов
+            (source_path / 'data' / 'dump.json').write_bytes(('"Привет, мир!"\n' * 500).encode('utf-8'))
+            (source_path / 'data' / 'copy.json').write_bytes(('"Привет, мир!"\n' * 500).encode('utf-8'))
+            (source_path / 'log.txt').write_bytes(('Строка журнала\r\n' * 300).encode('cp1251'))
+            (source_path / 'main.py').write_text('print(1)\n', encoding='utf-8')
+            backup_path = temp_path / f'backup.{backup_format}'
+            restore_path = temp_path / 'restore'
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--format', backup_format, '--jobs', '2'] + options)
+            assert result.exit_code == 0, result.output
+            if backup_format == 'yaml':
+                # Фрагмент занимает одну строку: за chunks идут только элементы списка и hash
+                chunk_lines = backup_path.read_text(encoding='utf-8').split('chunks:\n', 1)[1]
+                chunk_lines = chunk_lines.split('hash:', 1)[0].splitlines()[:-1]
+                assert len(chunk_lines) > 1
+                assert all(line.lstrip().startswith('- ') for line in chunk_lines)
+
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path), '--jobs', '4',
+                                         '--stats-json', str(temp_path / 'stats.json')])
+            assert result.exit_code == 0, result.output
+            for rel_path in ['data/dump.json', 'data/copy.json', 'log.txt', 'main.py']:
+                assert (restore_path / rel_path).read_bytes() == (source_path / rel_path).read_bytes()
+            # Байты фрагментов, в том числе скопированных с дубликата, учитываются в write
+            stats = json.loads((temp_path / 'stats.json').read_text(encoding='utf-8'))
+            assert stats['stages']['write']['bytes'] == sum(
+                path.stat().st_size for path in source_path.rglob('*') if path.is_file())
+
+            result = runner.invoke(cli, ['extract', str(backup_path), 'log.txt', '--stdout'])
+            assert result.stdout_bytes == (source_path / 'log.txt').read_bytes()
+
+            # Хеш большого файла пишется после фрагментов и тоже сверяется
+            result = runner.invoke(cli, ['check', str(backup_path)])
+            assert result.exit_code == 0, result.output
+            assert 'повреждено: 0' in result.output
+
+    def test_records_reads_chunked_file_once(self):
+        """records читает большой файл один раз, а кодировку пишет в завершающий фрагмент"""
+        with tempfile.TemporaryDirectory() as temp_dir, patch('main.CHUNK_SIZE', 1000):
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            content = ('Строка журнала\r\n' * 300).encode('cp1251')
+            (source_path / 'log.txt').write_bytes(content)
+            backup_path = temp_path / 'backup.rec'
+            real_open = open
+            opened = []
+            
+            def counting_open(file, *args, **kwargs):
+                opened.append(Path(str(file)).name)
+                return real_open(file, *args, **kwargs)
+            
+            runner = CliRunner()
+            with patch('builtins.open', side_effect=counting_open):
+                result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                             '--format', 'records'])
+            assert result.exit_code == 0, result.output
+            assert opened.count('log.txt') == 1
+            with open(backup_path, 'rb') as f:
+                reader = BackupRecordsReader(f)
+                reader.read_header()
+                entry = next(item[2] for item in reader.iter_entries() if item[0] == 'file')
+                assert 'encoding' not in entry
+                assert b''.join(entry['chunks']) == content
+                assert entry['encoding'] == 'cp1251'
+            
+            # В YAML такие фрагменты переходят байтами и восстанавливаются без изменений
+            yaml_path = temp_path / 'backup.yml'
+            result = runner.invoke(cli, ['convert', str(backup_path), str(yaml_path)])
+            assert result.exit_code == 0, result.output
+            result = runner.invoke(cli, ['restore', str(yaml_path), str(temp_path / 'restore')])
+            assert result.exit_code == 0, result.output
+            assert (temp_path / 'restore' / 'log.txt').read_bytes() == content
+    
+    @pytest.mark.parametrize('backup_format', ['yaml', 'records'])
+    def test_chunked_file_deleted_before_write(self, backup_format):
+        """Большой файл, удаленный после упреждающего чтения, не прерывает create"""
+        with tempfile.TemporaryDirectory() as temp_dir, patch('main.CHUNK_SIZE', 1000):
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'big.txt').write_text('x' * 5000, encoding='utf-8')
+            (source_path / 'gone.txt').write_text('y' * 5000, encoding='utf-8')
+            (source_path / 'main.py').write_text('print(1)\n', encoding='utf-8')
+            backup_path = temp_path / f'backup.{backup_format}'
+            real_read = read_file_data
+            real_open = open
+            
+            def deleting_read(file_path, *args, **kwargs):
+                # Файл удаляется сразу после упреждающего чтения, до записи его фрагментов
+                data = real_read(file_path, *args, **kwargs)
+                if file_path.name == 'big.txt':
+                    file_path.unlink()
+                return data
+            
+            def fake_open(file, *args, **kwargs):
+                if str(file).endswith('gone.txt'):
+                    raise FileNotFoundError(2, 'No such file or directory', str(file))
+                return real_open(file, *args, **kwargs)
+            
+            runner = CliRunner()
+            with patch('main.read_file_data', side_effect=deleting_read), \
+                    patch('builtins.open', side_effect=fake_open):
+                result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                             '--format', backup_format])
+            assert result.exit_code == 0, result.output
+            assert 'gone.txt пропущен' in result.output
+            result = runner.invoke(cli, ['restore', str(backup_path), str(temp_path / 'restore')])
+            assert result.exit_code == 0, result.output
+            assert sorted(path.name for path in (temp_path / 'restore').iterdir()) == ['big.txt', 'main.py']
+            assert (temp_path / 'restore' / 'big.txt').read_text(encoding='utf-8') == 'x' * 5000
+    
+    @pytest.mark.parametrize('policy, expected_size, warned', [
+        ('skip', None, False),
+        ('warn', None, True),
+        ('truncate', 2048, True),
+    ])
+    def test_max_file_size_policies(self, policy, expected_size, warned):
+        """Файлы больше --max-file-size пропускаются или обрезаются"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'huge.txt').write_text('x' * 10000, encoding='utf-8')
+            (source_path / 'main.py').write_text('print(1)\n', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+            restore_path = temp_path / 'restore'
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--max-file-size', '2K', '--oversize', policy])
+            assert result.exit_code == 0, result.output
+            assert ('большой файл huge.txt' in result.output) == warned
+
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path)])
+            assert result.exit_code == 0, result.output
+            assert (restore_path / 'main.py').exists()
+            if expected_size is None:
+                assert not (restore_path / 'huge.txt').exists()
+            else:
+                assert (restore_path / 'huge.txt').read_text(encoding='utf-8') == 'x' * expected_size
+
+    @pytest.mark.parametrize('backup_format', ['yaml', 'records'])
+    def test_sync_checksum_skips_unchanged_chunked_file(self, backup_format):
+        """--sync --checksum не переписывает большой файл с тем же содержимым"""
+        with tempfile.TemporaryDirectory() as temp_dir, patch('main.CHUNK_SIZE', 1000):
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            content = ''.join(f'строка {i}\n' for i in range(1000)).encode('utf-8')
+            (source_path / 'dump.txt').write_bytes(content)
+            backup_path = temp_path / f'backup.{backup_format}'
+            restore_path = temp_path / 'restore'
+            restored = restore_path / 'dump.txt'
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--format', backup_format])
+            assert result.exit_code == 0, result.output
+            sync = ['restore', str(backup_path), str(restore_path), '--sync', '--checksum', '--preserve-mtime']
+            result = runner.invoke(cli, sync)
+            assert result.exit_code == 0, result.output
+
+            # Тот же файл с другим mtime не переписывается, mtime возвращается
+            os.utime(restored, (1, 1))
+            result = runner.invoke(cli, sync)
+            assert 'Записано файлов: 0' in result.output
+            assert restored.stat().st_mtime == (source_path / 'dump.txt').stat().st_mtime
+
+            # Расхождение в середине файла того же размера исправляется
+            restored.write_bytes(content[:5000] + b'#' + content[5001:])
+            result = runner.invoke(cli, sync)
+            assert 'Записано файлов: 1' in result.output
+            assert restored.read_bytes() == content
+            assert not (restore_path / 'dump.txt.tmp').exists()
+
+
+class TestShards:
+    """Тесты для бэкапов, разбитых на шарды, и нескольких корней"""
+
+    def make_project(self, root: Path) -> None:
+        for rel_path, text in [('top.py', 'print(0)'), ('app/main.py', 'print(1)'),
+                               ('lib/core/util.py', 'print(2)'), ('docs/README.md', '# Docs')]:
+            (root / rel_path).parent.mkdir(parents=True, exist_ok=True)
+            (root / rel_path).write_text(text, encoding='utf-8')
+
+    @pytest.mark.parametrize('backup_format', ['yaml', 'records'])
+    def test_shard_roundtrip_and_selective_restore(self, backup_format):
+        """Шарды пишутся отдельными файлами и восстанавливаются целиком или выборочно"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            self.make_project(source_path)
+            backup_path = temp_path / 'set.yml'
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path), '--shard',
+                                         '--processes', '2', '--format', backup_format])
+            assert result.exit_code == 0, result.output
+            shards = read_shard_set(backup_path)
+            assert sorted(item['name'] for item in shards) == ['.', 'app', 'docs', 'lib']
+            assert all(item['path'].exists() for item in shards)
+
+            result = runner.invoke(cli, ['restore', str(backup_path), str(temp_path / 'full'), '-P', '2'])
+            assert result.exit_code == 0, result.output
+            for rel_path in ['top.py', 'app/main.py', 'lib/core/util.py', 'docs/README.md']:
+                assert (temp_path / 'full' / rel_path).read_bytes() == (source_path / rel_path).read_bytes()
+
+            result = runner.invoke(cli, ['restore', str(backup_path), str(temp_path / 'part'),
+                                         '--shard', 'lib', '--shard', '.'])
+            assert result.exit_code == 0, result.output
+            assert (temp_path / 'part' / 'lib' / 'core' / 'util.py').exists()
+            assert (temp_path / 'part' / 'top.py').exists()
+            assert not (temp_path / 'part' / 'app').exists()
+
+            result = runner.invoke(cli, ['extract', str(backup_path), 'lib/core/util.py', '--stdout'])
+            assert result.output == 'print(2)'
+
+    def test_multiple_roots_and_incremental(self):
+        """Каждый корень восстанавливается в свою поддиректорию, инкремент идет по шардам"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            for name in ['api', 'web']:
+                (temp_path / name).mkdir()
+                (temp_path / name / 'main.py').write_text(f'# {name}', encoding='utf-8')
+            roots = ['--path', str(temp_path / 'api'), '--path', str(temp_path / 'web')]
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(temp_path / 'full.yml')] + roots)
+            assert result.exit_code == 0, result.output
+            result = runner.invoke(cli, ['list', str(temp_path / 'full.yml')])
+            assert result.output.split() == ['api/main.py', 'web/main.py']
+
+            (temp_path / 'web' / 'main.py').write_text('# changed', encoding='utf-8')
+            result = runner.invoke(cli, ['create', str(temp_path / 'inc.yml'), '--incremental',
+                                         '--base', str(temp_path / 'full.yml')] + roots)
+            assert result.exit_code == 0, result.output
+            assert 'Изменено и добавлено файлов: 1' in result.output
+
+            restore_path = temp_path / 'restore'
+            result = runner.invoke(cli, ['restore', str(temp_path / 'inc.yml'), str(restore_path)])
+            assert result.exit_code == 0, result.output
+            assert (restore_path / 'api' / 'main.py').read_text(encoding='utf-8') == '# api'
+            assert (restore_path / 'web' / 'main.py').read_text(encoding='utf-8') == '# changed'
+
+            result = runner.invoke(cli, ['create', str(temp_path / 'bad.yml'), '--incremental',
+                                         '--base', str(temp_path / 'full.yml'), '--path', str(temp_path / 'api')])
+            assert result.exit_code != 0
+
+
+class TestVerifyDiff:
+    """Тесты для сравнения бэкапа с деревом на диске (verify и diff)"""
+
+    def test_diff_reports_added_removed_modified(self):
+        """diff находит изменения по stat, а --checksum отсеивает смену одного mtime"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'pkg').mkdir(parents=True)
+            for name in ['keep.py', 'touched.py', 'edited.py', 'gone.py']:
+                (source_path / 'pkg' / name).write_text(f'# {name}', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)])
+            assert result.exit_code == 0, result.output
+
+            (source_path / 'pkg' / 'new.py').write_text('# new', encoding='utf-8')
+            (source_path / 'pkg' / 'gone.py').unlink()
+            (source_path / 'pkg' / 'edited.py').write_text('# edited.py, longer', encoding='utf-8')
+            os.utime(source_path / 'pkg' / 'touched.py', (1, 1))
+
+            result = runner.invoke(cli, ['diff', str(backup_path), '--json'])
+            assert result.exit_code == 0, result.output
+            assert json.loads(result.output) == {
+                'added': ['pkg/new.py'], 'removed': ['pkg/gone.py'],
+                'modified': ['pkg/edited.py', 'pkg/touched.py'],
+            }
+
+            result = runner.invoke(cli, ['diff', str(backup_path), '--path', str(source_path), '--checksum'])
+            assert result.output.splitlines() == ['M\tpkg/edited.py', 'D\tpkg/gone.py', 'A\tpkg/new.py']
+
+    def test_verify_restored_tree(self):
+        """verify сверяет восстановленное дерево по хешу и сообщает о расхождениях кодом выхода"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'main.py').write_text('print(1)', encoding='utf-8')
+            (source_path / 'README.md').write_text('# Readme', encoding='utf-8')
+            backup_path = temp_path / 'backup.rec'
+            restore_path = temp_path / 'restore'
+
+            runner = CliRunner()
+            runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path), '--format', 'records'])
+            runner.invoke(cli, ['restore', str(backup_path), str(restore_path)])
+            result = runner.invoke(cli, ['verify', str(backup_path), '--path', str(restore_path), '-j', '2'])
+            assert result.exit_code == 0, result.output
+            assert 'совпадает' in result.output
+
+            (restore_path / 'main.py').write_text('print(2)', encoding='utf-8')
+            result = runner.invoke(cli, ['verify', str(backup_path), '--path', str(restore_path), '--json'])
+            assert result.exit_code == 1
+            assert json.loads(result.output)['modified'] == ['main.py']
+
+
+    @pytest.mark.parametrize('oversize', ['warn', 'truncate'])
+    def test_verify_uses_rules_recorded_by_create(self, oversize):
+        """verify сразу после create с --max-file-size и --include не находит расхождений"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'pkg' / 'sub').mkdir(parents=True)
+            (source_path / 'pkg' / 'main.py').write_text('print(1)', encoding='utf-8')
+            (source_path / 'pkg' / 'sub' / 'big.txt').write_text('x' * 4096, encoding='utf-8')
+            (source_path / 'pkg' / 'sub' / 'bigcp.txt').write_bytes('я'.encode('cp1251') * 4096)
+            (source_path / 'Makefile').write_text('all:\n', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--max-file-size', '1K', '--oversize', oversize, '--include', 'Makefile'])
+            assert result.exit_code == 0, result.output
+            result = runner.invoke(cli, ['verify', str(backup_path)])
+            assert result.exit_code == 0, result.output
+
+            # Опции командной строки по-прежнему заменяют записанные правила
+            result = runner.invoke(cli, ['diff', str(backup_path), '--max-file-size', '1M'])
+            expected = [] if oversize == 'truncate' else ['A\tpkg/sub/big.txt', 'A\tpkg/sub/bigcp.txt']
+            assert result.output.splitlines() == expected
+
+
+class TestIntegrity:
+    """Тесты для хешей записей, контрольной суммы бэкапа, check и restore --verify"""
+
+    @pytest.mark.parametrize('backup_format', ['yaml', 'records'])
+    def test_check_and_verify_detect_corruption(self, backup_format):
+        """Поврежденная запись находится check и restore --verify, остальные файлы восстанавливаются"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            (source_path / 'main.py').write_text('print("original")', encoding='utf-8')
+            (source_path / 'README.md').write_text('# Readme', encoding='utf-8')
+            backup_path = temp_path / f'backup.{backup_format}'
+
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--format', backup_format])
+            assert result.exit_code == 0, result.output
+            result = runner.invoke(cli, ['check', str(backup_path), '--jobs', '2'])
+            assert result.exit_code == 0, result.output
+
+            # Подмена байтов той же длины: формат остается корректным, меняется только содержимое
+            data = backup_path.read_bytes()
+            backup_path.write_bytes(data.replace(b'original', b'tampered'))
+            result = runner.invoke(cli, ['check', str(backup_path)])
+            assert result.exit_code == 1
+            assert 'повреждена запись main.py' in result.output
+            assert 'контрольная сумма не совпадает' in result.output
+
+            restore_path = temp_path / 'restore'
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path), '--verify', '-j', '2'])
+            assert result.exit_code == 1
+            assert 'Поврежден файл' in result.output and 'main.py' in result.output
+            assert (restore_path / 'README.md').read_text(encoding='utf-8') == '# Readme'
+
+    def test_check_truncated_backup(self):
+        """Обрезанный сжатый бэкап не проходит check"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            source_path.mkdir()
+            for i in range(20):
+                (source_path / f'module{i}.py').write_text(f'value = {i}\n' * 50, encoding='utf-8')
+            backup_path = temp_path / 'backup.yml.gz'
+
+            runner = CliRunner()
+            runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path)])
+            data = backup_path.read_bytes()
+            backup_path.write_bytes(data[:len(data) // 2])
+            result = runner.invoke(cli, ['check', str(backup_path)])
+            assert result.exit_code == 1
+            assert 'бэкап поврежден' in result.output
+
+
+class TestBinaryFiles:
+    """Тесты для режима --all-files и хранения двоичных файлов байтами"""
+
+    @pytest.mark.parametrize('backup_format', ['yaml', 'records'])
+    def test_all_files_roundtrip(self, backup_format):
+        """Двоичные файлы сохраняются компактно и восстанавливаются байт в байт"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'img').mkdir(parents=True)
+            png = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + bytes(range(256)) * 8
+            (source_path / 'img' / 'logo.png').write_bytes(png)
+            (source_path / 'fixture.json').write_bytes(b'{"a": 1}\x00\xff')
+            (source_path / 'poetry.lock').write_text('[[package]]\nname = "click"\n', encoding='utf-8')
+            (source_path / 'main.py').write_text('print(1)\n', encoding='utf-8')
+            assert read_file_text(source_path / 'fixture.json') == (b'{"a": 1}\x00\xff', 'binary')
+
+            backup_path = temp_path / f'backup.{backup_format}'
+            restore_path = temp_path / 'restore'
+            runner = CliRunner()
+            result = runner.invoke(cli, ['create', str(backup_path), '--path', str(source_path),
+                                         '--format', backup_format, '--all-files'])
+            assert result.exit_code == 0, result.output
+            if backup_format == 'yaml':
+                text = backup_path.read_text(encoding='utf-8')
+                assert '!!binary' in text
+                # base64 без экранирования: бэкап не больше 4/3 содержимого с запасом на метаданные
+                assert len(text) < len(png) * 4 / 3 + 2000
+
+            result = runner.invoke(cli, ['restore', str(backup_path), str(restore_path), '--verify'])
+            assert result.exit_code == 0, result.output
+            for rel_path in ['img/logo.png', 'fixture.json', 'poetry.lock', 'main.py']:
+                assert (restore_path / rel_path).read_bytes() == (source_path / rel_path).read_bytes()
+
+            # Без --all-files по-прежнему сохраняются только текстовые расширения
+            result = runner.invoke(cli, ['create', str(temp_path / 'text.yml'), '--path', str(source_path)])
+            assert 'Всего файлов: 2' in result.output
+
+
+class TestWatch:
+    """Тесты для индекса дерева в памяти и команды watch"""
+
+    def test_index_refresh_reads_only_marked_dirs(self):
+        """refresh находит изменения только в помеченных директориях и учитывает новые правила"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            root = (temp_path / 'source').resolve()
+            (root / 'pkg').mkdir(parents=True)
+            (root / 'docs').mkdir()
+            for name in ['a.py', 'b.py']:
+                (root / 'pkg' / name).write_text(f'# {name}', encoding='utf-8')
+            (root / 'docs' / 'guide.md').write_text('# Guide', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+            rules = ScanRules()
+            structure = scan_project(root, backup_path, rules, StageStats())
+            result = save_backup(backup_path, root, structure)
+            index = TreeIndex(root, rules, structure['structure'], result['manifest'])
+
+            (root / 'pkg' / 'a.py').write_text('# a.py, edited', encoding='utf-8')
+            (root / 'pkg' / 'b.py').unlink()
+            (root / 'pkg' / 'sub').mkdir()
+            (root / 'pkg' / 'sub' / 'c.py').write_text('# c', encoding='utf-8')
+            (root / 'docs' / 'notes.md').write_text('# Notes', encoding='utf-8')
+            index.mark([('pkg', 'a.py'), ('pkg', 'b.py'), ('pkg', 'sub')])
+            assert index.refresh() == 3
+            assert sorted(index.changed) == ['pkg/a.py', 'pkg/sub/c.py']
+            assert index.deleted == {'pkg/b.py'}
+            assert index.new_dirs == {'pkg/sub'}
+            assert list(index.snapshot_structure()['pkg']) == ['sub', 'a.py']
+
+            index.commit({'pkg/a.py': [14, 0.0, 'x'], 'pkg/sub/c.py': [3, 0.0, 'y']})
+            assert sorted(index.files) == ['docs/guide.md', 'pkg/a.py', 'pkg/sub/c.py']
+            assert not index.pending()
+
+            # Новый .backupignore перечитывает поддерево директории с новыми правилами
+            (root / 'docs' / '.backupignore').write_text('*.md\n', encoding='utf-8')
+            index.mark([('docs', '.backupignore')])
+            index.refresh()
+            assert index.deleted == {'docs/guide.md'}
+            assert not index.changed
+
+    @pytest.mark.parametrize('poll', [True, False])
+    def test_watch_writes_incremental_chain(self, poll):
+        """watch пишет цепочку снимков с разностными манифестами, и restore последнего воспроизводит дерево"""
+        if not poll:
+            try:
+                InotifyWatcher(Path('.')).close()
+            except OSError:
+                pytest.skip('inotify недоступен')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'pkg').mkdir(parents=True)
+            for name in ['keep.py', 'edited.py', 'gone.py']:
+                (source_path / 'pkg' / name).write_text(f'# {name}', encoding='utf-8')
+            # Снимки внутри дерева не должны попадать сами в себя
+            backup_path = source_path / 'backup.yml'
+            first = source_path / 'backup.0001.yml'
+
+            def change() -> None:
+                time.sleep(0.5)
+                (source_path / 'pkg' / 'edited.py').write_text('# edited, longer', encoding='utf-8')
+                (source_path / 'pkg' / 'gone.py').unlink()
+                deadline = time.monotonic() + 10
+                while not (source_path / 'backup.0001.yml.index').exists() and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                (source_path / 'new' / 'deep').mkdir(parents=True)
+                (source_path / 'new' / 'deep' / 'added.md').write_text('# added', encoding='utf-8')
+
+            thread = threading.Thread(target=change)
+            thread.start()
+            args = ['watch', str(backup_path), '--path', str(source_path), '--debounce', '0.2',
+                    '--interval', '0.2', '--count', '2', '--duration', '20']
+            runner = CliRunner()
+            result = runner.invoke(cli, args + (['--poll'] if poll else []))
+            thread.join()
+            assert result.exit_code == 0, result.output
+            assert 'Снимков: 2' in result.output
+            assert ('inotify' in result.output) != poll
+
+            header = json.loads((source_path / 'backup.0001.yml.manifest').read_text(encoding='utf-8').splitlines()[0])
+            assert header['base'] == 'backup.yml'
+            assert header['deleted'] == ['pkg/gone.py']
+            first_header = yaml.safe_load(first.read_text(encoding='utf-8').split('structure:')[0])
+            assert first_header['metadata']['changed_files'] == 1
+
+            result = runner.invoke(cli, ['diff', str(source_path / 'backup.0002.yml'), '--json',
+                                         '--exclude', 'backup.*'])
+            assert json.loads(result.output) == {'added': [], 'removed': [], 'modified': []}
+            restore_path = temp_path / 'restore'
+            result = runner.invoke(cli, ['restore', str(source_path / 'backup.0002.yml'), str(restore_path)])
+            assert result.exit_code == 0, result.output
+            restored = sorted(path.relative_to(restore_path).as_posix()
+                              for path in restore_path.rglob('*') if path.is_file())
+            assert restored == ['new/deep/added.md', 'pkg/edited.py', 'pkg/keep.py']
+            assert (restore_path / 'pkg' / 'edited.py').read_text(encoding='utf-8') == '# edited, longer'
+
+
+    def test_watch_keeps_emptied_directory(self):
+        """Директория, из которой удален единственный файл, остается после restore цепочки"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir)
+            source_path = temp_path / 'source'
+            (source_path / 'sub').mkdir(parents=True)
+            (source_path / 'sub' / 'only.py').write_text('# only', encoding='utf-8')
+            (source_path / 'main.py').write_text('# main', encoding='utf-8')
+            backup_path = temp_path / 'backup.yml'
+
+            def change() -> None:
+                time.sleep(0.5)
+                (source_path / 'sub' / 'only.py').unlink()
+
+            thread = threading.Thread(target=change)
+            thread.start()
+            runner = CliRunner()
+            result = runner.invoke(cli, ['watch', str(backup_path), '--path', str(source_path), '--poll',
+                                         '--debounce', '0.2', '--interval', '0.2', '--count', '1',
+                                         '--duration', '20'])
+            thread.join()
+            assert result.exit_code == 0, result.output
+            assert 'Снимков: 1' in result.output
+
+            restore_path = temp_path / 'restore'
+            result = runner.invoke(cli, ['restore', str(temp_path / 'backup.0001.yml'), str(restore_path)])
+            assert result.exit_code == 0, result.output
+            assert sorted(path.relative_to(restore_path).as_posix() for path in restore_path.rglob('*')) == [
+                'main.py', 'sub']
 
 
 class TestIntegration: